@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""CLs values, singly (CLs) and as structured numpy arrays (CLsDtype) for bulk operations.
+These need nothing but numpy, so they can be used (and tested) without ROOT.
+"""
+
+import math
+import numpy
+
+class CLs(object):
+    """Small data class: a CLs value, whether it is valid (ie not below the calibrated range),
+    and its ratio to the minimum calibrated CLs value.
+    Slots are used, as there is one of these per SR per model.
+    See also CLsArray, for handling many values at once.
+    """
+
+    __slots__ = ('value','valid','ratio')
+
+    def __init__(self, value, valid=True, ratio=1.):
+        if isinstance(value, CLs):
+            # Copy constructor
+            self.value = value.value
+            self.valid = value.valid
+            self.ratio = value.ratio
+            return
+
+        # If "value" is negative, then it must be the log of a CLs value
+        self.value = value if value > 0 else math.pow(10,value)
+        self.valid = valid
+        self.ratio = ratio # ratio to minimum CLs value
+
+    def __getstate__(self):
+        return (self.value,self.valid,self.ratio)
+
+    def __setstate__(self, state):
+        self.value,self.valid,self.ratio = state
+
+    def __float__(self):
+        return float(self.value)
+
+    def __lt__(self, other):
+        return self.value < (other.value if isinstance(other, CLs) else float(other))
+
+    def __le__(self, other):
+        return self.value <= (other.value if isinstance(other, CLs) else float(other))
+
+    def __gt__(self, other):
+        return self.value > (other.value if isinstance(other, CLs) else float(other))
+
+    def __ge__(self, other):
+        return self.value >= (other.value if isinstance(other, CLs) else float(other))
+
+    def __cmp__(self, other):
+        othervalue = other.value if isinstance(other, CLs) else float(other)
+        if self.value < othervalue:
+            return -1
+        elif self.value > othervalue:
+            return 1
+        else:
+            return 0
+
+    def __mul__(self, other):
+        # A bit tricky to define, but let's go
+        # Explanation: the ratio is used to determine if the
+        # result was extrapolated. Therefore we want to
+        # record the worst case, ie the smallest.
+        return CLs(self.value*other.value, self.valid and other.valid, min(self.ratio,other.ratio))
+
+    @classmethod
+    def product(cls, values):
+        """The product of a list of CLs objects, as reduce(lambda x,y: x*y, values, CLs(1.)),
+        without making the intermediate objects."""
+
+        value = 1.
+        valid = True
+        ratio = 1.
+        for item in values:
+            value *= item.value
+            valid = valid and item.valid
+            ratio = min(ratio,item.ratio)
+        return cls(value, valid, ratio)
+
+    def __str__(self):
+
+        valuestr = '%.3f'%(self.value) if self.value > 0.01 else '%.2e'%(self.value)
+        if self.valid:
+            return valuestr
+        else:
+            return 'INVALID CLs value of %s'%valuestr
+
+    def __repr__(self):
+        return self.__str__()
+
+# The structured-array form of CLs, for bulk operations on many values (eg all SRs, or all models)
+CLsDtype = numpy.dtype([('value',numpy.float64), ('valid',numpy.bool_), ('ratio',numpy.float64)])
+
+def CLsArray(values, valid=True, ratio=1.):
+    """Returns a structured array (see CLsDtype) of CLs values.
+    As for the CLs constructor, values that are not positive are taken to be log10(CLs).
+    values can also be a list of CLs objects, in which case valid and ratio are taken from them.
+    """
+
+    if len(values) and isinstance(values[0], CLs):
+        result = numpy.empty(len(values), dtype=CLsDtype)
+        result['value'] = [item.value for item in values]
+        result['valid'] = [item.valid for item in values]
+        result['ratio'] = [item.ratio for item in values]
+        return result
+
+    values = numpy.asarray(values, dtype=numpy.float64)
+    result = numpy.empty(values.shape, dtype=CLsDtype)
+    result['value'] = numpy.where(values > 0, values, numpy.power(10., numpy.minimum(values, 0.)))
+    result['valid'] = valid
+    result['ratio'] = ratio
+    return result
+
+def CLsList(array):
+    """The CLs objects corresponding to a one-dimensional structured array (see CLsArray)."""
+    return [CLs(float(value), bool(valid), float(ratio)) for value,valid,ratio in zip(array['value'],array['valid'],array['ratio'])]
+
+def SortCLs(array, axis=-1):
+    """Indices that sort a structured CLs array by value along the axis (smallest first, stable like sorted)."""
+    return numpy.argsort(array['value'], axis=axis, kind='mergesort')
+
+def MultiplyCLs(array, axis=-1):
+    """Product of the CLs values along the axis, with the same meaning as CLs.product:
+    valid only if all values are, and with the smallest ratio (at most one)."""
+
+    values = array['value'].prod(axis=axis)
+    result = numpy.empty(values.shape, dtype=CLsDtype)
+    result['value'] = values
+    result['valid'] = array['valid'].all(axis=axis)
+    if array.shape[axis]:
+        result['ratio'] = numpy.minimum(array['ratio'].min(axis=axis), 1.)
+    else:
+        result['ratio'] = 1.
+    return result
+
+def TruncateCLs(array, minimum=1e-6):
+    """Raises CLs values below minimum to the minimum, in place. Returns the array."""
+
+    array['value'] = numpy.maximum(array['value'], minimum)
+    return array
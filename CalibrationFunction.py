@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""Python interface to CalibrationFunction.C, which provides natively evaluated
+calibration functions, ie a HistFitter curve with one normalisation parameter.
+
+The TF1 objects are functionally identical to the old
+ROOT.TF1('fitfunc', lambda x,p: graph.Eval(x[0])/p[0], -6, 0, 1)
+but are evaluated without calling back into python.
+A TF1 written to a file only keeps a sampled version of the function,
+so the CalibrationCurve should be written alongside it (see CorrelationPlotter.SaveData)
+and RestoreCalibrationFunction used to rebuild the original function when reading.
+"""
+
+import os
+import ROOT
+
+def LoadLibrary():
+    """Compiles (if needed) and loads CalibrationFunction.C.
+    Safe to call many times, the work is only done once."""
+
+    if hasattr(ROOT, 'CalibrationCurve'):
+        return
+
+    # Find the macro relative to this file, so this works from any directory (eg HistFitter/)
+    macro = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CalibrationFunction.C')
+    if ROOT.gROOT.LoadMacro(macro+'+'):
+        raise RuntimeError('Could not compile %s'%(macro))
+
+def MakeCalibrationFunction(graph, name='fitfunc', xmin=-6, xmax=0, divide=True):
+    """Returns a TF1 evaluating graph(x)/p[0] (or graph(x)*p[0] if divide is False).
+    The TF1 is augmented with the original graph and the CalibrationCurve,
+    for the convenience of downstream code.
+    """
+
+    LoadLibrary()
+
+    curve = ROOT.CalibrationCurve(graph, divide)
+    func = curve.MakeTF1(name, xmin, xmax)
+    # Behave like a TF1 created in python
+    ROOT.SetOwnership(func, True)
+
+    func.graph = graph
+    func.curve = curve
+    return func
+
+def EvalCalibrationFunction(func, x):
+    """Vectorised func.Eval for a numpy array of x values.
+    Functions made here are evaluated by interpolating the original graph with numpy
+    and applying the normalisation parameter, ie without one PyROOT call per value.
+    Other functions fall back to calling func.Eval for each value.
+    """
+
+    import numpy
+
+    x = numpy.asarray(x, dtype=numpy.float64)
+
+    try:
+        graph = func.graph
+        curve = func.curve
+    except AttributeError:
+        return numpy.array([func.Eval(xval) for xval in x])
+
+    from GraphTools import EvalGraph
+
+    values = EvalGraph(graph, x)
+    if curve.Divides():
+        return values/func.GetParameter(0)
+    return values*func.GetParameter(0)
+
+def RestoreCalibrationFunction(func, curve):
+    """Rebuilds a native TF1 from a CalibrationCurve and a TF1 read back from a file.
+    The range, name and parameter (with error) are taken from the stored TF1.
+    """
+
+    LoadLibrary()
+
+    result = curve.MakeTF1(func.GetName(), func.GetXmin(), func.GetXmax())
+    ROOT.SetOwnership(result, True)
+    for iparam in range(func.GetNpar()):
+        result.SetParameter(iparam, func.GetParameter(iparam))
+        result.SetParError(iparam, func.GetParError(iparam))
+
+    result.graph = curve.GetGraph()
+    result.curve = curve
+    return result
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""Memory-mappable copies of ntuple columns, stored next to the ROOT file they came from.
+
+Reading the yields through PyROOT decompresses the ROOT baskets and makes a python call per
+entry and branch. ExportColumns writes selected branches once, as one .npy file per branch
+in <file>.columns/ (float32, except modelName which is int32), with a manifest.json describing
+them and the ROOT file. OpenColumns then returns numpy arrays memory-mapped from these files,
+so reading them again costs little more than the page cache.
+
+A cache is only used while its ROOT file is unchanged (same size, modification time and inode).
+Otherwise OpenColumns returns None, and the caller should read the tree as before.
+"""
+
+import fnmatch
+import json
+import os
+import numpy
+import ROOT
+
+from GraphTools import BufferToArray
+
+# Bump this if the format of the cache changes
+CACHEVERSION = 2
+
+# The branches exported by default: the model ID, and the truth yields and their errors
+DEFAULTPATTERNS = ['modelName', '*ExpectedEvents*', '*ExpectedError*']
+
+# Entries read per TTree::Draw call
+CHUNKSIZE = 1000000
+
+def ReadColumns(tree, varexp, first, nentries):
+    """Returns a list of numpy arrays with the values of the (up to four) ':'-separated
+    expressions in varexp, for the entries [first,first+nentries), using TTree::Draw.
+    The expressions should have one value per entry."""
+
+    if tree.GetEstimate() < nentries:
+        tree.SetEstimate(nentries)
+
+    nrows = tree.Draw(varexp, '', 'goff', nentries, first)
+    if nrows < 0:
+        raise RuntimeError('Could not read %s from %s'%(varexp,tree.GetName()))
+
+    buffers = [tree.GetV1, tree.GetV2, tree.GetV3, tree.GetV4]
+    return [BufferToArray(buffers[i](), nrows) for i in range(len(varexp.split(':')))]
+
+def CacheDirectory(rootfilename):
+    """Where the columns of rootfilename are kept."""
+    return os.path.splitext(rootfilename)[0]+'.columns'
+
+def SourceID(filename):
+    """What identifies the version of a file, as stored in the manifest.
+    The modification time is kept to sub-second precision, and the inode catches
+    files replaced by a rename (eg by IncrementalSkim) within the same clock tick."""
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'inode': stat.st_ino}
+
+def _ManifestName(directory):
+    return os.path.join(directory, 'manifest.json')
+
+def ExportColumns(rootfilename, patterns=DEFAULTPATTERNS, treename='susy', chunksize=CHUNKSIZE):
+    """Writes the branches of the tree matching any of the (fnmatch) patterns to CacheDirectory(rootfilename).
+    Any previous columns in that directory are replaced.
+    """
+
+    infile = ROOT.TFile.Open(rootfilename)
+    tree = infile.Get(treename)
+    nentries = tree.GetEntries()
+
+    branchnames = [branch.GetName() for branch in tree.GetListOfBranches()]
+    selected = [name for name in branchnames if any([fnmatch.fnmatchcase(name, pattern) for pattern in patterns])]
+
+    directory = CacheDirectory(rootfilename)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    # The old cache is invalid from here on
+    if os.path.exists(_ManifestName(directory)):
+        os.remove(_ManifestName(directory))
+
+    # Read one branch at a time, so only that one is decompressed
+    tree.SetBranchStatus('*', 0)
+    columns = {}
+    for name in selected:
+
+        tree.SetBranchStatus(name, 1)
+        array = numpy.empty(nentries, dtype=numpy.int32 if name == 'modelName' else numpy.float32)
+        for first in xrange(0, nentries, chunksize):
+            n = min(chunksize, nentries-first)
+            array[first:first+n] = ReadColumns(tree, name, first, n)[0]
+        tree.SetBranchStatus(name, 0)
+
+        filename = name+'.npy'
+        numpy.save(os.path.join(directory, filename), array)
+        columns[name] = {'file': filename, 'dtype': array.dtype.str}
+
+    infile.Close()
+
+    # Remove columns left over from earlier exports
+    for filename in os.listdir(directory):
+        if filename.endswith('.npy') and filename[:-4] not in columns:
+            os.remove(os.path.join(directory, filename))
+
+    manifest = {
+        'version': CACHEVERSION,
+        'tree': treename,
+        'entries': nentries,
+        'source': SourceID(rootfilename),
+        'columns': columns,
+        }
+    with open(_ManifestName(directory), 'w') as manifestfile:
+        json.dump(manifest, manifestfile, indent=1, sort_keys=True)
+
+    print 'INFO: Exported %i columns of %s to %s'%(len(columns),rootfilename,directory)
+
+def OpenColumns(rootfilename, treename='susy'):
+    """Returns a ColumnCache with the exported columns of rootfilename,
+    or None if there are none, or they are out of date."""
+
+    directory = CacheDirectory(rootfilename)
+    try:
+        with open(_ManifestName(directory)) as manifestfile:
+            manifest = json.load(manifestfile)
+        source = SourceID(rootfilename)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if manifest.get('version') != CACHEVERSION or manifest.get('tree') != treename:
+        return None
+    if manifest.get('source') != source:
+        print 'INFO: Ignoring the out-of-date columns in %s'%(directory)
+        return None
+
+    return ColumnCache(directory, manifest)
+
+class ColumnCache:
+    """Read-only access to the columns exported by ExportColumns (see OpenColumns).
+    Columns are numpy arrays memory-mapped from their files, indexed by entry number.
+    """
+
+    def __init__(self, directory, manifest):
+
+        self.directory = directory
+        self.nentries = manifest['entries']
+        self.__columns = manifest['columns']
+        self.__arrays = {}
+
+    def __contains__(self, name):
+        return name in self.__columns
+
+    def names(self):
+        return sorted(self.__columns.keys())
+
+    def __getitem__(self, name):
+
+        try:
+            return self.__arrays[name]
+        except KeyError:
+            pass
+
+        array = numpy.load(os.path.join(self.directory, self.__columns[name]['file']), mmap_mode='r')
+        self.__arrays[name] = array
+        return array
+
+    def Rows(self, names, chunksize=10000):
+        """Iterates over the entries, giving (entry number, array of the values of the named columns).
+        The columns are read a chunk of entries at a time."""
+
+        for first in xrange(0, self.nentries, chunksize):
+            last = min(first+chunksize, self.nentries)
+            chunk = numpy.column_stack([numpy.asarray(self[name][first:last], dtype=numpy.float64) for name in names])
+            for irow in xrange(last-first):
+                yield first+irow,chunk[irow]
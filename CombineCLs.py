@@ -1,59 +1,12 @@
 #!/usr/bin/env python
 
 import pickle,math
-
-class CLs:
-    """Small data class"""
-
-    def __init__(self, value):
-        try:
-            # Maybe "value" is actually a CLs object
-            self.value = value.value
-            self.valid = value.valid
-            self.ratio = value.ratio
-        except AttributeError:
-            # Or maybe "value" is really just a value
-            # If "value" is negative, then it must be the log of a CLs value
-            if value > 0:
-                self.value = value
-            else:
-                self.value = math.pow(10,value)
-            self.valid = True
-            self.ratio = 1. # ratio to minimum CLs value
-
-    def __float__(self):
-        return float(self.value)
-
-    def __cmp__(self, other):
-        if self.value < float(other):
-            return -1
-        elif self.value > float(other):
-            return 1
-        else:
-            return 0
-
-    def __mul__(self, other):
-        # A bit tricky to define, but let's go
-
-        result = CLs(self.value*other.value)
-        result.valid = self.valid and other.valid
-        result.ratio = min([self.ratio,other.ratio])
-        # Explanation: the ratio is used to determine if the
-        # result was extrapolated. Therefore we want to
-        # record the worst case, ie the smallest.
-
-        return result
-
-    def __str__(self):
-
-        valuestr = '%.3f'%(self.value) if self.value > 0.01 else '%.2e'%(self.value)
-        if self.valid:
-            return valuestr
-        else:
-            return 'INVALID CLs value of %s'%valuestr
-
-    def __repr__(self):
-        return self.__str__()
+import numpy
+from CalibrationFunction import LoadLibrary,RestoreCalibrationFunction
+from CLsValues import CLs,CLsArray,CLsList,SortCLs,MultiplyCLs,TruncateCLs
+from SRCatalogue import SRCatalogue
+from ColumnCache import OpenColumns
+from TreeIO import OpenTree
 
 class DoNotProcessError(Exception):
     """Signals that there is something really wrong with the model,
@@ -79,6 +32,7 @@ class Combiner:
         self.strategy = 'smallest'
         self.truncate = False
         self.useexpected = False
+        self.nproc = 1 # Processes used to render the plots
 
     @classmethod
     def __FixXrange(cls, graph):
@@ -101,40 +55,6 @@ class Combiner:
         # Nothing more to do
         return
 
-    @classmethod
-    def __HepDataSRname(cls, SR):
-        """Reinterpret the in-code SR name with a theorist-friendly one for HepData.
-        """
-
-        splitname = SR.split('_')
-
-        if splitname[0] == 'EwkTwoLepton':
-            if 'mT' in splitname[-1]:
-                threshold = 90 if 'a' in splitname[-1] else (120 if 'b' in splitname[-1] else 150)
-                return '2L_SR_mT2_%i'%(threshold)
-            else: # Zjets or WWx
-                return '2L_SR_%s'%(splitname[-1])
-
-        elif splitname[0] == 'EwkThreeLepton':
-            if 'SR0a' in splitname[-2]:
-                return '3L_SR_0tau_a_bin_%s'%(splitname[-1])
-            elif splitname[-1] == 'SR0b':
-                return '3L_SR_0tau_b'
-            elif splitname[-1] == 'SR1SS':
-                return '3L_SR_1tau'
-
-        elif splitname[0] == 'EwkFourLepton':
-            return '4L_%s'%(splitname[-1])
-
-        elif splitname[0] == 'EwkTwoTau':
-            if splitname[2].startswith('C1'):
-                return '2tau_SR_%s'%(splitname[2])
-            else:
-                return '2tau_SR_DS_lowMass' if 'low' in splitname[-1] else '2tau_SR_DS_highMass'
-
-        # If we get here, something went wrong
-        return SR #'ERROR'
-
     def ReadCalibrations(self, calibfilename):
         """Reads all TF1 objects and stores them in self.CalibCurves.
         This is a dictionary, with entries either like {SRname: CL_graph}.
@@ -145,6 +65,9 @@ class Combiner:
         self.CalibCurves = {}
         self.CalibCurvesExp = {}
 
+        # The CalibrationCurve dictionary must be loaded before the curves are read from the file
+        LoadLibrary()
+
         calibfile = ROOT.TFile.Open(calibfilename)
 
         for keyname in calibfile.GetListOfKeys():
@@ -159,6 +82,12 @@ class Combiner:
 
             # This is a graph we want!
 
+            # The stored TF1 is only a sampled version of the calibration function.
+            # If the original curve was saved too, rebuild the real (native) function.
+            curve = calibfile.Get(keyname+'_curve')
+            if curve:
+                thing = RestoreCalibrationFunction(thing, curve)
+
             # Fix its x-axis range
             self.__FixXrange(thing)
             
@@ -174,86 +103,104 @@ class Combiner:
 
         calibfile.Close()
 
+        # Integer IDs for the SRs, used by the loop over models
+        self.catalogue = SRCatalogue(self.CalibCurves.keys())
+        self.__curves = [self.CalibCurves[name] for name in self.catalogue.names]
+        self.__curvesExp = [self.CalibCurvesExp.get(name) for name in self.catalogue.names]
+        self.__limits = self.__CurveLimits(self.__curves)
+        self.__limitsExp = self.__CurveLimits(self.__curvesExp)
+
         return
 
-    def __AnalyseModel(self, entry):
-        """Analyse a single entry in the ntuple.
+    @classmethod
+    def __CurveLimits(cls, curves):
+        """The range checks of __AnalyseModel for each curve (or None), as arrays indexed by SR ID:
+        whether the curve is on a log scale, the CLs value above which results are dropped,
+        and the minimum valid CLs value (graph.xmin)."""
+
+        islog = numpy.zeros(len(curves), dtype=bool)
+        maximum = numpy.ones(len(curves))
+        minimum = numpy.zeros(len(curves))
+        for iSR,graph in enumerate(curves):
+            if graph is None:
+                continue
+            islog[iSR] = graph.GetXmin() < 0
+            if islog[iSR]:
+                maximum[iSR] = math.pow(10, graph.GetXmax())
+            else:
+                maximum[iSR] = 0.999*graph.GetXmax()
+            minimum[iSR] = graph.xmin
+        return islog,maximum,minimum
+
+    def __AnalyseModel(self, yields):
+        """Analyse a single model, given the truth yields of the SRs (indexed by SR ID).
+        Returns the combined CLs, the ID of the best SR in self.catalogue (None if there is none),
+        the observed and expected CLs of all SRs as structured arrays indexed by ID (see CLsArray),
+        and a boolean array of the SRs that have a result.
+        The expected CLs are only filled if self.useexpected is set.
         This can raise a DoNotProcessError if the truth yields are not present."""
 
-        results = {}
-        resultsExp = {}
+        nSRs = len(self.catalogue)
+        results = CLsArray(numpy.ones(nSRs))
+        resultsExp = CLsArray(numpy.ones(nSRs))
+        active = numpy.zeros(nSRs, dtype=bool)
         negativeYieldList = []
 
-        def GetCLs(graph, truthyield):
-            """Small helper function to extract a valid CLs from a TGraph.
-            If the number is out of the valid range, then None is returned.
+        def GetCLs(graph, limits, iSR, truthyield, output):
+            """Small helper function to extract a valid CLs from a TGraph into output[iSR].
+            If the number is out of the valid range, then False is returned.
             """
 
-            result = CLs(graph.GetX(truthyield))
+            value = graph.GetX(truthyield)
+            # As for CLs objects, a negative value is log(CLs)
+            if value <= 0:
+                value = math.pow(10,value)
 
-            # If on a linear scale, check if the CLs value is within the valid range
-            if graph.GetXmin() >= 0 and result.value >= 0.999*graph.GetXmax():
+            # Check if the CLs value is within the valid range (see __CurveLimits)
+            islog,maximum,minimum = limits
+            if value >= maximum[iSR]:
                 # Too high
-                return None
-            # Similar range check for a log scale
-            if graph.GetXmin() < 0 and math.log10(result.value) >= graph.GetXmax():
-                return None
+                return False
 
+            output['value'][iSR] = value
             # Compare the CLs to our self-imposed minimum
-            if result.value < graph.xmin:
-                # This message prints out A LOT
-                # print 'WARNING in CombineCLs: %s has CLs = %f below the min of %s'%(analysisSR,CLs,graph.xmin)
-
-                result.valid = False
-                result.ratio = result.value/graph.xmin
+            if value < minimum[iSR]:
+                output['valid'][iSR] = False
+                output['ratio'][iSR] = value/minimum[iSR]
 
-            return result
+            return True
 
         # Start the event loop
-        for analysisSR,graph in self.CalibCurves.items():
+        for iSR,graph in enumerate(self.__curves):
 
-            # slow, slow, slow, but I guess OK for now
-            truthyield = getattr(entry, graph.branchname)
-            # trutherror = getattr(entry, '_'.join(['EW_ExpectedError',analysisSR]))
+            truthyield = yields[iSR]
             if truthyield < 0:
-                negativeYieldList.append(analysisSR)
+                negativeYieldList.append(iSR)
                 continue
 
             # Get the main result
-            number = GetCLs(graph, truthyield)
-            if number is None:
+            if not GetCLs(graph, self.__limits, iSR, truthyield, results):
                 continue
 
             if self.useexpected:
                 # See if we have the corresponding expected result
-                try:
-                    graphExp = self.CalibCurvesExp[analysisSR]
-                except KeyError:
+                graphExp = self.__curvesExp[iSR]
+                if graphExp is None:
                     # Only write the results out if we have the expected results
                     continue
 
-                numberExp = GetCLs(graphExp, truthyield)
-                if numberExp is None:
+                if not GetCLs(graphExp, self.__limitsExp, iSR, truthyield, resultsExp):
                     continue
 
-                # We have both expected+observed results, so this is looking OK
-                results[analysisSR] = number
-                resultsExp[analysisSR] = numberExp
-
-            else:
-                # self.useexpected == False
-                results[analysisSR] = number
-
-            # print '%40s: %.3f events, CLs = %s, log(CLs) = %.2f'%(analysisSR,truthyield,number,math.log10(number.value))
-            # if number.value < 1e-3:
-            #     print number.value,graph.xmin,number.ratio
+            # We have both expected+observed results (if needed), so this is looking OK
+            active[iSR] = True
 
         if negativeYieldList:
 
             # Oh dear, we may have a problem, where a model with generated events
             # has no recorded yield for one or more SRs
 
-            if len(negativeYieldList) == len(self.CalibCurves):
+            if len(negativeYieldList) == nSRs:
 
                 # Perfectly straightforward, no evgen yields were found, the model is completely broken
                 raise DoNotProcessError
@@ -263,9 +210,10 @@ class Combiner:
                 # There is a known issue with some 2tau yields
                 # If this is the only issue, the result I get should still be OK
                 # I also found one model with missing 3L results
+                names = [self.catalogue.names[iSR] for iSR in negativeYieldList]
                 onlyTau = True
                 only3L = True
-                for analysisSR in negativeYieldList:
+                for analysisSR in names:
                     if 'TwoTau' not in analysisSR:
                         onlyTau = False
                     if 'ThreeLepton' not in analysisSR:
@@ -278,48 +226,41 @@ class Combiner:
                 if not onlyTau:
                     # A bit clumsy, but I had this code already and it does the job
                     try:
-                        assert len(negativeYieldList) == len(self.CalibCurves)
+                        assert len(negativeYieldList) == nSRs
                     except AssertionError:
                         print '================ Oh dear, some SRs have yields and others don\'t!'
-                        print len(negativeYieldList),len(self.CalibCurves)
-                        for analysisSR,graph in self.CalibCurves.items():
-                            truthyield = getattr(entry, graph.branchname)
+                        print len(negativeYieldList),nSRs
+                        for analysisSR,truthyield in zip(self.catalogue.names,yields):
                             print '%30s: %6.2f'%(analysisSR,truthyield)
                         raise
                 # If only 2tau results were affected, carry on!
                 pass
 
-        if results:
+        if active.any():
 
-            # Find the best SR
-            if self.useexpected:
-                resultkey = min(resultsExp, key=resultsExp.get)
-            else:
-                resultkey = min(results, key=results.get)
-            # FIXME: Use results[resultkey] to find if CLs < 0.05
+            # Sort the SRs, best first
+            # On ties, the SR with the lowest ID wins
+            activeIDs = numpy.flatnonzero(active)
+            ranking = resultsExp if self.useexpected else results
+            sortedIDs = activeIDs[SortCLs(ranking[activeIDs])]
+            resultkey = int(sortedIDs[0])
 
             # What we do next depends on the CLs combination strategy
             if self.strategy == 'smallest':
                 # Take only the best result
-                # This is a copy constructor, as result might be truncated later
-                result = CLs(results[resultkey])
+                combined = results[sortedIDs[:1]]
 
             elif self.strategy == 'twosmallest':
-                # Now we need to sort the whole list
-                if self.useexpected:
-                    sortedkeys = sorted(resultsExp, key=resultsExp.get)[:2]
-                else:
-                    sortedkeys = sorted(results, key=results.get)[:2]
                 # Find the observed CLs from the two best results
-                mylist = [results[k] for k in sortedkeys]
-                result = reduce(lambda x,y: x*y, mylist, CLs(1.))
+                combined = MultiplyCLs(results[sortedIDs[:2]])[numpy.newaxis]
 
             # However we got the result, truncate it now if necessary
-            if self.truncate and result.value < 1e-6:
-                result.value = 1e-6
+            if self.truncate:
+                TruncateCLs(combined)
+            result = CLsList(combined)[0]
 
             if not result.valid:
-                print 'Invalid result: %s has CLs = %6e below the min of %6e'%(resultkey,result.value,self.CalibCurves[resultkey].xmin)
+                print 'Invalid result: %s has CLs = %6e below the min of %6e'%(self.catalogue.names[resultkey],result.value,self.__curves[resultkey].xmin)
 
         else:
             # Absolutely no sensitive SR
@@ -327,7 +268,15 @@ class Combiner:
             result = CLs(1.)
             result.valid = False        
         
-        return result,resultkey,results,resultsExp
+        return result,resultkey,results,resultsExp,active
+
+    @classmethod
+    def __TreeRows(cls, tree, branchnames):
+        """Iterates over the entries of the tree like ColumnCache.Rows,
+        giving (entry number, [modelName]+[value of each branch])."""
+
+        for ientry,entry in enumerate(tree):
+            yield ientry,[entry.modelName]+[getattr(entry, branchname) for branchname in branchnames]
 
     def ReadNtuple(self, outdirname, Nmodels=None, eventlist=None):
         """Read all truth yields, record the estimated CLs values.
@@ -342,20 +291,27 @@ class Combiner:
         if not os.path.exists(perSRdirname):
             os.makedirs(perSRdirname)
 
-        yieldfile = ROOT.TFile.Open(self.__yieldfilename)
+        # The SRs are referred to by their ID in self.catalogue from here on
+        catalogue = self.catalogue
+        NSRs = len(catalogue)
+
+        # Read the yields from the exported columns if possible (see ColumnCache.py), otherwise from the tree
+        columns = OpenColumns(self.__yieldfilename)
+        if columns is not None and all([name in columns for name in ['modelName']+catalogue.branchnames]):
+            print 'INFO: Reading the yields from %s'%(columns.directory)
+            yieldfile = None
+            nentries = columns.nentries
+            rows = columns.Rows(['modelName']+catalogue.branchnames)
+        else:
+            # Only the yields of the calibrated SRs are read
+            yieldfile = OpenTree(self.__yieldfilename, branches=['modelName']+catalogue.branchnames)
 
-        tree = yieldfile.Get('susy')
-        if eventlist:
-            tree.SetEventList(eventlist)
-        tree.SetBranchStatus('*', 0)
-        tree.SetBranchStatus('modelName', 1)
-        tree.SetBranchStatus('*ExpectedEvents*', 1)
+            tree = yieldfile.tree
+            if eventlist:
+                tree.SetEventList(eventlist)
 
-        for analysisSR,graph in self.CalibCurves.items():
-            graph.branchname = '_'.join(['EW_ExpectedEvents',analysisSR])
-            graph.yieldbranch = tree.GetBranch(graph.branchname)
-            graph.yieldvalue = getattr(tree, graph.branchname)
-            # I can't find out how to actually use this :(
+            nentries = tree.GetEntries()
+            rows = self.__TreeRows(tree, catalogue.branchnames)
 
         # Some stuff for record-keeping
 
@@ -373,6 +329,11 @@ class Combiner:
         # Now the count for where each SR is the best *and* CLs < 0.05
         BestExclusionCount = {'total': 0, # Total number of models excluded by the STA procedure
                             }
+        # The per-SR entries of these are counted in arrays indexed by SR ID,
+        # and added to the dictionaries after the loop over models
+        bestSRcounts = numpy.zeros(NSRs, dtype=int)
+        exclusionCounts = numpy.zeros(NSRs, dtype=int)
+        bestExclusionCounts = numpy.zeros(NSRs, dtype=int)
 
         # Plots of the CLs values for all models
         CLsTemplate = ROOT.TH1I('CLsTemplate',';CL_{s};Number of models',100,0,1)
@@ -418,11 +379,11 @@ class Combiner:
 
         # Plots of the observed CLs
         ObsCLsPlots = CLsPlots('Observed', 'CLsObs')
-        ObsCLsSRPlots = {} # One plot per best SR
+        ObsCLsSRPlots = [None]*NSRs # One plot per best SR, made when first needed
         if self.useexpected:
             # Plots of the expected CLs
             ExpCLsPlots = CLsPlots('Expected', 'CLsExp')
-            ExpCLsSRPlots = {} # One plot per best SR
+            ExpCLsSRPlots = [None]*NSRs # One plot per best SR
 
         # How many SRs were used? Absolute maximum of 42 :D
         NSRplot = ROOT.TH1I('NSRplot',';Number of active SRs;Number of models',43,-0.5,42.5)
@@ -433,15 +394,17 @@ class Combiner:
             p.SetDirectory(0)
 
         # A correlation plot
-        NSRs = len(self.CalibCurves)
         SRcorr_numerator = ROOT.TH2D('SRcorrelation_numerator','',NSRs,-0.5,NSRs-0.5,NSRs,-0.5,NSRs-0.5) # Initially fill iff both SRs exclude
         SRcorr_numerator.Sumw2()
         SRcorr_numerator.SetDirectory(0)
-        for ibin,analysisSR in enumerate(sorted(self.CalibCurves.keys())):
-            SRcorr_numerator.GetXaxis().SetBinLabel(ibin+1, analysisSR)
-            SRcorr_numerator.GetYaxis().SetBinLabel(ibin+1, analysisSR)
+        for ibin,analysisSR in zip(catalogue.bins,catalogue.names):
+            SRcorr_numerator.GetXaxis().SetBinLabel(ibin, analysisSR)
+            SRcorr_numerator.GetYaxis().SetBinLabel(ibin, analysisSR)
         SRcorr_denominator = SRcorr_numerator.Clone('SRcorrelation_denominator') # Fill if x-axis SR excludes
         SRcorr_denominator.SetDirectory(0)
+        # These are counted in arrays during the loop over models, see below
+        corrNumerator = numpy.zeros((NSRs,NSRs), dtype=int)
+        corrDenominator = numpy.zeros(NSRs, dtype=int)
 
         # Output text file for the STAs
         stafile = open('/'.join([outdirname,'STAresults.csv']), 'w')
@@ -476,15 +439,15 @@ class Combiner:
         if eventlist:
             print '%i models found in event list'%(eventlist.GetN())
         else:
-            print '%i models found in tree'%(tree.GetEntries())
+            print '%i models found in tree'%(nentries)
         imodel = 0 # Counter
 
-        for ientry,entry in enumerate(tree):
+        for ientry,row in rows:
 
             if eventlist and not eventlist.Contains(ientry):
                 continue
             
-            modelName = entry.modelName
+            modelName = int(row[0])
             if modelName % 1000 == 0:
                 print 'On model %6i'%(modelName)
 
@@ -497,70 +460,54 @@ class Combiner:
                 print '============== Model',modelName
 
             try:
-                CLresult,bestSR,CLresults,CLresultsExp = self.__AnalyseModel(entry)
+                CLresult,bestSR,CLresults,CLresultsExp,active = self.__AnalyseModel(row[1:])
             except DoNotProcessError:
                 badmodelfile.write('%i\n'%(modelName))
                 continue
 
-            # This could definitely be done in a more clever way, but let's just get it done
-            nonBestSRs = []
-            excludedSRs_CLsExp = {} # A dict of {SRname: CLsExp}, to allow sorting by best expected CLs
-            excludedSRs_CLsObs = {} # A dict of {SRname: CLsObs}, for debugging
-            for k,v in CLresults.items():
-                # if v.value < 0.05:
-                if self.useexpected:
-                    excludedSRs_CLsExp[self.__HepDataSRname(k)] = CLresultsExp[k]
-                excludedSRs_CLsObs[self.__HepDataSRname(k)] = CLresults[k]
-                if v.value < 0.05 and k != bestSR:
-                    nonBestSRs.append(k)
-            stafile.write('%i,%6e,%s,%s\n'%(modelName,CLresult.value,bestSR,','.join(nonBestSRs)))
+            # The SRs with a result, and those that exclude the model
+            activeIDs = numpy.flatnonzero(active)
+            excluding = active & (CLresults['value'] < 0.05)
+            excludingIDs = numpy.flatnonzero(excluding)
+
+            bestSRname = catalogue.names[bestSR] if bestSR is not None else None
+            nonBestSRs = [catalogue.names[iSR] for iSR in excludingIDs if iSR != bestSR]
+            stafile.write('%i,%6e,%s,%s\n'%(modelName,CLresult.value,bestSRname,','.join(nonBestSRs)))
             SRcount['STA'] += 1
 
             # Sort the SRs, the same way as in self.__AnalyseModel
-            if self.useexpected:
-                sortedSRs = sorted(excludedSRs_CLsExp, key=excludedSRs_CLsExp.get)
-            else:
-                sortedSRs = sorted(excludedSRs_CLsObs, key=excludedSRs_CLsObs.get)
+            ranking = CLresultsExp if self.useexpected else CLresults
+            sortedSRs = activeIDs[SortCLs(ranking[activeIDs])]
             # Construct two lists of SRs. First the best SR(s)
             bestSRlist = []
             # Only fill this if it makes any sense at all
             if CLresult.value < 0.99:
-                for SRname in sortedSRs:
+                bestvalue = ranking['value'][bestSR]
+                for iSR in sortedSRs:
 
                     # If the CL is too high, break out
                     # Add a sanity check that the CL is also not too low
-                    if self.useexpected:
-                        if excludedSRs_CLsExp[SRname].value - CLresultsExp[bestSR].value > 1e-2*CLresultsExp[bestSR].value:
-                            break
-                        elif excludedSRs_CLsExp[SRname].value - CLresultsExp[bestSR].value < -1e-2*CLresultsExp[bestSR].value:
-                            print '================================== ERROR ERROR ERROR RESULTS DO NOT AGREE'
-                    else:
-                        if excludedSRs_CLsObs[SRname].value - CLresults[bestSR].value > 1e-2*CLresults[bestSR].value:
-                            break
-                        elif excludedSRs_CLsObs[SRname].value - CLresults[bestSR].value < -1e-2*CLresults[bestSR].value:
-                            print '================================== ERROR ERROR ERROR RESULTS DO NOT AGREE'
+                    if ranking['value'][iSR] - bestvalue > 1e-2*bestvalue:
+                        break
+                    elif ranking['value'][iSR] - bestvalue < -1e-2*bestvalue:
+                        print '================================== ERROR ERROR ERROR RESULTS DO NOT AGREE'
                     # If we get to here, it's a "best" SR
-                    bestSRlist.append(SRname)
+                    bestSRlist.append(catalogue.hepdatanames[iSR])
 
             try:
                 if bestSRlist:
-                    assert(self.__HepDataSRname(bestSR) in bestSRlist)
+                    assert(catalogue.hepdatanames[bestSR] in bestSRlist)
             except AssertionError:
                 print '=============== best SR not in the list?'
                 from pprint import pprint
-                pprint(excludedSRs_CLsExp)
-                print bestSR
+                pprint(dict([(catalogue.hepdatanames[iSR],CLsList(ranking[[iSR]])[0]) for iSR in activeIDs]))
+                print bestSRname
                 raise
 
             bestSRstring = ';'.join(bestSRlist)
             # Now make a string of the excluding SRs, in order of best observed CLs
-            sortedSRs = sorted(excludedSRs_CLsObs, key=excludedSRs_CLsObs.get)
-            excludingSRlist = []
-            for SRname in sortedSRs:
-
-                if excludedSRs_CLsObs[SRname] >= 0.05:
-                    break
-                excludingSRlist.append(SRname)
+            sortedSRs = excludingIDs[SortCLs(CLresults[excludingIDs])]
+            excludingSRlist = [catalogue.hepdatanames[iSR] for iSR in sortedSRs]
 
             excludingSRstring = ';'.join(excludingSRlist)
 
@@ -573,121 +520,91 @@ class Combiner:
                     print '====================== Multiple best SRs do not all exclude?? Model',modelName
                     from pprint import pprint
                     print CLresult
-                    print bestSR
-                    pprint(CLresults)
-                    pprint(CLresultsExp)
+                    print bestSRname
+                    pprint(dict(zip([catalogue.names[iSR] for iSR in activeIDs],CLsList(CLresults[activeIDs]))))
+                    if self.useexpected:
+                        pprint(dict(zip([catalogue.names[iSR] for iSR in activeIDs],CLsList(CLresultsExp[activeIDs]))))
                     pprint(bestSRlist)
                     pprint(excludingSRlist)
                     # if modelName != 245974 and modelName != 43893: raise
 
             hepdatafile.write('%i,%s,%s\n'%(modelName,bestSRstring,excludingSRstring))
 
-                        
-#             # Construct a string listing the excluding SRs, ordered by CLsExp
-#             # Sort in _exactly_ the same way as in self.__AnalyseModel.
-#             if self.useexpected:
-#                 hepdatastring = ';'.join(sorted(excludedSRs_CLsExp, key=excludedSRs_CLsExp.get))
-#             else:
-#                 hepdatastring = ';'.join(sorted(excludedSRs_CLsObs, key=excludedSRs_CLsObs.get))
-#             hepdatafile.write('%i,%s\n'%(modelName,hepdatastring))
-#             try:
-#                 bestSR_HepData = hepdatastring.split(';')[0]
-#                 if bestSR and CLresult.value < 0.05:
-#                     # FIXME: If both CLsExp results are equal to 1e-6, then the order is arbitrary
-#                     if CLresultsExp[bestSR].value > 1e-6 or excludedSRs_CLsExp[bestSR_HepData].value > 1e-6:
-#                         # Check that the two SRs have the same name
-#                         assert(bestSR_HepData == self.__HepDataSRname(bestSR))
-#                 elif hepdatastring:
-#                     # In principle an error
-#                     assert(excludedSRs_CLsObs[bestSR_HepData].value < 0.05) # FIXME: Report exclusion where we use none in the paper
-#             except AssertionError:
-#                 from pprint import pprint
-#                 print '================= ERROR on event',ientry,', model',modelName
-#                 print CLresult
-#                 print bestSR
-#                 pprint(CLresults)
-#                 pprint(CLresultsExp)
-#                 print hepdatastring
-#                 raise
-
             ObsCLsPlots.fill(CLresult)
-            if bestSR:
-                try:
-                    ObsCLsSRPlots[bestSR].fill(CLresult)
-                except KeyError:
-                    ObsCLsSRPlots[bestSR] = CLsPlots('Observed', 'CLsObs', bestSR)
-                    ObsCLsSRPlots[bestSR].fill(CLresult)
+            if bestSR is not None:
+                if ObsCLsSRPlots[bestSR] is None:
+                    ObsCLsSRPlots[bestSR] = CLsPlots('Observed', 'CLsObs', bestSRname)
+                ObsCLsSRPlots[bestSR].fill(CLresult)
 
-            NSRplot.Fill(len(CLresults))
+            NSRplot.Fill(len(activeIDs))
             if CLresult.value < 1.: # This would be zero by default
-                NSRplots[int(CLresult.value/0.05)].Fill(len(CLresults))
+                NSRplots[int(CLresult.value/0.05)].Fill(len(activeIDs))
 
-            if self.useexpected and bestSR:
+            if self.useexpected and bestSR is not None:
 
-                CLsExp = CLresultsExp[bestSR]
+                CLsExp = CLsList(CLresultsExp[[bestSR]])[0]
                 ExpCLsPlots.fill(CLsExp)
 
-                if bestSR:
-                    try:
-                        ExpCLsSRPlots[bestSR].fill(CLsExp)
-                    except KeyError:
-                        ExpCLsSRPlots[bestSR] = CLsPlots('Expected', 'CLsExp', bestSR)
-                        ExpCLsSRPlots[bestSR].fill(CLsExp)
-
-            bestSRkey = bestSR if bestSR else ''
+                if ExpCLsSRPlots[bestSR] is None:
+                    ExpCLsSRPlots[bestSR] = CLsPlots('Expected', 'CLsExp', bestSRname)
+                ExpCLsSRPlots[bestSR].fill(CLsExp)
 
-            if bestSRkey:
+            if bestSR is not None:
                 SRcount['total'] += 1
                 if '+' in '%6e'%(CLresult.value):
                     SRcount['rounded'] += 1
+                bestSRcounts[bestSR] += 1
             else:
                 SRcount['CLs1'] += 1
-
-            try:
-                SRcount[bestSRkey] += 1
-            except KeyError:
-                SRcount[bestSRkey] = 1
+                SRcount[''] = SRcount.get('', 0) + 1
 
             # Test if model is excluded, record this for posterity if it is
             if CLresult.value < 0.05:
                 ExclusionCount['total'] += 1
                 BestExclusionCount['total'] += 1
-                try:
-                    BestExclusionCount[bestSRkey] += 1
-                except KeyError:
-                    BestExclusionCount[bestSRkey] = 1
-                addPerSRresult(bestSR, str(int(modelName)))
+                bestExclusionCounts[bestSR] += 1
+                addPerSRresult(bestSRname, str(int(modelName)))
             # Also record all CLs values, regardless of other considerations
-            for k,v in CLresults.items():
-                if self.useexpected:
-                    addPerSRCLsresult(k, int(modelName), v.value, CLresultsExp[k].value)
-                else:
-                    addPerSRCLsresult(k, int(modelName), v.value, '---')
-
-            exclusionSRs = []
-            for k,v in CLresults.items():
-                if v.value < 0.05:
-                    exclusionSRs.append(k)
-                    try:
-                        ExclusionCount[k] += 1
-                    except KeyError:
-                        ExclusionCount[k] = 1
-            if exclusionSRs:
+            # (only written with an event list, see addPerSRCLsresult)
+            if eventlist:
+                for iSR in activeIDs:
+                    if self.useexpected:
+                        addPerSRCLsresult(catalogue.names[iSR], int(modelName), float(CLresults['value'][iSR]), float(CLresultsExp['value'][iSR]))
+                    else:
+                        addPerSRCLsresult(catalogue.names[iSR], int(modelName), float(CLresults['value'][iSR]), '---')
+
+            if len(excludingIDs):
+                exclusionCounts[excludingIDs] += 1
                 ExclusionCount['total_any'] += 1
 
-                for exclSR in exclusionSRs:
-                    # Denominator: fill the entire column:
-                    for ibiny in range(1,SRcorr_denominator.GetNbinsY()+1):
-                        SRcorr_denominator.Fill(exclSR, ibiny, 1)
-                    # Numerator: Loop over other SRs
-                    for exclSR2 in exclusionSRs:
-                        # Order does not matter, as every combo comes up eventually
-                        SRcorr_numerator.Fill(exclSR, exclSR2, 1)
+                # Denominator: the entire column of each excluding SR
+                corrDenominator[excludingIDs] += 1
+                # Numerator: every pair of excluding SRs
+                corrNumerator[numpy.ix_(excludingIDs,excludingIDs)] += 1
                 
         stafile.close()
         badmodelfile.close()
         hepdatafile.close()
-        yieldfile.Close()
+        if yieldfile:
+            yieldfile.Close()
+
+        # Add the per-SR counts to the dictionaries, keyed by SR name as before
+        for counts,countdict in [(bestSRcounts,SRcount), (exclusionCounts,ExclusionCount), (bestExclusionCounts,BestExclusionCount)]:
+            for iSR in numpy.flatnonzero(counts):
+                countdict[catalogue.names[iSR]] = int(counts[iSR])
+
+        # Fill the correlation plots with the counts, giving the same bin contents and errors
+        # as filling them once per model (with the histogram bins catalogue.bins)
+        for iSR,ibinx in enumerate(catalogue.bins):
+            for jSR,ibiny in enumerate(catalogue.bins):
+                SRcorr_numerator.SetBinContent(ibinx, ibiny, corrNumerator[iSR,jSR])
+                SRcorr_numerator.SetBinError(ibinx, ibiny, math.sqrt(corrNumerator[iSR,jSR]))
+            # The denominator column was filled at y = 1..NSRs, ie in the bins 2..NSRs+1
+            for ibiny in range(2,NSRs+2):
+                SRcorr_denominator.SetBinContent(ibinx, ibiny, corrDenominator[iSR])
+                SRcorr_denominator.SetBinError(ibinx, ibiny, math.sqrt(corrDenominator[iSR]))
+        SRcorr_numerator.SetEntries(corrNumerator.sum())
+        SRcorr_denominator.SetEntries(NSRs*corrDenominator.sum())
 
         SRcorr_exclusion = SRcorr_numerator.Clone('SRcorr_exclusion')
         SRcorr_exclusion.Divide(SRcorr_numerator, SRcorr_denominator, 1, 1, 'B')
@@ -697,11 +614,13 @@ class Combiner:
         ObsCLsPlots.write()
         if self.useexpected:
             ExpCLsPlots.write()
-        for p in ObsCLsSRPlots.values():
-            p.write()
-        if self.useexpected:
-            for p in ExpCLsSRPlots.values():
+        for p in ObsCLsSRPlots:
+            if p is not None:
                 p.write()
+        if self.useexpected:
+            for p in ExpCLsSRPlots:
+                if p is not None:
+                    p.write()
         NSRplot.Write()
         for p in NSRplots:
             p.Write()
@@ -737,13 +656,26 @@ class Combiner:
         """Makes some pdf plots.
         Separated from the event loop, as that's so slow."""
 
+        from ParallelRender import RenderPages,Fingerprint
+
         canvas = ROOT.TCanvas('can','can',800,600)
+
+        # Read all the histograms now, as the plots may be drawn in other processes
+        # (which should not share the file)
         infile = ROOT.TFile.Open('/'.join([dirname,'CLresults.root']))
+        plots = {}
+        keynames = []
+        for key in infile.GetListOfKeys():
+            keyname = key.GetName()
+            plots[keyname] = infile.Get(keyname)
+            plots[keyname].SetDirectory(0)
+            keynames.append(keyname)
+        infile.Close()
 
-        def CLsPlot_withInvalid(basename, logY=False, pdfname=None):
+        def CLsPlot_withInvalid(canvas, printpage, basename, logY=False):
 
-            CLsPlot = infile.Get(basename)
-            CLsPlot_valid = infile.Get(basename+'_valid')
+            CLsPlot = plots[basename]
+            CLsPlot_valid = plots[basename+'_valid']
         
             CLsPlot_valid.SetFillColor(ROOT.kBlue)
             CLsPlot_valid.SetLineWidth(0)
@@ -759,16 +691,13 @@ class Combiner:
                 ROOT.myText(0.2, 0.95, ROOT.kBlack, basename)
 
             canvas.SetLogy(logY)
-            if pdfname is None:
-                canvas.Print('/'.join([dirname,basename+'Plot.pdf']))
-            else:
-                canvas.Print('/'.join([dirname,pdfname+'Plot.pdf']))
+            printpage()
             canvas.SetLogy(0) # Always revert to a linear scale
 
-        def CLsPlot_withExpected(basename, logY=False, pdfname=None):
+        def CLsPlot_withExpected(canvas, printpage, basename, logY=False):
 
-            CLsPlot = infile.Get(basename)
-            CLsExpPlot = infile.Get(basename.replace('Obs','Exp'))
+            CLsPlot = plots[basename]
+            CLsExpPlot = plots[basename.replace('Obs','Exp')]
         
             CLsExpPlot.SetLineColor(ROOT.kBlue)
             CLsExpPlot.Draw()
@@ -783,57 +712,57 @@ class Combiner:
                 ROOT.myText(0.2, 0.95, ROOT.kBlack, basename)
 
             canvas.SetLogy(logY)
-            if pdfname is None:
-                canvas.Print('/'.join([dirname,basename+'ExpPlot.pdf']))
-            else:
-                canvas.Print('/'.join([dirname,pdfname+'ExpPlot.pdf']))
+            printpage()
             canvas.SetLogy(0) # Always revert to a linear scale
 
-        CLsPlot_withInvalid('CLsObs')
-        CLsPlot_withInvalid('LogCLsObs', True)
-        if self.useexpected:
-            CLsPlot_withExpected('CLsObs')
-            CLsPlot_withExpected('LogCLsObs', True)
+        # The pdf pages to make, as (file name, drawing function)
+        jobs = []
+
+        def AddCLsPlots(basename, logY=False, pdfname=None):
+            """Adds the pages for CLsPlot_withInvalid and (if needed) CLsPlot_withExpected,
+            by default in their own files."""
+
+            if pdfname is None:
+                pdfname = basename
+            # The fingerprints cover everything drawn, so unchanged pages are not redrawn
+            jobs.append( ('/'.join([dirname,pdfname+'Plot.pdf']),
+                          lambda canvas,printpage: CLsPlot_withInvalid(canvas, printpage, basename, logY),
+                          Fingerprint('withInvalid', basename, logY, plots[basename], plots[basename+'_valid'])) )
+            if self.useexpected:
+                jobs.append( ('/'.join([dirname,pdfname+'ExpPlot.pdf']),
+                              lambda canvas,printpage: CLsPlot_withExpected(canvas, printpage, basename, logY),
+                              Fingerprint('withExpected', basename, logY, plots[basename], plots[basename.replace('Obs','Exp')])) )
+
+        AddCLsPlots('CLsObs')
+        AddCLsPlots('LogCLsObs', True)
 
         # Try some per-SR plots
         pdfname = 'PerSRCLs'
         pdfnameLog = 'PerSRLogCLs'
-        canvas.Print('/'.join([dirname,pdfname+'Plot.pdf[']))
-        canvas.Print('/'.join([dirname,pdfnameLog+'Plot.pdf[']))
-        if self.useexpected:
-            canvas.Print('/'.join([dirname,pdfname+'ExpPlot.pdf[']))
-            canvas.Print('/'.join([dirname,pdfnameLog+'ExpPlot.pdf[']))
-        for key in sorted(infile.GetListOfKeys()):
-            keyname = key.GetName()
+        for keyname in sorted(keynames):
             if keyname.endswith('_valid'): continue
             if keyname.startswith('CLsObs'):
-                CLsPlot_withInvalid(keyname, pdfname=pdfname)
-                if self.useexpected:
-                    CLsPlot_withExpected(keyname, pdfname=pdfname)
+                AddCLsPlots(keyname, pdfname=pdfname)
             elif keyname.startswith('LogCLsObs'):
-                CLsPlot_withInvalid(keyname, True, pdfname=pdfnameLog)
-                if self.useexpected:
-                    CLsPlot_withExpected(keyname, True, pdfname=pdfnameLog)
-        canvas.Print('/'.join([dirname,pdfname+'Plot.pdf]']))
-        canvas.Print('/'.join([dirname,pdfnameLog+'Plot.pdf]']))
-        if self.useexpected:
-            canvas.Print('/'.join([dirname,pdfname+'ExpPlot.pdf]']))
-            canvas.Print('/'.join([dirname,pdfnameLog+'ExpPlot.pdf]']))
-
-        NSRname = '/'.join([dirname,'NSRplot.pdf'])
-        NSRplot = infile.Get('NSRplot')
-        NSRplot.Draw()
-        canvas.Print(NSRname+'(')
-        for ibin in range(20):
-            NSRplot = infile.Get('NSRplot_%i'%(ibin))
-            NSRplot.Draw()
-            ROOT.myText(0.2,0.95,ROOT.kBlack,'Bin %i: %i%% < CLs < %i%%'%(ibin,5*ibin,5*(ibin+1)))
-            canvas.Print(NSRname)
-        canvas.Print(NSRname+']')
+                AddCLsPlots(keyname, True, pdfname=pdfnameLog)
+
+        def NSRPlots(canvas, printpage):
+
+            plots['NSRplot'].Draw()
+            printpage()
+            for ibin in range(20):
+                plots['NSRplot_%i'%(ibin)].Draw()
+                ROOT.myText(0.2,0.95,ROOT.kBlack,'Bin %i: %i%% < CLs < %i%%'%(ibin,5*ibin,5*(ibin+1)))
+                printpage()
+
+        jobs.append( ('/'.join([dirname,'NSRplot.pdf']), NSRPlots,
+                      Fingerprint('NSR', plots['NSRplot'], *[plots['NSRplot_%i'%(ibin)] for ibin in range(20)])) )
+
+        RenderPages(jobs, canvas, self.nproc)
 
         # Add some useful printout too
-        CLsObsPlot = infile.Get('CLsObs')
-        CLsObsPlot_valid = infile.Get('CLsObs_valid')
+        CLsObsPlot = plots['CLsObs']
+        CLsObsPlot_valid = plots['CLsObs_valid']
         Ninvalid = CLsObsPlot.Integral() - CLsObsPlot_valid.Integral()
         print 'Number of invalid models :',Ninvalid
         Nexcluded = CLsObsPlot.Integral(0,CLsObsPlot.GetXaxis().FindBin(0.049))
@@ -842,6 +771,8 @@ class Combiner:
     def LatexSummary(self, dirname):
         """Makes some LaTeX tables to put directly into the support note (maybe also the paper)."""
 
+        from SRCatalogue import LatexSRname
+
         # First grab the SR count information
         SRcountFile = open('/'.join([dirname,'SRcount.pickle']))
         SRcount = pickle.load(SRcountFile)
@@ -885,24 +816,18 @@ class Combiner:
         # Start with the 2L SRWW results
         mySRs = [SR for SR in SRcount.keys() if 'SR_WW' in SR]
         for SR in sorted(mySRs):
-            # It's either SR_WWa, b, or c
-            whichone = SR.split('_')[2][-1]
-            writeLine('2$\\ell$ SR-\\Wboson{}\\Wboson{}'+whichone, SR)
+            writeLine(LatexSRname(SR), SR)
 
         # Now on to the 2L Zjets SR
         mySRs = [SR for SR in SRcount.keys() if 'Zjets' in SR]
         for SR in sorted(mySRs):
             # There should be only one...
-            writeLine('2$\\ell$ SR-\\Zboson{}jets', SR)
+            writeLine(LatexSRname(SR), SR)
 
         # Next, the 2L mT2 SRs
         mySRs = [SR for SR in SRcount.keys() if 'SR_mT2' in SR]
         for SR in sorted(mySRs):
-            # It's either SR_mT2a, b, or c
-            whichone = SR.split('_')[2][-1]
-            # But we don't call them a,b,c in the note...
-            whichone = {'a':90, 'b':120, 'c':150}[whichone]
-            writeLine('2$\\ell$ SR-$\\mttwo^{%i}$'%(whichone), SR)
+            writeLine(LatexSRname(SR), SR)
 
         # Have a break
         latexfile.write('\\midrule\n')
@@ -917,17 +842,17 @@ class Combiner:
                 print theSRs
             if theSRs:
                 SR = theSRs[0]
-                writeLine('3$\\ell$ SR0$\\tau$a bin %i'%(ibin), SR)
+                writeLine(LatexSRname(SR), SR)
 
         # Now the other 3L regions, if we have them
         mySRs = [SR for SR in SRcount.keys() if 'SR0b' in SR]
         for SR in sorted(mySRs):
             # There should be only one...
-            writeLine('3$\\ell$ SR0$\\tau$b', SR)
+            writeLine(LatexSRname(SR), SR)
         mySRs = [SR for SR in SRcount.keys() if 'SR1SS' in SR]
         for SR in sorted(mySRs):
             # There should be only one...
-            writeLine('3$\\ell$ SR1$\\tau$', SR)
+            writeLine(LatexSRname(SR), SR)
 
         # Have a break
         latexfile.write('\\midrule\n')
@@ -935,8 +860,7 @@ class Combiner:
         # Now the 4L regions
         mySRs = [SR for SR in SRcount.keys() if 'FourLepton' in SR]
         for SR in sorted(mySRs):
-            whichone = SR.split('_')[1]
-            writeLine('4$\\ell$ '+whichone, SR)
+            writeLine(LatexSRname(SR), SR)
 
 
         # Now the 2tau regions
@@ -946,16 +870,7 @@ class Combiner:
             latexfile.write('\\midrule\n')
 
         for SR in sorted(mySRs):
-            # Let's just hard-code this
-            if 'C1C1' in SR:
-                latexSR = 'SR-C1C1'
-            elif 'C1N2' in SR:
-                latexSR = 'SR-C1N2'
-            elif 'highMT2' in SR:
-                latexSR = 'SR-DS-highMass'
-            elif 'lowMT2' in SR:
-                latexSR = 'SR-DS-lowMass'
-            writeLine('2$\\tau$ '+latexSR, SR)
+            writeLine(LatexSRname(SR), SR)
 
         latexfile.write('\\midrule\n')
         writeLine('All SRs', 'total')
@@ -969,6 +884,7 @@ if __name__ == '__main__':
 
     # Add some command line options
     import argparse
+    from SkimYieldFile import PROFILES,SkimmedFile
     parser = argparse.ArgumentParser(
         description="""
            Reads truth yields and uses the CLs calibration functions to produce the ATLAS likelihood.""",
@@ -1014,6 +930,18 @@ if __name__ == '__main__':
         action = "store_true",
         dest = "subset",
         help = "Perform the analysis using D3PDs_testsubset.txt")
+    parser.add_argument(
+        "--nproc",
+        dest = "nproc",
+        type = int,
+        default = 1,
+        help = "Number of processes to use for rendering the plots")
+    parser.add_argument(
+        "--profile",
+        dest = "profile",
+        default = "full",
+        choices = sorted(PROFILES.keys()),
+        help = "Branch profile of the skimmed ntuples to read (see SkimYieldFile.py), calibration or full")
     cmdlinearguments = parser.parse_args()
 
     import ROOT
@@ -1056,12 +984,13 @@ if __name__ == '__main__':
         EL = ELfile.Get('elist_TestSample')
         EL.SetDirectory(0)
         ELfile.Close()
-        infile = 'Data_Yields/SummaryNtuple_STA_sim.root'
+        infile = SkimmedFile('sim', cmdlinearguments.profile)
     else:
         EL = None
-        infile = 'Data_Yields/SummaryNtuple_STA_evgen.root'
+        infile = SkimmedFile('evgen', cmdlinearguments.profile)
 
     obj = Combiner(infile, '/'.join([CLsdir,'calibration.root']))
+    obj.nproc = cmdlinearguments.nproc
     if cmdlinearguments.all:
         obj.strategy = cmdlinearguments.strategy
         obj.truncate = cmdlinearguments.truncate
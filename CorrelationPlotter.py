@@ -1,5 +1,115 @@
 #!/usr/bin/env python
 
+# ########################################################
+# Fast fitting of the calibration normalisation
+# ########################################################
+
+class FitResultSummary:
+    """Stand-in for a TFitResultPtr, for fits that do not go through Minuit.
+    Only the methods used by CorrelationPlotter (and SignalRegion.GoodFit) are provided.
+    """
+
+    def __init__(self, values, errors, chi2, ndf, status=0):
+
+        self.__values = list(values)
+        self.__errors = list(errors)
+        self.__chi2 = chi2
+        self.__ndf = ndf
+        self.__status = status
+
+    def __nonzero__(self):
+        return True
+
+    def Get(self):
+        # A TFitResultPtr returns a null pointer for failed fits, this never fails
+        return self
+
+    def Status(self):
+        return self.__status
+
+    def NPar(self):
+        return len(self.__values)
+
+    def Value(self, ipar):
+        return self.__values[ipar]
+
+    def Error(self, ipar):
+        return self.__errors[ipar]
+
+    def Chi2(self):
+        return self.__chi2
+
+    def Ndf(self):
+        return self.__ndf
+
+    def Prob(self):
+        return ROOT.TMath.Prob(self.__chi2, self.__ndf)
+
+def AnalyticNormalisationFit(x, y, ey, curve, xmin, xmax):
+    """Least-squares fit of y = curve(x)/p, using numpy arrays of the data points (x,y,ey)
+    and of the HistFitter curve evaluated at each x.
+    As the model is linear in a = 1/p, the chi^2 minimum and its (parabolic) error are
+    a = sum(w*g*y)/sum(w*g^2) and 1/sqrt(sum(w*g^2)), with w = 1/ey^2 and g = curve(x).
+    Only points with xmin <= x <= xmax and a nonzero yield error are used.
+    Returns a FitResultSummary for p, or None if there are no usable points.
+    """
+
+    import numpy
+
+    selection = (x >= xmin) & (x <= xmax) & (ey > 0)
+    x = x[selection]
+    y = y[selection]
+    g = curve[selection]
+    weight = 1./(ey[selection]*ey[selection])
+
+    sumgg = numpy.sum(weight*g*g)
+    if not len(x) or not sumgg:
+        return None
+
+    a = numpy.sum(weight*g*y)/sumgg
+    aerror = 1./numpy.sqrt(sumgg)
+
+    residual = y - a*g
+    chi2 = float(numpy.sum(weight*residual*residual))
+    ndf = len(x) - 1
+
+    if a <= 0:
+        # Unphysical normalisation, flag it like a failed Minuit fit
+        return FitResultSummary([0.], [0.], chi2, ndf, status=1)
+
+    # Convert to the normalisation parameter p = 1/a
+    return FitResultSummary([float(1./a)], [float(aerror/(a*a))], chi2, ndf)
+
+def _FitResultTuple(fitresult):
+    """The numbers in a fit result (TFitResultPtr or FitResultSummary) as plain python objects,
+    such that FitResultSummary(*tuple) recreates it. Returns None for a missing fit result.
+    """
+
+    if fitresult is None:
+        return None
+
+    return ([fitresult.Value(i) for i in range(fitresult.NPar())],
+            [fitresult.Error(i) for i in range(fitresult.NPar())],
+            fitresult.Chi2(),
+            fitresult.Ndf(),
+            fitresult.Status())
+
+# ########################################################
+# Process-parallel fitting
+# ########################################################
+
+# The CorrelationPlotter being fitted, set just before the worker processes are forked,
+# so that they inherit it (graphs, fit functions and all) rather than having it pickled
+_parallelplotter = None
+
+def _FitTaskInWorker(task):
+    """Entry point for the worker processes in CorrelationPlotter.__FitInParallel."""
+    return _parallelplotter._FitTaskInWorker(task)
+
+def _CrossValidateInWorker(task):
+    """Entry point for the worker processes in CorrelationPlotter.CrossValidate."""
+    return _parallelplotter._CrossValidateTask(task)
+
 # ########################################################
 # Main helper class for calibration
 # ########################################################
@@ -12,6 +122,12 @@ class CorrelationPlotter:
     More or less everything else (eg where output plots are written) is configurable.
     """
 
+    # Bump this if the format of the saved state (see self.__WriteState) changes
+    stateversion = 1
+
+    # Percentiles of the bootstrapped normalisations saved in calibration.root (see Bootstrap)
+    bootstrappercentiles = [2.5, 16., 50., 84., 97.5]
+
     def __init__(self, data):
         """Initialise the object, storing a reference to the data.
         data should be a list of SignalRegion objects, with names corresponding to "analysis_SR".
@@ -25,57 +141,100 @@ class CorrelationPlotter:
         self.__correlations = None
 
         # Fit result cache, for monitoring
-        self.__fitresults = None # Dict of name:TFitResultPtr
+        self.__fitresults = None # Dict of name:TFitResultPtr (or FitResultSummary)
+
+        # How to fit the calibration normalisation:
+        # 'minuit' uses TGraph::Fit, while 'analytic' uses the closed-form solution
+        # (only possible for HistFitter calibration functions, others always use Minuit)
+        self.fitmode = 'minuit'
+        # If true, analytic fits are cross-checked against Minuit
+        self.crosscheck = False
+
+        # Number of processes used to fit the graphs (1 means no parallelisation)
+        self.nproc = 1
+
+        # If true, CheckData lists the affected models, rather than just counting them
+        self.verbosecheck = False
+
+        # For incremental updates (see UpdateCorrelations):
+        # the saved state of the previous calibration, and the graphs that no longer exist
+        self.__previousstate = None
+        self.__removedkeys = []
+
+        # For cross-validation (see CrossValidate): the fold of each model, and the number of folds
+        self.__folds = None
+        self.__nfolds = 0
+
+        # Bootstrapped percentiles of the normalisation for each graph (see Bootstrap)
+        self.__bootstrap = {}
 
         # For plotting
         self.__canvas = None
 
     def CheckData(self):
         """Check data integrity, eg whether all analysis+SR combinations
-        have the same list of models."""
+        have the same list of models.
+        Only a summary is printed, unless self.verbosecheck is true."""
 
-        # Element to store the complete list of all models
-        modelset = set()
+        from DataObject import PresenceMatrix
 
-        # Loop over the analysis/SR list
-        # First pupose: populate the complete model set
-        # Second purpose: look for incomplete data ie missing yield and/or CLs values
+        # One bit per model, SR and field, for all SRs at once
+        presence = PresenceMatrix(self.__data)
 
-        for dataobj in self.__data:
+        # First purpose: look for incomplete data ie missing yield and/or CL values
+        presence.PrintSummary(self.verbosecheck)
 
-            dataobj.CheckData() # Checks and removes the duds
+        # Remove the duds
+        duds = presence.Duds()
+        for idata,dataobj in enumerate(self.__data):
+            dataobj.RemoveModels(presence.RegionMask(duds, idata))
 
-            # Collect the model list after cleaning
-            modelset |= set(dataobj.data.keys())
+        # Second purpose: check if any analyses have missing models after cleaning
+        # Just for information, no action is taken
+        missing = presence.Missing(duds)
+        nmodels = (presence.Has('exists') & ~duds).any(axis=1).sum()
 
         print
-        print 'Found %i models and %i SRs'%(len(modelset),len(self.__data))
+        print 'Found %i models and %i SRs'%(nmodels,len(self.__data))
         print 'SR list:\t','\n\t\t'.join([x.name for x in self.__data])
         print
 
-        # Second loop, to check if any analyses have missing models
-        # Just for information, no action is taken
-        
-        for dataobj in self.__data:
-
-            if modelset != set(dataobj.data.keys()):
-                print 'WARNING in CorrelationPlotter: missing %i/%i models for %s'%(len(modelset) - len(dataobj.data.keys()),len(modelset),dataobj.name)
-                print '\t','\n\t'.join(map(str, sorted(modelset - set(dataobj.data.keys())))),'\n'
+        nmissing = missing.sum(axis=0)
+        for idata,dataobj in enumerate(self.__data):
+            if not nmissing[idata]:
+                continue
+            print 'WARNING in CorrelationPlotter: missing %i/%i models for %s'%(nmissing[idata],nmodels,dataobj.name)
+            if self.verbosecheck:
+                print '\t','\n\t'.join(map(str, presence.model_ids[missing[:,idata]].tolist())),'\n'
 
-    def MakeCorrelations(self):
+    def MakeCorrelations(self, only=None):
         """Makes a TGraph object for each SR where we have both a truth-level yield and a CLs value.
+        If only is given (a set of SR names), the other SRs are skipped.
         """
-        
+
+        import numpy
+        from GraphTools import GraphViews,MakeGraph
+
         # First check and clean the data
         self.CheckData()
 
         # Clear the correlation data
         self.__correlations = {}
         self.__fitresults = {}
+        self.__previousstate = None
+        self.__removedkeys = []
+        self.__bootstrap = {}
+
+        # The graphs to be fitted, once they have all been filled
+        # Each task is (index in self.__data, CL type, graph key)
+        tasks = []
 
         # Loop over each SR
         # Recall that dataobj is a SignalRegion object
-        for dataobj in self.__data:
+        for idata,dataobj in enumerate(self.__data):
+
+            if only is not None and dataobj.name not in only:
+                continue
 
             # Loop over the different CL values (one plot per CL type)
             for CLtype in dataobj.InfoList():
@@ -83,15 +242,29 @@ class CorrelationPlotter:
                 # Work out what to call this graph
                 graphkey = '_'.join( [dataobj.name, CLtype] )
 
+                # Collect the models where we have the necessary x- and y-axis values
+                x,y,ey = self.__CollectPoints(dataobj, CLtype)[1:]
+
                 # See if it already exists
                 try:
-                    graph = self.__correlations[graphkey]
+                    oldgraph = self.__correlations[graphkey]
                 except KeyError:
-                    # Graph does not exist, we need to make it
-                    graph = ROOT.TGraphErrors()
-                    graph.SetName('Corr_%s'%(graphkey))
-                    graph.SetTitle(dataobj.name.replace('_',' ')) # Helps when plotting
-                    
+                    oldgraph = None
+                else:
+                    # Shouldn't happen, but keep the points that are already there
+                    oldx,oldy,oldex,oldey = GraphViews(oldgraph)
+                    x = numpy.concatenate([oldx, x])
+                    y = numpy.concatenate([oldy, y])
+                    ey = numpy.concatenate([oldey, ey])
+
+                # Make the graph with all the points in one go
+                graph = MakeGraph(x, y, None, ey)
+                graph.SetName('Corr_%s'%(graphkey))
+                graph.SetTitle(dataobj.name.replace('_',' ')) # Helps when plotting
+
+                if oldgraph is not None:
+                    graph.xtitle = oldgraph.xtitle
+                else:
                     # Little hack to set the x-axis title correctly
                     # Using graph.GetXaxis().SetTitle(...) now is pointless,
                     # because the underlying histogram axes have not yet been made.
@@ -102,28 +275,10 @@ class CorrelationPlotter:
                         print 'WARNING in CorrelationPlotter: No CLname info provided for %s in %s'%(CLtype,dataobj.name)
                         graph.xtitle = 'CL'
 
-                    # Store the graph for future use
-                    self.__correlations[graphkey] = graph
-
-                # Loop over each model to extract yield and CL values
-                for model,info in dataobj.data.iteritems():
-
-                    # Check if we have the necessary x- and y-axis values
-                    if info[CLtype] is not None and info['yield']:
-
-                        # Add a new point to the TGraph
-                        pointNumber = graph.GetN()
-                        graph.SetPoint(pointNumber, info[CLtype], info['yield'])
-
-                        # Check to see if we have an error on the yield
-                        try:
-                            # The next line only works if info['yield'] is a valueWithError object
-                            graph.SetPointError(pointNumber, 0, info['yield'].error)
-                        except AttributeError:
-                            # Absolutely OK, we just don't have errors on the yield
-                            pass
+                # Store the graph for future use
+                self.__correlations[graphkey] = graph
 
-                # Finally, attempt to fit the graph for this SR + CL type combination
+                # Finally, queue the graph for this SR + CL type combination for fitting
                 # Only try this if it's non-empty
                 if graph.GetN():
 
@@ -131,23 +286,13 @@ class CorrelationPlotter:
                     if self.__fitresults.has_key(graphkey):
                         print 'WARNING: Graph %s has already been fitted'%(graphkey)
 
-                    # Overwrite previous fit result, if any
-                    # The fit function is defined by the SignalRegion object itself
-                    self.__fitresults[graphkey] = self.FitGraph(graph, dataobj.fitfunctions[CLtype])
-
-                    # The fit is good if
-                    # a) the fit result exists
-                    # b) the fit status is zero (nonzero implies an error)
-                    # c) the SignalRegion object's GoodFit function is satisfied
-                    graph.goodfit = self.__fitresults[graphkey] and (not self.__fitresults[graphkey].Status()) and dataobj.GoodFit(graph)
-
-                    # Compute and store the error on the fit
-                    graph.fiterrorgraph = dataobj.FitErrorGraph(graph)
+                    tasks.append( (idata,CLtype,graphkey) )
 
                 else:
                     # If the graph is empty, set flags to indicate a lack of fit
                     graph.goodfit = False
                     graph.fiterrorgraph = None
+                    graph.calibcurve = None
                     self.__fitresults[graphkey] = None
 
                 # End of loop over different CL types
@@ -156,36 +301,618 @@ class CorrelationPlotter:
             # End of loop over models
             pass
 
+        # Now do the fits, which are independent of each other
+        if self.nproc > 1 and len(tasks) > 1:
+            fits = self.__FitInParallel(tasks)
+        else:
+            fits = [self.__FitTask(task) for task in tasks]
+
+        for (idata,CLtype,graphkey),(fitresult,goodfit) in zip(tasks,fits):
+
+            dataobj = self.__data[idata]
+            graph = self.__correlations[graphkey]
+
+            # Overwrite previous fit result, if any
+            self.__fitresults[graphkey] = fitresult
+            graph.goodfit = goodfit
+
+            # Compute and store the error on the fit
+            graph.fiterrorgraph = dataobj.FitErrorGraph(graph)
+
+            # Keep the native calibration curve (if any), so it can be saved with the function
+            graph.calibcurve = getattr(dataobj.fitfunctions[CLtype], 'curve', None)
+
+    def __CollectPoints(self, dataobj, CLtype):
+        """Returns numpy arrays (modelIDs, x, y, ey) of the models in dataobj with both a yield
+        and a CLtype value, ie the points of the correlation graph.
+        """
+
+        CL = dataobj.Column(CLtype)
+        selection = dataobj.Mask(CLtype) & dataobj.Mask('yield') & (dataobj.Column('yield') != 0)
+
+        # The error is only available if the yield was given as a valueWithError object
+        # Absolutely OK if it wasn't, we just don't have errors on the yield (ie they are zero)
+        modelyield = dataobj.Yields()[selection]
+
+        return dataobj.model_ids[selection],CL[selection],modelyield.value,modelyield.error
+
+    def UpdateCorrelations(self, dirname):
+        """Like MakeCorrelations, but only refits the SRs whose inputs have changed
+        since the calibration in dirname was saved (see SaveData).
+        The fit results of the other SRs are carried over from the saved state, and SaveData
+        then only replaces the changed entries in results.root and calibration.root.
+        Falls back to MakeCorrelations if there is no usable previous calibration.
+        Inputs are compared using the SignalRegion's inputhash (see Reader_DMSTA), so SRs without one are always refitted.
+        """
+
+        import os
+
+        state = self.__ReadState(dirname)
+        if state is None or not all([os.path.exists('/'.join([dirname,fname])) for fname in ['results.root','calibration.root']]):
+            print 'INFO: No previous calibration found in %s, fitting all SRs'%(dirname)
+            self.MakeCorrelations()
+            return
+
+        # Work out which SRs need refitting
+        changed = set()
+        for dataobj in self.__data:
+            previous = state['SRs'].get(dataobj.name)
+            inputkey = self.__InputKey(dataobj)
+            if (previous is None or inputkey is None or previous['inputkey'] != inputkey or
+                [CLtype for CLtype in dataobj.InfoList() if '_'.join([dataobj.name,CLtype]) not in state['fits']]):
+                changed.add(dataobj.name)
+
+        print 'INFO: %i/%i SRs have changed since the calibration in %s'%(len(changed),len(self.__data),dirname)
+        if changed:
+            print '\t','\n\t'.join(sorted(changed))
+
+        self.MakeCorrelations(only=changed)
+
+        # Carry over the fit results of the unchanged SRs
+        for dataobj in self.__data:
+            if dataobj.name in changed:
+                continue
+            for CLtype in dataobj.InfoList():
+                graphkey = '_'.join( [dataobj.name, CLtype] )
+                fitresult = state['fits'][graphkey]['fitresult']
+                self.__fitresults[graphkey] = FitResultSummary(*fitresult) if fitresult is not None else None
+
+        self.__previousstate = state
+        self.__removedkeys = [fitkey for fitkey in state['fits'] if fitkey not in self.__fitresults]
+
+    def __InputKey(self, dataobj):
+        """Returns a hash of everything that determines the fits for this SR:
+        its inputs (dataobj.inputhash), the fit mode, and the fit ranges and scale factors.
+        Returns None if the SR does not record its inputs.
+        """
+
+        import hashlib
+
+        inputhash = getattr(dataobj, 'inputhash', None)
+        if inputhash is None:
+            return None
+
+        functions = []
+        for CLtype in dataobj.InfoList():
+            fitfunc = dataobj.fitfunctions[CLtype]
+            if fitfunc is None:
+                functions.append( (CLtype,None) )
+                continue
+            functions.append( (CLtype,
+                               getattr(fitfunc, 'xmin', fitfunc.GetXmin()),
+                               getattr(fitfunc, 'xmax', fitfunc.GetXmax()),
+                               getattr(getattr(fitfunc, 'SystematicFactor', None), '__name__', None)) )
+
+        return hashlib.sha1(repr((inputhash, self.fitmode, functions))).hexdigest()
+
+    def __StateFileName(self, dirname):
+        return '/'.join([dirname,'calibstate.pickle'])
+
+    def __ReadState(self, dirname):
+        """Returns the state saved with the calibration in dirname, or None if there is no (usable) state."""
+
+        import os,cPickle
+        statename = self.__StateFileName(dirname)
+        if not os.path.exists(statename):
+            return None
+
+        try:
+            statefile = open(statename, 'rb')
+            state = cPickle.load(statefile)
+            statefile.close()
+        except Exception as e:
+            print 'WARNING in CorrelationPlotter: could not read state file %s (%s)'%(statename,e)
+            return None
+
+        if state.get('version') != self.stateversion:
+            return None
+        return state
+
+    def __WriteState(self, dirname):
+        """Saves what is needed to update the calibration in dirname later (see UpdateCorrelations):
+        the inputs of each SR, and the fit result of each graph.
+        """
+
+        import os,cPickle
+
+        state = {'version': self.stateversion, 'SRs': {}, 'fits': {}}
+
+        for dataobj in self.__data:
+            state['SRs'][dataobj.name] = {'inputkey': self.__InputKey(dataobj),
+                                          'inputfiles': getattr(dataobj, 'inputfiles', None),
+                                          'curvehash': getattr(dataobj, 'curvehash', None)}
+
+        for graphkey,fitresult in self.__fitresults.items():
+            try:
+                goodfit = bool(self.__correlations[graphkey].goodfit)
+            except KeyError:
+                # Carried over from the previous calibration
+                goodfit = self.__previousstate['fits'][graphkey]['goodfit']
+            state['fits'][graphkey] = {'fitresult': _FitResultTuple(fitresult), 'goodfit': goodfit}
+
+        statename = self.__StateFileName(dirname)
+        try:
+            # As for the reader cache, do not leave a truncated file behind
+            statefile = open(statename+'.tmp', 'wb')
+            cPickle.dump(state, statefile, cPickle.HIGHEST_PROTOCOL)
+            statefile.close()
+            os.rename(statename+'.tmp', statename)
+        except (IOError,OSError) as e:
+            print 'WARNING in CorrelationPlotter: could not write state file %s (%s)'%(statename,e)
+
+    def __FitTask(self, task):
+        """Fits one of the graphs queued by MakeCorrelations.
+        Returns the fit result and whether the fit is good.
+        """
+
+        idata,CLtype,graphkey = task
+        dataobj = self.__data[idata]
+        graph = self.__correlations[graphkey]
+
+        # The fit function is defined by the SignalRegion object itself
+        fitresult = self.FitGraph(graph, dataobj.fitfunctions[CLtype])
+
+        # The fit is good if
+        # a) the fit result exists
+        # b) the fit status is zero (nonzero implies an error)
+        # c) the SignalRegion object's GoodFit function is satisfied
+        goodfit = fitresult and (not fitresult.Status()) and dataobj.GoodFit(graph)
+
+        return fitresult,goodfit
+
+    def _FitTaskInWorker(self, task):
+        """Fits one graph in a worker process (see __FitInParallel).
+        Neither the fit result nor the fitted function can be sent back to the parent,
+        so return the numbers needed to rebuild them as plain python objects.
+        """
+
+        fitresult,goodfit = self.__FitTask(task)
+
+        output = {'goodfit':bool(goodfit), 'fitresult':_FitResultTuple(fitresult), 'function':None}
+
+        # The function attached to the graph by FitGraph (which may include a systematic scale factor)
+        funclist = self.__correlations[task[2]].GetListOfFunctions()
+        if len(funclist):
+            func = funclist[0]
+            output['function'] = ([func.GetParameter(i) for i in range(func.GetNpar())],
+                                  [func.GetParError(i) for i in range(func.GetNpar())])
+
+        return output
+
+    def __FitInParallel(self, tasks):
+        """Fits the graphs queued by MakeCorrelations using a pool of self.nproc processes.
+        The workers are forked after the graphs are filled, so they already have all the data,
+        and only the task keys and fitted numbers need to be passed around.
+        Returns the same (fitresult, goodfit) list as the serial fits, with the fitted
+        functions reattached to the graphs in this process.
+        """
+
+        print 'INFO: Fitting %i graphs using %i processes'%(len(tasks),min(self.nproc,len(tasks)))
+        outputs = self.__MapInParallel(_FitTaskInWorker, tasks)
+
+        return [self.__ReattachFit(task, output) for task,output in zip(tasks,outputs)]
+
+    def __MapInParallel(self, function, tasks):
+        """Returns [function(task) for task in tasks], evaluated by a pool of self.nproc forked processes.
+        function should be one of the module-level entry points, which call back into this object.
+        """
+
+        import multiprocessing
+
+        global _parallelplotter
+        _parallelplotter = self
+
+        pool = multiprocessing.Pool(min(self.nproc,len(tasks)))
+        try:
+            return pool.map(function, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            _parallelplotter = None
+
+    def __ReattachFit(self, task, output):
+        """Recreates the outcome of FitGraph in this process, from the output of _FitTaskInWorker.
+        Returns (fitresult, goodfit), with the fit result as a FitResultSummary.
+        """
+
+        idata,CLtype,graphkey = task
+        fitfunc = self.__data[idata].fitfunctions[CLtype]
+        graph = self.__correlations[graphkey]
+
+        fitresult = None
+        if output['fitresult'] is not None:
+            values,errors,chi2,ndf,status = output['fitresult']
+            fitresult = FitResultSummary(values, errors, chi2, ndf, status)
+
+            # Leave the SR's fit function as the fit would have done
+            for iparam in range(len(values)):
+                fitfunc.SetParameter(iparam, values[iparam])
+                fitfunc.SetParError(iparam, errors[iparam])
+
+        if output['function'] is not None:
+            # Same reconstruction as in FitGraph
+            try:
+                newfunc = MakeCalibrationFunction(fitfunc.graph, 'fitfunc', -6, 0)
+            except AttributeError:
+                newfunc = fitfunc.Clone()
+
+            params,errors = output['function']
+            for iparam in range(len(params)):
+                newfunc.SetParameter(iparam, params[iparam])
+                newfunc.SetParError(iparam, errors[iparam])
+            graph.GetListOfFunctions().Clear()
+            graph.GetListOfFunctions().AddFirst(newfunc)
+
+        return fitresult,output['goodfit']
+
+    def Bootstrap(self, nreplicas, seed=1):
+        """Bootstrap estimate of the uncertainty on the fitted normalisations.
+        The models are resampled (with replacement) nreplicas times, using the same replicas for all SRs,
+        and the normalisation of each graph made by MakeCorrelations is refitted to every replica.
+        The refits use the closed-form least-squares solution (see AnalyticNormalisationFit),
+        evaluated for all replicas at once, so are only done for HistFitter calibration functions.
+        The percentiles (see self.bootstrappercentiles) of the replica normalisations are written
+        to calibration.root by SaveData, before any systematic scale factor is applied.
+        """
+
+        import numpy
+        from GraphTools import EvalGraph
+
+        if self.__correlations is None:
+            print 'ERROR: Cannot bootstrap the fits, as the graphs have not been created yet!'
+            return
+
+        models = sorted(set().union(*[dataobj.ModelIDs() for dataobj in self.__data]))
+        modelindex = dict([(modelID,imodel) for imodel,modelID in enumerate(models)])
+
+        # Number of times each model appears in each replica
+        counts = numpy.random.RandomState(seed).multinomial(len(models), [1./len(models)]*len(models), size=nreplicas)
+        counts = counts.astype(numpy.float64)
+
+        print 'INFO: Bootstrapping the normalisations with %i replicas of %i models'%(nreplicas,len(models))
+
+        self.__bootstrap = {}
+        for dataobj in self.__data:
+            for CLtype in dataobj.InfoList():
+
+                graphkey = '_'.join( [dataobj.name, CLtype] )
+                fitfunc = dataobj.fitfunctions[CLtype]
+                if graphkey not in self.__correlations or not hasattr(fitfunc, 'graph') or not fitfunc.curve.Divides():
+                    continue
+
+                modelIDs,x,y,ey = self.__CollectPoints(dataobj, CLtype)
+                xmin = getattr(fitfunc, 'xmin', fitfunc.GetXmin())
+                xmax = getattr(fitfunc, 'xmax', fitfunc.GetXmax())
+
+                # Same selection as in AnalyticNormalisationFit
+                selection = (x >= xmin) & (x <= xmax) & (ey > 0)
+                if not selection.any():
+                    continue
+
+                g = EvalGraph(fitfunc.graph, x[selection])
+                weight = 1./(ey[selection]*ey[selection])
+                columns = numpy.array([modelindex[modelID] for modelID in modelIDs[selection]])
+
+                # The sums in the closed-form solution, with each point weighted by how often it appears in the replica
+                sumgg = counts[:,columns].dot(weight*g*g)
+                sumgy = counts[:,columns].dot(weight*g*y[selection])
+
+                # Replicas without any selected points, or with a non-positive normalisation, cannot be used
+                # (as for AnalyticNormalisationFit, which gives status=1 in that case)
+                a = sumgy[sumgg > 0]/sumgg[sumgg > 0]
+                a = a[a > 0]
+                ndropped = nreplicas - len(a)
+                if ndropped:
+                    print 'WARNING: %s: dropped %i/%i bootstrap replicas with no points or a non-positive normalisation'%(graphkey,ndropped,nreplicas)
+                if not len(a):
+                    continue
+
+                self.__bootstrap[graphkey] = numpy.percentile(1./a, self.bootstrappercentiles)
+
+        print
+        print '======= Bootstrapped normalisations (median and 68% interval)'
+        for graphkey,percentiles in sorted(self.__bootstrap.items()):
+            print '%s: %.4f [%.4f, %.4f]'%(graphkey,percentiles[2],percentiles[1],percentiles[3])
+
+    def CrossValidate(self, nfolds, outdir, seed=1):
+        """k-fold cross-validation of the calibration fits.
+        The models are split randomly into nfolds folds (the same split for all SRs).
+        For each SR and CL type, the normalisation is fitted to all but one fold, and the fitted
+        function is used to predict the CL values of the models in the remaining fold from their yields.
+        The bias (mean) and spread (standard deviation) of predicted - true CL are printed,
+        and written to crossvalidation.txt in outdir.
+        The fits use the same method as FitGraph (see self.fitmode), and are spread over self.nproc processes.
+        Returns a dictionary of graph key:(bias, spread, number of predictions, normalisation per fold).
+        """
+
+        import numpy,os
+
+        if nfolds < 2:
+            print 'ERROR: Cannot cross-validate with %i folds'%(nfolds)
+            return None
+
+        # Assign the models to folds
+        models = sorted(set().union(*[dataobj.ModelIDs() for dataobj in self.__data]))
+        permutation = numpy.random.RandomState(seed).permutation(len(models))
+        self.__folds = dict([(models[imodel],ientry%nfolds) for ientry,imodel in enumerate(permutation)])
+        self.__nfolds = nfolds
+
+        print 'INFO: Cross-validating with %i folds of %i models'%(nfolds,len(models))
+
+        # One task per graph, which fits all of the folds
+        tasks = [(idata,CLtype) for idata,dataobj in enumerate(self.__data)
+                 for CLtype in dataobj.InfoList() if dataobj.fitfunctions[CLtype] is not None]
+
+        if self.nproc > 1 and len(tasks) > 1:
+            outputs = self.__MapInParallel(_CrossValidateInWorker, tasks)
+        else:
+            outputs = [self._CrossValidateTask(task) for task in tasks]
+
+        results = {}
+        for (idata,CLtype),(residuals,params) in zip(tasks,outputs):
+            graphkey = '_'.join( [self.__data[idata].name, CLtype] )
+            if len(residuals):
+                results[graphkey] = (residuals.mean(), residuals.std(), len(residuals), params)
+            else:
+                results[graphkey] = (None, None, 0, params)
+
+        # Summary printout, also written to a file
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+
+        keylength = max([len(x) for x in results.keys()] + [len('SR')])
+        lines = ['%*s  %10s  %10s  %6s  %s'%(keylength,'SR','bias','spread','Npred','normalisation per fold')]
+        for graphkey,(bias,spread,npred,params) in sorted(results.items()):
+            paramstring = ' '.join(['%.4f'%(p) if p is not None else '-' for p in params])
+            if npred:
+                lines.append('%*s  %10.4f  %10.4f  %6i  %s'%(keylength,graphkey,bias,spread,npred,paramstring))
+            else:
+                lines.append('%*s  %10s  %10s  %6i  %s'%(keylength,graphkey,'-','-',npred,paramstring))
+
+        print
+        print '======= %i-fold cross-validation (predicted - true CL)'%(nfolds)
+        print '\n'.join(lines)
+
+        outfile = open('/'.join([outdir,'crossvalidation.txt']), 'w')
+        outfile.write('\n'.join(lines)+'\n')
+        outfile.close()
+
+        return results
+
+    def _CrossValidateTask(self, task):
+        """Cross-validates the fit of one graph (see CrossValidate), possibly in a worker process.
+        Returns a numpy array of the held-out prediction errors (predicted - true CL)
+        and the fitted normalisation for each fold (None where the fit failed).
+        """
+
+        import numpy
+
+        idata,CLtype = task
+        dataobj = self.__data[idata]
+        fitfunc = dataobj.fitfunctions[CLtype]
+
+        modelIDs,x,y,ey = self.__CollectPoints(dataobj, CLtype)
+        folds = numpy.array([self.__folds[modelID] for modelID in modelIDs], dtype=int)
+
+        xmin = getattr(fitfunc, 'xmin', fitfunc.GetXmin())
+        xmax = getattr(fitfunc, 'xmax', fitfunc.GetXmax())
+
+        residuals = []
+        params = []
+        for ifold in range(self.__nfolds):
+
+            train = folds != ifold
+            # Only predict within the fit range, as the calibration is not used outside it
+            test = (folds == ifold) & (x >= xmin) & (x <= xmax)
+
+            func = self.__FitFold(fitfunc, x[train], y[train], ey[train], xmin, xmax)
+            if func is None:
+                params.append(None)
+                continue
+
+            params.append(func.GetParameter(0))
+            residuals.append(self.__PredictCL(func, y[test]) - x[test])
+
+        if residuals:
+            residuals = numpy.concatenate(residuals)
+        else:
+            residuals = numpy.zeros(0)
+        return residuals,params
+
+    def __FitFold(self, fitfunc, x, y, ey, xmin, xmax):
+        """Fits a copy of fitfunc to the points (x,y,ey), without touching any of the graphs.
+        Returns the fitted function, or None if the fit failed.
+        """
+
+        from GraphTools import EvalGraph,MakeGraph
+
+        if hasattr(fitfunc, 'graph'):
+            func = MakeCalibrationFunction(fitfunc.graph, 'fitfunc_fold', -6, 0, fitfunc.curve.Divides())
+        else:
+            func = fitfunc.Clone('fitfunc_fold')
+
+        if self.fitmode == 'analytic' and hasattr(fitfunc, 'graph'):
+            fitresult = AnalyticNormalisationFit(x, y, ey, EvalGraph(fitfunc.graph, x), xmin, xmax)
+            if fitresult is None or fitresult.Status():
+                return None
+            func.SetParameter(0, fitresult.Value(0))
+            func.SetParError(0, fitresult.Error(0))
+            return func
+
+        fitresult = MakeGraph(x, y, None, ey).Fit(func, "SRBQN", '', xmin, xmax)
+        if not fitresult.Get() or fitresult.Status():
+            return None
+        return func
+
+    def __PredictCL(self, func, yields):
+        """Inverts the calibration function, ie returns the CL values predicted for a numpy array of yields.
+        HistFitter calibration functions are inverted by interpolating their curve (which is monotonic),
+        other functions with TF1::GetX.
+        """
+
+        import numpy
+        from GraphTools import GraphViews,InterpolateLinear
+
+        try:
+            curvex,curvey = GraphViews(func.graph)[:2]
+        except AttributeError:
+            return numpy.array([func.GetX(value, func.GetXmin(), func.GetXmax()) for value in yields])
+
+        # Undo the normalisation, to get the value of the curve itself
+        if func.curve.Divides():
+            target = yields*func.GetParameter(0)
+        else:
+            target = yields/func.GetParameter(0)
+
+        # Like GetX, stay within the function range
+        return numpy.clip(InterpolateLinear(curvey, curvex, target), func.GetXmin(), func.GetXmax())
+
+    def MakeSystematicVariant(self, systematic):
+        """Returns a new CorrelationPlotter holding the results of a systematic variation
+        of the fits (see DMSTAReader.systematics), derived from the nominal results of this one.
+        The variation only changes the fit range and/or the normalisation scale factor,
+        so the graphs are copied and only refitted where the fit range changes.
+        Otherwise the nominal fit is reused, with the scale factor applied.
+        SRs that do not provide MakeFitFunctions (see Reader_DMSTA) keep their nominal fit.
+        This must be called after MakeCorrelations, and before PlotData (which deletes the graphs).
+        """
+
+        if self.__correlations is None:
+            print 'ERROR: Cannot make a systematic variation, as the nominal graphs have not been created yet!'
+            return None
+
+        variant = CorrelationPlotter(self.__data)
+        variant.fitmode = self.fitmode
+        variant.crosscheck = self.crosscheck
+        variant.nproc = self.nproc
+        variant.__correlations = {}
+        variant.__fitresults = {}
+
+        for dataobj in self.__data:
+
+            try:
+                fitfunctions = dataobj.MakeFitFunctions(systematic)
+            except AttributeError:
+                fitfunctions = dataobj.fitfunctions
+
+            for CLtype in dataobj.InfoList():
+
+                graphkey = '_'.join( [dataobj.name, CLtype] )
+
+                # Copy the nominal graph, including the python-level augmentation
+                nominalgraph = self.__correlations[graphkey]
+                graph = nominalgraph.Clone()
+                graph.xtitle = nominalgraph.xtitle
+                variant.__correlations[graphkey] = graph
+
+                if not graph.GetN():
+                    graph.goodfit = False
+                    graph.fiterrorgraph = None
+                    graph.calibcurve = None
+                    variant.__fitresults[graphkey] = None
+                    continue
+
+                fitfunc = fitfunctions[CLtype]
+                nominalfunc = dataobj.fitfunctions[CLtype]
+                fitresult = self.__fitresults[graphkey]
+
+                samerange = (getattr(fitfunc, 'xmin', None) == getattr(nominalfunc, 'xmin', None) and
+                             getattr(fitfunc, 'xmax', None) == getattr(nominalfunc, 'xmax', None))
+
+                if fitresult is not None and samerange:
+                    # The fit itself is identical, so start from the nominal parameters
+                    # and just (re)apply the scale factor
+                    for iparam in range(fitresult.NPar()):
+                        fitfunc.SetParameter(iparam, fitresult.Value(iparam))
+                        fitfunc.SetParError(iparam, fitresult.Error(iparam))
+                    variant.__AttachFittedFunction(graph, fitfunc, fitfunc)
+                else:
+                    print 'INFO: Refitting %s for systematic %s'%(graphkey,systematic)
+                    graph.GetListOfFunctions().Clear()
+                    fitresult = variant.FitGraph(graph, fitfunc)
+
+                # Same as in MakeCorrelations
+                variant.__fitresults[graphkey] = fitresult
+                graph.goodfit = fitresult and (not fitresult.Status()) and dataobj.GoodFit(graph)
+                graph.fiterrorgraph = dataobj.FitErrorGraph(graph)
+                graph.calibcurve = getattr(fitfunc, 'curve', None)
+
+        return variant
+
     def SaveData(self, dirname):
         """Save graphs in self.__correlations in a TFile called results.root,
         and a separate summary of the good fit results in calibration.root.
         The latter file only records SRs with a good fit, and can therefore be used
         safely by downstream code, without further checks.
+        After UpdateCorrelations, only the refitted (or removed) entries of the files are replaced.
+        The state needed for UpdateCorrelations is saved as well.
         """
 
         if self.__correlations is None:
             print 'ERROR: Cannot save graph output, as it has not been created yet!'
             return
 
+        import numpy
+        from GraphTools import GraphViews
+
         # Create the output directory if it does not already exist
         import os
         if not os.path.exists(dirname):
             os.makedirs(dirname)
 
+        # When updating, the graphs of unchanged SRs are left as they are in the files,
+        # and the new ones replace the old versions
+        update = self.__previousstate is not None
+        filemode = 'UPDATE' if update else 'RECREATE'
+        writeoption = ROOT.TObject.kOverwrite if update else 0
+
         # First write the correlation graphs (scatter plots)
         # Note that any fitted TF1s are still associated with them,
         # and therefore also saved.
-        outfile = ROOT.TFile.Open('/'.join([dirname,'results.root']),'RECREATE')
+        outfile = ROOT.TFile.Open('/'.join([dirname,'results.root']),filemode)
 
         for analysisSR in sorted(self.__correlations.keys()):
             # Save all graphs, for reference
             # These elements are just TGraph objects
-            self.__correlations[analysisSR].Write()
+            self.__correlations[analysisSR].Write('',writeoption)
+
+        for analysisSR in self.__removedkeys:
+            outfile.Delete('Corr_%s;*'%(analysisSR))
 
         outfile.Close()
 
         # Now write the fitted functions to a separate file, for easier downstream access
-        outfile = ROOT.TFile.Open('/'.join([dirname,'calibration.root']),'RECREATE')
+        outfile = ROOT.TFile.Open('/'.join([dirname,'calibration.root']),filemode)
+
+        def RemoveFunction(analysisSR):
+            # Get rid of the previous version, if any
+            if update:
+                outfile.Delete(analysisSR+';*')
+                outfile.Delete(analysisSR+'_curve;*')
+                outfile.Delete(analysisSR+'_bootstrap;*')
+
+        for analysisSR in self.__removedkeys:
+            RemoveFunction(analysisSR)
 
         # Loop again over the correlation dictionary
         for analysisSR in sorted(self.__correlations.keys()):
@@ -196,6 +923,7 @@ class CorrelationPlotter:
             # Use the result we cached in MakeCorrelations to decide if we want to keep it
             if not graph.goodfit:
                 print 'INFO in SaveData: %s rejected'%(analysisSR)
+                RemoveFunction(analysisSR)
                 continue
 
             # Now we extract the fitted TF1 associated with the graph
@@ -207,6 +935,7 @@ class CorrelationPlotter:
 
             # If we have no function, there's nothing to store...
             if not funclist:
+                RemoveFunction(analysisSR)
                 continue
 
             # At this point, there _might_ be more than one function (though there shouldn't be)
@@ -216,7 +945,7 @@ class CorrelationPlotter:
             
             # Set the function minimum to the first observed point
             # This is needed by downstream code, and is only accessible via the original TGraph scatter plot
-            xmin = min([graph.GetX()[i] for i in range(graph.GetN())])
+            xmin = GraphViews(graph)[0].min()
 
             # For the log-scale version, I have to set the maximum to zero now,
             # or else it's not saved
@@ -229,10 +958,32 @@ class CorrelationPlotter:
                 # Logarithmic
                 func.SetRange(max([xmin,-6]),0)
             
-            func.Write()
+            func.Write('',writeoption)
+
+            # The TF1 only stores a sampled version of the function,
+            # so also save the curve it was made from, for CombineCLs to rebuild it
+            if graph.calibcurve:
+                graph.calibcurve.Write(analysisSR+'_curve',writeoption)
+            elif update:
+                outfile.Delete(analysisSR+'_curve;*')
+
+            # The bootstrapped normalisation percentiles, if requested
+            if analysisSR in self.__bootstrap:
+                percentiles = numpy.ascontiguousarray(self.__bootstrap[analysisSR], dtype=numpy.float64)
+                ROOT.TVectorD(len(percentiles), percentiles).Write(analysisSR+'_bootstrap',writeoption)
+            elif update:
+                outfile.Delete(analysisSR+'_bootstrap;*')
+
+        # Record which percentiles the bootstrap vectors hold
+        if self.__bootstrap:
+            levels = numpy.array(self.bootstrappercentiles, dtype=numpy.float64)
+            ROOT.TVectorD(len(levels), levels).Write('bootstrap_percentiles',writeoption)
 
         outfile.Close()
 
+        # Finally, record what went into the calibration, for UpdateCorrelations
+        self.__WriteState(dirname)
+
     def PlotData(self, outdir):
         """Makes scatter plots with the fitted functions in the specified directory."""
 
@@ -245,6 +996,8 @@ class CorrelationPlotter:
         if not os.path.exists(outdir):
             os.makedirs(outdir)
 
+        from ParallelRender import RenderPages,Fingerprint
+
         # Make a canvas (this could be done more elegantly)
         self.__canvas = ROOT.TCanvas('can','can',800,800)
 
@@ -256,177 +1009,49 @@ class CorrelationPlotter:
         # Also, a set for the "real" analysis/SR combinations
         SRs = set()
 
-        # Loop over the correlation graphs
-        for analysisSR,graph in self.__correlations.items():
+        # The pdf pages to make, as (file name, drawing function)
+        jobs = []
 
-            # Extract and record the CL type and SR name
-            # This is stored at the end of the analysisSR name
+        # Extract and record the CL type and SR name
+        # This is stored at the end of the analysisSR name
+        # Use the fit results, as after UpdateCorrelations there are only graphs for the changed SRs
+        for analysisSR in self.__fitresults:
             CLtype = analysisSR.split('_')[-1]
             CLtypes.add(CLtype)
             SRname = analysisSR.replace('_'+CLtype,'')
             SRs.add(SRname)
 
-            graph.SetMarkerSize(1)
-            graph.SetMarkerStyle(ROOT.kFullCircle)
+        # Loop over the correlation graphs
+        for analysisSR,graph in self.__correlations.items():
 
-            # Let's make the best fit line red
+            # The pages for each graph are drawn by self.__DrawCorrelation
+            # They only need redrawing if the graph or its fit have changed
             funclist = graph.GetListOfFunctions()
-            for f in funclist:
-                f.SetLineColor(ROOT.kRed)
-
-            # First draw, needed in order to access the axis labels etc
-            graph.Draw('ap')
-            graph.GetYaxis().SetTitle('Yield')
-            try:
-                graph.GetXaxis().SetTitle(graph.xtitle) # Using the augmentation provided in self.MakeCorrelations()
-            except AttributeError:
-                # Should not happen, this is just in case
-                print 'WARNING in CorrelationPlotter: python-level augmentation of %s graph did not work'%(graph.GetName())
-
-            # Set the minimum of the y-axis to zero
-            graph.GetYaxis().SetRangeUser(0,graph.GetYaxis().GetXmax())
-
-            # Check if the x-axis goes negative (ie log(CLs) vs CLs)
-            isLinearCLs = graph.GetXaxis().GetXmin() >= 0
-            if isLinearCLs:
-                # Linear CL scale
-
-                # Set x-axis minimum to zero
-                graph.GetXaxis().SetLimits(0,graph.GetXaxis().GetXmax())
-
-                # If the x-axis is linear, then we want to also plot a log(x) version of the plot
-                doLogX = True
-            else:
-                # Log(CL) scale
-                # Sanity check
-                assert(graph.GetXaxis().GetXmax() <= 0)
-
-                # Zoom out to a consistent range if needed
-                # ie always plot down to -6, or the graph minimum if this is smaller
-                xmin = min([graph.GetXaxis().GetXmin(), -6])
-                graph.GetXaxis().SetLimits(xmin,0)
-
-                # If the x-axis is logarithmic, there is no point trying a log(log(x)) plot
-                doLogX = False
-
-            # Draw again (this is the pretty one!)
-            graph.Draw('ap')
-
-            # Draw a guide line at CLs = 0.05
-            exclusionLine = ROOT.TLine()
-            exclusionLine.SetLineColor(ROOT.kGray)
-            exclusionLine.SetLineWidth(4)
-            exclusionLine.SetLineStyle(7) #ROOT.kDashed)
-            import math
-            xvalue = 0.05 if isLinearCLs else math.log10(0.05)
-            ymax = graph.GetYaxis().GetXmax()
-            exclusionLine.DrawLine(xvalue,0, xvalue,ymax)
-
-            # Add some text to explain what the grey line is?
-            # I can't seem to get this to look right...
-            # exclusionText = ROOT.TLatex()
-            # exclusionText.SetTextColor(ROOT.kGray)
-            # exclusionText.SetTextAngle(90)
-            # exclusionText.SetTextAlign(21) # Centre bottom adjusted
-            # exclusionText.SetTextSize(0.04)
-            # exclusionText.DrawLatex(xvalue, ymax*2./3, 'CLs = 0.05')
-
-            # Draw the fit function error band next, if it exists
-            if graph.fiterrorgraph:
-                graph.fiterrorgraph.SetMarkerSize(0)
-                graph.fiterrorgraph.SetFillColorAlpha(ROOT.kYellow, 0.35)
-                graph.fiterrorgraph.Draw('same3')
-
-            # The fit function itself should go on top
-            for f in funclist:
-
-                f.Draw('same')
-
-                # Put the fit parameters on the plot, for convenience
-                # Have one parameter as a special case
-                if f.GetNpar() == 1:
-                    ROOT.myText(0.2,0.19, ROOT.kBlack, '#LT#epsilon #GT = %5.2f #pm%5.2f'%(f.GetParameter(0),f.GetParError(0)))
-                else:
-                    printy = 0.9 # Start position for listing the fit parameters
-                    for ipar in range(f.GetNpar()):
-                        printy -= 0.05
-                        ROOT.myText(0.6,printy, ROOT.kBlack, 'p%i: %5.2f #pm %5.2f'%(ipar,f.GetParameter(ipar),f.GetParError(ipar)))
-
-            # Add the graph title, so you can see which SR this is
-            # This needs to be reinterpreted for publication-quality plots
-            splittitle = graph.GetTitle().split()
-            analysistext = ''
-            SRtext = ''
-            if splittitle[0] == 'EwkTwoLepton':
-                analysistext = '2 lepton search'
-                if 'mT' in splittitle[-1]:
-                    threshold = 90 if 'a' in splittitle[-1] else (120 if 'b' in splittitle[-1] else 150)
-                    SRtext = 'SR-m_{T2}^{%i}'%(threshold)
-                else: # Zjets or WWx
-                    SRtext = 'SR-%s'%(splittitle[-1])
-            elif splittitle[0] == 'EwkThreeLepton':
-                analysistext = '3 lepton search'
-                if 'SR0a' in splittitle[-2]:
-                    SRtext = 'SR0#tau a bin %s'%(splittitle[-1])
-                elif splittitle[-1] == 'SR0b':
-                    SRtext = 'SR0#tau b'
-                elif splittitle[-1] == 'SR1SS':
-                    SRtext = 'SR1#tau'
-            elif splittitle[0] == 'EwkFourLepton':
-                analysistext = '4 lepton search'
-                SRtext = splittitle[-1]
-            elif splittitle[0] == 'EwkTwoTau':
-                analysistext = '2 tau search'
-                if splittitle[2].startswith('C1'):
-                    SRtext = 'SR-%s'%(splittitle[2])
-                else:
-                    SRtext = 'SR-DS-lowMass' if 'low' in splittitle[-1] else 'SR-DS-highMass'
-
-            ROOT.myTextVarSize(0.2, 0.30, ROOT.kBlack, analysistext+', '+SRtext, 0.04)
-            # ROOT.myTextVarSize(0.2, 0.25, ROOT.kBlack, SRtext, 0.03)
-            ROOT.myBoxTextColorAlpha(0.27, 0.26, 0.04, ROOT.kYellow, 'CL_{s} parametrisation', ROOT.kRed, 0.35)
-            # And an ATLAS label!
-            ROOT.ATLASLabel(0.2,0.35,"Internal")
-
-            # Finally, say if the fit on the plot is good or not
-            if not graph.goodfit:
-                ROOT.myText(0.8, 0.9, ROOT.kRed, 'Bad fit')
-
-            # Open a multi-page pdf file
-            # This adds the current canvas, ie completely "natural" x and y axes
-            self.__canvas.Print('/'.join([outdir,analysisSR+'.pdf(']))
-
-            # If the x-axis is linear, plot a log(x) vs log(y) version
-            if doLogX:
-                self.__canvas.SetLogx()
-                self.__canvas.SetLogy()
-                self.__canvas.Print('/'.join([outdir,analysisSR+'.pdf']))
-
-            # "Natural" x-axis, log(y)
-            self.__canvas.SetLogx(0)
-            self.__canvas.SetLogy()
-            self.__canvas.Print('/'.join([outdir,analysisSR+'.pdf']))
+            fingerprint = Fingerprint(graph, graph.xtitle, bool(graph.goodfit), graph.fiterrorgraph,
+                                      [(f.GetName(), f.GetXmin(), f.GetXmax(),
+                                        [f.GetParameter(i) for i in range(f.GetNpar())],
+                                        [f.GetParError(i) for i in range(f.GetNpar())]) for f in funclist])
+            jobs.append( ('/'.join([outdir,analysisSR+'.pdf']),
+                          lambda canvas,printpage,graph=graph: self.__DrawCorrelation(graph, canvas, printpage),
+                          fingerprint) )
 
-            if doLogX:
-                # log(x) vs linear y
-                self.__canvas.SetLogx()
-                self.__canvas.SetLogy(0)
-                self.__canvas.Print('/'.join([outdir,analysisSR+'.pdf']))
+            # End of loop over per-SR correlation graphs (scatter plots)
+            pass
 
-            # Close the file
-            self.__canvas.Print('/'.join([outdir,analysisSR+'.pdf]']))
+        # Render the pages, in parallel if requested, skipping those that have not changed
+        RenderPages(jobs, self.__canvas, self.nproc)
 
-            # Reset to linear scale
-            self.__canvas.SetLogx(0)
-            self.__canvas.SetLogy(0)
+        # Remove the plots of graphs that no longer exist (see UpdateCorrelations)
+        for analysisSR in self.__removedkeys:
+            for fname in ['/'.join([outdir,analysisSR+'.pdf']), '/'.join([outdir,analysisSR+'.pdf.manifest.json'])]:
+                if os.path.exists(fname):
+                    os.remove(fname)
 
-            # If I don't delete the graphs now, the job ends with a seg fault
-            # Strange, but true!
+        # If I don't delete the graphs now, the job ends with a seg fault
+        # Strange, but true!
+        for graph in self.__correlations.values():
             graph.Delete()
 
-            # End of loop over per-SR correlation graphs (scatter plots)
-            pass
-
         # Let's just do a little check
         if len(self.__fitresults) != len(SRs)*len(CLtypes):
             print '========================================='
@@ -566,6 +1191,161 @@ class CorrelationPlotter:
                 for i in range(fitresult.NPar()):
                     print '  Par %i: %.4f +- %.2f %%'%(i,fitresult.Value(i),100.*fitresult.Error(i)/fitresult.Value(i))
 
+    def __DrawCorrelation(self, graph, canvas, printpage):
+        """Draws the pages of the scatter plot for one correlation graph (see PlotData),
+        calling printpage() after each one.
+        """
+
+        graph.SetMarkerSize(1)
+        graph.SetMarkerStyle(ROOT.kFullCircle)
+
+        # Let's make the best fit line red
+        funclist = graph.GetListOfFunctions()
+        for f in funclist:
+            f.SetLineColor(ROOT.kRed)
+
+        # First draw, needed in order to access the axis labels etc
+        graph.Draw('ap')
+        graph.GetYaxis().SetTitle('Yield')
+        try:
+            graph.GetXaxis().SetTitle(graph.xtitle) # Using the augmentation provided in self.MakeCorrelations()
+        except AttributeError:
+            # Should not happen, this is just in case
+            print 'WARNING in CorrelationPlotter: python-level augmentation of %s graph did not work'%(graph.GetName())
+
+        # Set the minimum of the y-axis to zero
+        graph.GetYaxis().SetRangeUser(0,graph.GetYaxis().GetXmax())
+
+        # Check if the x-axis goes negative (ie log(CLs) vs CLs)
+        isLinearCLs = graph.GetXaxis().GetXmin() >= 0
+        if isLinearCLs:
+            # Linear CL scale
+
+            # Set x-axis minimum to zero
+            graph.GetXaxis().SetLimits(0,graph.GetXaxis().GetXmax())
+
+            # If the x-axis is linear, then we want to also plot a log(x) version of the plot
+            doLogX = True
+        else:
+            # Log(CL) scale
+            # Sanity check
+            assert(graph.GetXaxis().GetXmax() <= 0)
+
+            # Zoom out to a consistent range if needed
+            # ie always plot down to -6, or the graph minimum if this is smaller
+            xmin = min([graph.GetXaxis().GetXmin(), -6])
+            graph.GetXaxis().SetLimits(xmin,0)
+
+            # If the x-axis is logarithmic, there is no point trying a log(log(x)) plot
+            doLogX = False
+
+        # Draw again (this is the pretty one!)
+        graph.Draw('ap')
+
+        # Draw a guide line at CLs = 0.05
+        exclusionLine = ROOT.TLine()
+        exclusionLine.SetLineColor(ROOT.kGray)
+        exclusionLine.SetLineWidth(4)
+        exclusionLine.SetLineStyle(7) #ROOT.kDashed)
+        import math
+        xvalue = 0.05 if isLinearCLs else math.log10(0.05)
+        ymax = graph.GetYaxis().GetXmax()
+        exclusionLine.DrawLine(xvalue,0, xvalue,ymax)
+
+        # Add some text to explain what the grey line is?
+        # I can't seem to get this to look right...
+        # exclusionText = ROOT.TLatex()
+        # exclusionText.SetTextColor(ROOT.kGray)
+        # exclusionText.SetTextAngle(90)
+        # exclusionText.SetTextAlign(21) # Centre bottom adjusted
+        # exclusionText.SetTextSize(0.04)
+        # exclusionText.DrawLatex(xvalue, ymax*2./3, 'CLs = 0.05')
+
+        # Draw the fit function error band next, if it exists
+        if graph.fiterrorgraph:
+            graph.fiterrorgraph.SetMarkerSize(0)
+            graph.fiterrorgraph.SetFillColorAlpha(ROOT.kYellow, 0.35)
+            graph.fiterrorgraph.Draw('same3')
+
+        # The fit function itself should go on top
+        for f in funclist:
+
+            f.Draw('same')
+
+            # Put the fit parameters on the plot, for convenience
+            # Have one parameter as a special case
+            if f.GetNpar() == 1:
+                ROOT.myText(0.2,0.19, ROOT.kBlack, '#LT#epsilon #GT = %5.2f #pm%5.2f'%(f.GetParameter(0),f.GetParError(0)))
+            else:
+                printy = 0.9 # Start position for listing the fit parameters
+                for ipar in range(f.GetNpar()):
+                    printy -= 0.05
+                    ROOT.myText(0.6,printy, ROOT.kBlack, 'p%i: %5.2f #pm %5.2f'%(ipar,f.GetParameter(ipar),f.GetParError(ipar)))
+
+        # Add the graph title, so you can see which SR this is
+        # This needs to be reinterpreted for publication-quality plots
+        splittitle = graph.GetTitle().split()
+        analysistext = ''
+        SRtext = ''
+        if splittitle[0] == 'EwkTwoLepton':
+            analysistext = '2 lepton search'
+            if 'mT' in splittitle[-1]:
+                threshold = 90 if 'a' in splittitle[-1] else (120 if 'b' in splittitle[-1] else 150)
+                SRtext = 'SR-m_{T2}^{%i}'%(threshold)
+            else: # Zjets or WWx
+                SRtext = 'SR-%s'%(splittitle[-1])
+        elif splittitle[0] == 'EwkThreeLepton':
+            analysistext = '3 lepton search'
+            if 'SR0a' in splittitle[-2]:
+                SRtext = 'SR0#tau a bin %s'%(splittitle[-1])
+            elif splittitle[-1] == 'SR0b':
+                SRtext = 'SR0#tau b'
+            elif splittitle[-1] == 'SR1SS':
+                SRtext = 'SR1#tau'
+        elif splittitle[0] == 'EwkFourLepton':
+            analysistext = '4 lepton search'
+            SRtext = splittitle[-1]
+        elif splittitle[0] == 'EwkTwoTau':
+            analysistext = '2 tau search'
+            if splittitle[2].startswith('C1'):
+                SRtext = 'SR-%s'%(splittitle[2])
+            else:
+                SRtext = 'SR-DS-lowMass' if 'low' in splittitle[-1] else 'SR-DS-highMass'
+
+        ROOT.myTextVarSize(0.2, 0.30, ROOT.kBlack, analysistext+', '+SRtext, 0.04)
+        # ROOT.myTextVarSize(0.2, 0.25, ROOT.kBlack, SRtext, 0.03)
+        ROOT.myBoxTextColorAlpha(0.27, 0.26, 0.04, ROOT.kYellow, 'CL_{s} parametrisation', ROOT.kRed, 0.35)
+        # And an ATLAS label!
+        ROOT.ATLASLabel(0.2,0.35,"Internal")
+
+        # Finally, say if the fit on the plot is good or not
+        if not graph.goodfit:
+            ROOT.myText(0.8, 0.9, ROOT.kRed, 'Bad fit')
+
+        # The first page has completely "natural" x and y axes
+        printpage()
+
+        # If the x-axis is linear, plot a log(x) vs log(y) version
+        if doLogX:
+            canvas.SetLogx()
+            canvas.SetLogy()
+            printpage()
+
+        # "Natural" x-axis, log(y)
+        canvas.SetLogx(0)
+        canvas.SetLogy()
+        printpage()
+
+        if doLogX:
+            # log(x) vs linear y
+            canvas.SetLogx()
+            canvas.SetLogy(0)
+            printpage()
+
+        # Reset to linear scale
+        canvas.SetLogx(0)
+        canvas.SetLogy(0)
+
     def FitGraph(self, graph, fitfunc):
         """Function for fitting the CL calibration data.
         If called before the graph is plotted and/or saved, the results are included in those steps.
@@ -598,31 +1378,18 @@ class CorrelationPlotter:
         except AttributeError:
             xmax = fitfunc.GetXmax()
 
-        fitresult = graph.Fit(fitfunc, "SRB", '', xmin, xmax)
-        finalfunc = graph.GetFunction(fitfunc.GetName())
-        if finalfunc:
-
-            # The only way I can find to properly store the region
-            # -0.5 < log(CLs) < 0.0 is to clone the original function.
-            # It really seems as if this part of the function is lost during the fit...?
-            # Even worse, the functional form is lost in a call to Clone(),
-            # so reconstruct it from the original graph
-            newfunc = ROOT.TF1('fitfunc', lambda x,p: fitfunc.graph.Eval(x[0])/p[0], -6, 0, 1)
-
-            # See if we need to adjust the normalisation
-            try:
-                scalefact = fitfunc.SystematicFactor(graph, fitfunc)
-            except AttributeError:
-                scalefact = 1.0
+        if self.fitmode == 'analytic' and hasattr(fitfunc, 'graph'):
+            fitresult = self.__FitGraphAnalytic(graph, fitfunc, xmin, xmax)
+            if fitresult is None:
+                print 'ERROR: No fit object returned for %s'%(graph.GetName())
+                return None
+            finalfunc = fitfunc
+        else:
+            fitresult = graph.Fit(fitfunc, "SRB", '', xmin, xmax)
+            finalfunc = graph.GetFunction(fitfunc.GetName())
 
-            for iparam in range(newfunc.GetNpar()):
-                newfunc.SetParameter(iparam, scalefact*finalfunc.GetParameter(iparam))
-                newfunc.SetParError(iparam, scalefact*finalfunc.GetParError(iparam))
-            graph.GetListOfFunctions().Clear()
-            # finalfunc.SetName(finalfunc.GetName()+'_old')
-            graph.GetListOfFunctions().AddFirst(newfunc)
-            assert len(graph.GetListOfFunctions()) == 1
-            # finalfunc.SetRange(funcmin,funcmax)
+        if finalfunc:
+            self.__AttachFittedFunction(graph, fitfunc, finalfunc)
 
         # Some failures (eg no data) return a null object
         if not fitresult.Get():
@@ -640,10 +1407,77 @@ class CorrelationPlotter:
         # errors = [fitresult.Error(i) for i in range(fitresult.NPar())]
         
         return fitresult
+
+    def __AttachFittedFunction(self, graph, fitfunc, finalfunc):
+        """Replaces the functions attached to the graph by a copy of the fitted function (finalfunc),
+        scaled by fitfunc.SystematicFactor if there is one.
+        """
+
+        # The only way I can find to properly store the region
+        # -0.5 < log(CLs) < 0.0 is to clone the original function.
+        # It really seems as if this part of the function is lost during the fit...?
+        # Even worse, the functional form is lost in a call to Clone(),
+        # so reconstruct it from the original graph
+        try:
+            newfunc = MakeCalibrationFunction(fitfunc.graph, 'fitfunc', -6, 0)
+        except AttributeError:
+            # Not a HistFitter calibration function (eg from the dummy reader),
+            # so there's nothing to reconstruct it from
+            newfunc = finalfunc.Clone()
+
+        # See if we need to adjust the normalisation
+        try:
+            scalefact = fitfunc.SystematicFactor(graph, fitfunc)
+        except AttributeError:
+            scalefact = 1.0
+
+        for iparam in range(newfunc.GetNpar()):
+            newfunc.SetParameter(iparam, scalefact*finalfunc.GetParameter(iparam))
+            newfunc.SetParError(iparam, scalefact*finalfunc.GetParError(iparam))
+        graph.GetListOfFunctions().Clear()
+        # finalfunc.SetName(finalfunc.GetName()+'_old')
+        graph.GetListOfFunctions().AddFirst(newfunc)
+        assert len(graph.GetListOfFunctions()) == 1
+        # finalfunc.SetRange(funcmin,funcmax)
+
+    def __FitGraphAnalytic(self, graph, fitfunc, xmin, xmax):
+        """Fits the normalisation of the HistFitter curve (fitfunc.graph) to the graph,
+        using the closed-form least-squares solution rather than Minuit.
+        On return, fitfunc holds the fitted parameter, as it would after TGraph::Fit.
+        Returns a FitResultSummary, or None if the fit was not possible.
+        """
+
+        from GraphTools import GraphArrays,EvalGraph
+
+        x,y,ex,ey = GraphArrays(graph)
+        fitresult = AnalyticNormalisationFit(x, y, ey, EvalGraph(fitfunc.graph, x), xmin, xmax)
+        if fitresult is None:
+            return None
+
+        fitfunc.SetParameter(0, fitresult.Value(0))
+        fitfunc.SetParError(0, fitresult.Error(0))
+        fitfunc.SetChisquare(fitresult.Chi2())
+        fitfunc.SetNDF(fitresult.Ndf())
+
+        if self.crosscheck:
+            # Repeat the fit with Minuit, on a copy so the graph is not modified
+            checkfunc = MakeCalibrationFunction(fitfunc.graph, 'fitfunc_check', -6, 0)
+            checkresult = graph.Clone().Fit(checkfunc, "SRBQN", '', xmin, xmax)
+            if checkresult.Get():
+                print 'INFO: Minuit cross-check for %s: p = %.4f +- %.4f (analytic %.4f +- %.4f), chi2 = %.2f (analytic %.2f)'%(
+                    graph.GetName(),
+                    checkresult.Value(0),checkresult.Error(0),
+                    fitresult.Value(0),fitresult.Error(0),
+                    checkresult.Chi2(),fitresult.Chi2())
+            else:
+                print 'WARNING: Minuit cross-check failed for %s'%(graph.GetName())
+
+        return fitresult
             
 def PassArguments():
 
     import argparse
+    from SkimYieldFile import PROFILES
 
     parser = argparse.ArgumentParser(
         description="""
@@ -682,13 +1516,63 @@ def PassArguments():
     parser.add_argument(
         "--systematic",
         dest = "systematic",
-        choices = [None, "Lin", "Quad", "2L", "LinAll", "QuadAll"],
-        help = "Do a systematic variation, for robustness checks")
+        choices = [None, "Lin", "Quad", "2L", "LinAll", "QuadAll", "all"],
+        help = "Do a systematic variation, for robustness checks (all: do every variation, as well as the nominal calibration)")
     parser.add_argument(
         "--subset",
         action = "store_true",
         dest = "subset",
         help = "Perform the calibration using D3PDs_calibsubset.txt")
+    parser.add_argument(
+        "--nocache",
+        action = "store_true",
+        dest = "nocache",
+        help = "Always read the input files, ignoring (and not writing) the reader cache")
+    parser.add_argument(
+        "--checkdetails",
+        action = "store_true",
+        dest = "checkdetails",
+        help = "List the models with missing or incomplete data, rather than just counting them")
+    parser.add_argument(
+        "--fitter",
+        dest = "fitter",
+        choices = ["minuit", "analytic"],
+        default = "minuit",
+        help = "Fit the calibration normalisation with Minuit, or with the (much faster) closed-form solution")
+    parser.add_argument(
+        "--crosscheck",
+        action = "store_true",
+        dest = "crosscheck",
+        help = "Cross-check analytic fits against Minuit")
+    parser.add_argument(
+        "--nproc",
+        dest = "nproc",
+        type = int,
+        default = 1,
+        help = "Number of processes to use for the calibration fits and plots")
+    parser.add_argument(
+        "--incremental",
+        action = "store_true",
+        dest = "incremental",
+        help = "Only refit the SRs whose inputs have changed since the last calibration in the output directory")
+    parser.add_argument(
+        "--kfold",
+        dest = "kfold",
+        type = int,
+        default = 0,
+        help = "Also cross-validate the calibration with K folds of the models, reporting the bias and spread of the predicted CL values per SR")
+    parser.add_argument(
+        "--bootstrap",
+        dest = "bootstrap",
+        type = int,
+        default = 0,
+        help = "Bootstrap the fitted normalisations with N replicas of the models, saving percentiles in calibration.root")
+    parser.add_argument(
+        "--profile",
+        dest = "profile",
+        default = "full",
+        choices = sorted(PROFILES.keys()),
+        help = "Branch profile of the skimmed ntuples to read (see SkimYieldFile.py), calibration or full")
 
     return parser.parse_args()
 
@@ -703,8 +1587,11 @@ if __name__ == '__main__':
     ROOT.gROOT.LoadMacro("AtlasUtils.C") 
     ROOT.gROOT.LoadMacro("ExtraAtlasUtils.C") 
     ROOT.gROOT.LoadMacro("AtlasLabels.C") 
+    from CalibrationFunction import MakeCalibrationFunction
 
     plotdir = 'plots'
+    # Systematic variations to be derived from the nominal fits, as (systematic, plotdir)
+    variantdirs = []
     
     # Read the input files
     if cmdlinearguments.dummy:
@@ -745,24 +1632,57 @@ if __name__ == '__main__':
         
         # Default operation: do the real anaylsis
         from Reader_DMSTA import DMSTAReader
+        from SkimYieldFile import SkimmedFile
 
+        readerargs = {'yieldfile': SkimmedFile('sim', cmdlinearguments.profile)}
         if cmdlinearguments.subset:
-            reader = DMSTAReader(DSlist='Data_Yields/D3PDs_calibsubset.txt')
+            readerargs['DSlist'] = 'Data_Yields/D3PDs_calibsubset.txt'
+        if cmdlinearguments.nocache:
+            readerargs['cachedir'] = None
+        reader = DMSTAReader(**readerargs)
+
+        # With "all", the data are read (and fitted) once without any variation
+        systematic = cmdlinearguments.systematic
+        if systematic == 'all':
+            systematic = None
+            variants = DMSTAReader.systematics
         else:
-            reader = DMSTAReader()
-        data = reader.ReadFiles(not cmdlinearguments.truthlevel, cmdlinearguments.systematic)
+            variants = []
+
+        data = reader.ReadFiles(not cmdlinearguments.truthlevel, systematic)
         if cmdlinearguments.truthlevel:
             plotdir = 'plots_privateMC'
         else:
             plotdir = 'plots_officialMC'
-        if cmdlinearguments.systematic:
-            plotdir += '_sys'+cmdlinearguments.systematic
-        if cmdlinearguments.subset:
-            plotdir += '_subset'
+        subsetsuffix = '_subset' if cmdlinearguments.subset else ''
+        variantdirs = [(variant, plotdir+'_sys'+variant+subsetsuffix) for variant in variants]
+        if systematic:
+            plotdir += '_sys'+systematic
+        plotdir += subsetsuffix
 
     if 'data' in dir():
         plotter = CorrelationPlotter(data)
-        plotter.MakeCorrelations()
+        plotter.fitmode = cmdlinearguments.fitter
+        plotter.crosscheck = cmdlinearguments.crosscheck
+        plotter.nproc = cmdlinearguments.nproc
+        plotter.verbosecheck = cmdlinearguments.checkdetails
+        if cmdlinearguments.incremental and variantdirs:
+            # The variations are derived from the nominal graphs, so need all of them
+            print 'WARNING: --incremental cannot be used with --systematic all, fitting all SRs'
+            plotter.MakeCorrelations()
+        elif cmdlinearguments.incremental:
+            plotter.UpdateCorrelations(plotdir)
+        else:
+            plotter.MakeCorrelations()
+        # The variations have to be made before PlotData, which deletes the nominal graphs
+        variantplotters = [(variantdir, plotter.MakeSystematicVariant(variant)) for variant,variantdir in variantdirs]
+        if cmdlinearguments.bootstrap:
+            plotter.Bootstrap(cmdlinearguments.bootstrap)
         plotter.SaveData(plotdir)
+        if cmdlinearguments.kfold:
+            plotter.CrossValidate(cmdlinearguments.kfold, plotdir)
         plotter.PlotData(plotdir)
+        for variantdir,variantplotter in variantplotters:
+            variantplotter.SaveData(variantdir)
+            variantplotter.PlotData(variantdir)
 
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
-class SignalRegion:
+import numpy
+from ValueWithError import valueWithError,valueWithErrorArray
+
+class SignalRegion(object):
     """
     Class for holding CL values and fit functions for a single signal region.
     """
@@ -49,102 +52,426 @@ class SignalRegion:
         else:                self.__infolist = infolist
 
         # Data (CL values) and fit functions will be filled later
-        # The structure of data is a dictionary of dictionaries like this:
+        # The data are stored in columns, with one row per model (see self.model_ids):
+        # 'yield', 'yield_err' and one column per infolist item, with NaN for missing values
+        # (a yield without an error has a NaN 'yield_err').
+        # Use self.Column and self.Mask to work on these arrays directly.
+        # For convenience, self.data gives the same information in the form
         # { modelID : {'yield': yield, 'CLs': CLs, ... }, ... }
         # It should be filled by an appropriate Reader class, eg Reader_DMSTA
-        self.data = {}
+        self.ClearData()
         self.fitfunctions = dict.fromkeys(self.__infolist) # Values default to None
 
     def InfoList(self):
         return self.__infolist
-    
+
+    def Fields(self):
+        """The names of the data columns."""
+        return ['yield','yield_err'] + self.__infolist
+
+    # ########################################################
+    # Columnar access
+
+    def ClearData(self):
+        """Removes all models."""
+
+        self.__modelIDs = [] # In row order
+        self.__rows = {} # modelID:row
+        self.__modelIDarray = None # Made when needed, see self.model_ids
+        self.__columns = dict([(field,numpy.zeros(0)) for field in self.Fields()])
+
+    def NModels(self):
+        return len(self.__modelIDs)
+
+    def ModelIDs(self):
+        """List of the model IDs, in row order."""
+        return list(self.__modelIDs)
+
+    @property
+    def model_ids(self):
+        """numpy array of the model IDs, in row order."""
+
+        if self.__modelIDarray is None:
+            self.__modelIDarray = numpy.array(self.__modelIDs)
+        return self.__modelIDarray
+
+    @property
+    def data(self):
+        """Dictionary-like view of the data, see the comment in __init__."""
+        return _DataView(self)
+
+    def Column(self, field):
+        """numpy array of the field for all models, in row order.
+        This is a view of the data, so it should not be modified unless that is intended.
+        """
+        return self.__columns[field][:len(self.__modelIDs)]
+
+    def Mask(self, field):
+        """Boolean numpy array, true for the models with a value for the field."""
+        return ~numpy.isnan(self.Column(field))
+
+    def Yields(self):
+        """The yields of all models as a valueWithErrorArray, in row order.
+        Yields given without an error have an error of zero.
+        """
+        return valueWithErrorArray(self.Column('yield'), numpy.nan_to_num(self.Column('yield_err')))
+
+    def Row(self, modelID):
+        """Returns the row of the model, raising a KeyError if it does not exist."""
+        return self.__rows[modelID]
+
+    def HasModel(self, modelID):
+        return modelID in self.__rows
+
+    def Lookup(self, modelIDs, field):
+        """Returns a numpy array of the field for each of the modelIDs, with NaN for models that do not exist."""
+
+        rows = numpy.array([self.__rows.get(modelID, -1) for modelID in modelIDs], dtype=int)
+        result = numpy.empty(len(rows))
+        result.fill(numpy.nan)
+        found = rows >= 0
+        result[found] = self.Column(field)[rows[found]]
+        return result
+
+    def AddModel(self, modelID):
+        """Returns the row of the model, adding an empty one if it does not exist yet."""
+
+        try:
+            return self.__rows[modelID]
+        except KeyError:
+            pass
+
+        row = len(self.__modelIDs)
+
+        # Grow the columns in large steps, as models are usually added one at a time
+        capacity = len(self.__columns['yield'])
+        if row >= capacity:
+            capacity = max(64, 2*capacity)
+            for field,column in self.__columns.items():
+                newcolumn = numpy.empty(capacity)
+                newcolumn.fill(numpy.nan)
+                newcolumn[:row] = column[:row]
+                self.__columns[field] = newcolumn
+
+        for column in self.__columns.itervalues():
+            column[row] = numpy.nan
+
+        self.__modelIDs.append(modelID)
+        self.__rows[modelID] = row
+        self.__modelIDarray = None
+        return row
+
+    def GetValue(self, modelID, field):
+        """Returns the field for the model in the traditional format, ie None if there is no value,
+        and a valueWithError for a yield with an error.
+        """
+
+        row = self.__rows[modelID]
+        value = self.__columns[field][row]
+        if numpy.isnan(value):
+            return None
+
+        if field == 'yield':
+            error = self.__columns['yield_err'][row]
+            if not numpy.isnan(error):
+                return valueWithError(float(value), float(error))
+
+        return float(value)
+
+    def SetValue(self, modelID, field, value):
+        """Sets the field for an existing model (raising a KeyError otherwise).
+        Values are given in the traditional format, ie None for no value.
+        A yield can be a valueWithError, which fills 'yield_err' too.
+        """
+
+        row = self.__rows[modelID]
+
+        if field == 'yield':
+            try:
+                value,error = value.value,value.error
+            except AttributeError:
+                error = None
+            self.__columns['yield_err'][row] = numpy.nan if error is None else error
+
+        self.__columns[field][row] = numpy.nan if value is None else value
+
+    def RemoveModels(self, mask):
+        """Removes the models selected by the boolean numpy array mask (in row order)."""
+
+        keep = ~numpy.asarray(mask, dtype=bool)
+        if keep.all():
+            return
+
+        self.__modelIDs = [modelID for modelID,kept in zip(self.__modelIDs,keep) if kept]
+        self.__rows = dict([(modelID,row) for row,modelID in enumerate(self.__modelIDs)])
+        self.__modelIDarray = None
+        for field in self.__columns.keys():
+            self.__columns[field] = self.__columns[field][:len(keep)][keep]
+
+    def ColumnData(self):
+        """Returns the data as (list of model IDs, dictionary of field:numpy array), eg for pickling."""
+        return list(self.__modelIDs), dict([(field,self.Column(field).copy()) for field in self.Fields()])
+
+    def SetColumnData(self, modelIDs, columns):
+        """Replaces the data by the output of ColumnData."""
+
+        self.__modelIDs = list(modelIDs)
+        self.__rows = dict([(modelID,row) for row,modelID in enumerate(self.__modelIDs)])
+        self.__modelIDarray = None
+        self.__columns = dict([(field,numpy.array(columns[field], dtype=numpy.float64)) for field in self.Fields()])
+
+    # ########################################################
+    # Traditional per-model access
+
     def AddData(self, modelID):
         """Creates a new entry in self.data, if needed, and return the entry.
         Existing data is not overwritten.
         """
 
-        if self.data.has_key(modelID): return self.data[modelID]
-        return self.ResetData(modelID)
+        self.AddModel(modelID)
+        return _ModelData(self, modelID)
 
     def ResetData(self, modelID):
         """Resets the data for the given model, creating a new record if required.
         The data entry is returned.
         """
 
-        self.data[modelID] = dict.fromkeys(['yield']+self.__infolist)
-        return self.data[modelID]
+        row = self.AddModel(modelID)
+        for column in self.__columns.itervalues():
+            column[row] = numpy.nan
+        return _ModelData(self, modelID)
     
-    def CheckData(self):
+    def CheckData(self, verbose=False):
         """Checks for missing data and (by default) removes models where no yield and/or CL information is found.
+        Only the number of bad models is printed, unless verbose is true (see PresenceMatrix).
         """
 
-        # Find models with incomplete data
-        # Simple implementation with one loop over the models - hopefully the amount of missing data will be small
+        presence = PresenceMatrix([self])
+        presence.PrintSummary(verbose)
+        self.RemoveModels(presence.RegionMask(presence.Duds(), 0))
 
-        # Classify missing info as follows (mutually exclusive categories):
-        emptymodels = [] # No data at all
-        yieldlessmodels = [] # No yield, but at least one CL value
-        CLlessmodels = [] # Has yield, but no CL values
-        incompletemodels = [] # Has yield, as well as some (but not all) CL values - only this is OK for plotting
+class PresenceMatrix(object):
+    """Records which data are present for each model in a list of SignalRegion objects,
+    with one bit per (model, SR, field), so that the completeness of the data can be checked
+    with array operations rather than per-model loops.
 
-        # Find out how many results we _should_ have
-        targetCLnumber = len(self.__infolist)
-        
-        # Loop over the data
-        for modelID,datum in self.data.iteritems():
+    self.bits has one row per model (see self.model_ids, the sorted union of the models of all SRs)
+    and one column per SR. The bits are given by self.Bit: 'exists' is set if the model was read in
+    for the SR at all, and then one bit for the yield and one for each CL-like quantity.
+    """
 
-            try:
-                # Make sure we have a yield
-                hasYield = datum['yield'] is not None
-            except TypeError:
-                # Implies that datum has no "yield" key
-                # This should not happen, bail out if it does
-                print 'Urgh:',modelID,datum
-                raise
-
-            # Find out how many CL-like numbers are filled (ie not None)
-            numCLs = len([prop for prop in self.__infolist if datum[prop] is not None])
-
-            if hasYield:
-                # Maybe OK, let's check the CL values
-                if numCLs == targetCLnumber:
-                    # Perfect, we have all the CL values
+    # Mutually exclusive classes of bad data, in the order they are reported
+    # (category, description, whether to remove the models)
+    categories = [
+        ('empty', 'empty data', True), # No data at all
+        ('yieldless', 'empty yields', True), # No yield, but at least one CL value
+        ('CLless', 'empty CL data', True), # Has yield, but no CL values
+        ('incomplete', 'incomplete CL data', False), # Has yield, as well as some (but not all) CL values - only this is OK for plotting
+        ]
+
+    def __init__(self, regions):
+
+        self.regions = list(regions)
+        self.names = [region.name for region in self.regions]
+
+        # The bits, in order
+        self.fields = ['exists','yield']
+        for region in self.regions:
+            self.fields.extend([field for field in region.InfoList() if field not in self.fields])
+        assert len(self.fields) <= 32
+
+        # All models, and the row of each region's models in the matrix
+        allIDs = [region.model_ids for region in self.regions if region.NModels()]
+        self.model_ids = numpy.unique(numpy.concatenate(allIDs)) if allIDs else numpy.zeros(0)
+        self.__rows = [numpy.searchsorted(self.model_ids, region.model_ids) for region in self.regions]
+
+        self.bits = numpy.zeros((len(self.model_ids),len(self.regions)), dtype=numpy.uint32)
+        for iregion,region in enumerate(self.regions):
+            column = numpy.zeros(region.NModels(), dtype=numpy.uint32) | self.Bit('exists')
+            for field in ['yield']+region.InfoList():
+                column |= region.Mask(field).astype(numpy.uint32) << numpy.uint32(self.fields.index(field))
+            self.bits[self.__rows[iregion],iregion] = column
+
+        # The CL-like bits each region should have
+        self.__CLbits = numpy.zeros(len(self.regions), dtype=numpy.uint32)
+        for iregion,region in enumerate(self.regions):
+            for field in region.InfoList():
+                self.__CLbits[iregion] |= self.Bit(field)
+
+    def Bit(self, field):
+        return numpy.uint32(1 << self.fields.index(field))
+
+    def Has(self, field):
+        """Boolean (model, SR) matrix, true where the field is present."""
+        return (self.bits & self.Bit(field)) != 0
+
+    def Classify(self):
+        """Returns a dictionary of category (see self.categories): boolean (model, SR) matrix."""
+
+        exists = self.Has('exists')
+        hasYield = self.Has('yield')
+        CLs = self.bits & self.__CLbits
+        anyCL = CLs != 0
+        allCLs = CLs == self.__CLbits
+
+        return {
+            'empty': exists & ~hasYield & ~anyCL,
+            'yieldless': exists & ~hasYield & anyCL,
+            'CLless': hasYield & ~anyCL,
+            'incomplete': hasYield & anyCL & ~allCLs,
+            }
+
+    def Duds(self):
+        """Boolean (model, SR) matrix of the models that should be removed from each SR."""
+
+        classes = self.Classify()
+        result = numpy.zeros(self.bits.shape, dtype=bool)
+        for category,description,remove in self.categories:
+            if remove:
+                result |= classes[category]
+        return result
+
+    def RegionMask(self, matrix, iregion):
+        """The column of a (model, SR) matrix for one SR, in the row order of that SignalRegion (eg for RemoveModels)."""
+        return matrix[self.__rows[iregion],iregion]
+
+    def Missing(self, remove=None):
+        """Boolean (model, SR) matrix of the models that are not available for an SR, but are for some other SR.
+        The models in remove (a (model, SR) matrix, eg self.Duds()) are treated as not available.
+        """
+
+        available = self.Has('exists')
+        if remove is not None:
+            available = available & ~remove
+        return available.any(axis=1)[:,numpy.newaxis] & ~available
+
+    def PrintSummary(self, verbose=False):
+        """Prints the number of models in each category of bad data for each SR,
+        and (if verbose) the lists of models.
+        """
+
+        classes = self.Classify()
+        counts = self.Has('exists').sum(axis=0)
+
+        for iregion,name in enumerate(self.names):
+            for category,description,remove in self.categories:
+                nbad = classes[category][:,iregion].sum()
+                if not nbad:
                     continue
-                elif not numCLs:
-                    # No CL values at all, ie no meaningful results
-                    CLlessmodels.append(modelID)
-                else:
-                    # Some, but not all, CL values are filled
-                    incompletemodels.append(modelID)
-            else:
-                # No evgen yields, this is a problem
-                if not numCLs:
-                    # No CL values either, ie completely empty
-                    emptymodels.append(modelID)
-                else:
-                    # At least one CL value is filled
-                    yieldlessmodels.append(modelID)
-        
-        def __PrintWarning(modellist, message, removeduds=True):
-            """Helper function to process possible warnings.
-            Bad models (in modellist) are removed from self.data unless removeduds is False.
-            """
+                print 'WARNING: %s for %i/%i models in %s'%(description,nbad,counts[iregion],name)
+                if verbose:
+                    print '\t',self.model_ids[classes[category][:,iregion]].tolist(),'\n'
+
+        # One line for all SRs with good data
+        good = [name for iregion,name in enumerate(self.names)
+                if not [category for category in classes if classes[category][:,iregion].any()]]
+        if len(good) == len(self.names):
+            print 'INFO: Checked %i SR(s) for missing data. OK'%(len(good))
+        elif good:
+            print 'INFO: No missing data in %i/%i SRs'%(len(good),len(self.names))
+
+class _ModelData:
+    """The data of one model in a SignalRegion, behaving like the dictionary
+    {'yield': yield, 'CLs': CLs, ... } that used to be stored for each model.
+    """
+
+    def __init__(self, region, modelID):
+        self.__region = region
+        self.__modelID = modelID
+
+    def keys(self):
+        return ['yield'] + self.__region.InfoList()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def has_key(self, key):
+        return key in self.keys()
+
+    def __getitem__(self, key):
+        if key not in self.keys():
+            raise KeyError(key)
+        return self.__region.GetValue(self.__modelID, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.keys():
+            raise KeyError(key)
+        self.__region.SetValue(self.__modelID, key, value)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        return [(key,self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+class _DataView:
+    """Dictionary-like view of the data of a SignalRegion, as { modelID : {'yield': yield, 'CLs': CLs, ... }, ... },
+    where each value is a _ModelData object.
+    """
+
+    def __init__(self, region):
+        self.__region = region
+
+    def keys(self):
+        return self.__region.ModelIDs()
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    __iter__ = iterkeys
+
+    def __len__(self):
+        return self.__region.NModels()
+
+    def __contains__(self, modelID):
+        return self.__region.HasModel(modelID)
+
+    def has_key(self, modelID):
+        return self.__region.HasModel(modelID)
+
+    def __getitem__(self, modelID):
+        if not self.__region.HasModel(modelID):
+            raise KeyError(modelID)
+        return _ModelData(self.__region, modelID)
+
+    def get(self, modelID, default=None):
+        try:
+            return self[modelID]
+        except KeyError:
+            return default
+
+    def values(self):
+        return [_ModelData(self.__region, modelID) for modelID in self.keys()]
 
-            # If the (bad) modellist is empty, everything is OK
-            if not modellist:
-                print 'INFO: Checked %s for %s. OK'%(self.name,message)
-                return
+    def itervalues(self):
+        return iter(self.values())
 
-            # If we get here, something is wrong
-            print 'WARNING: %s for %i/%s models in %s'%(message,len(modellist),len(self.data),self.name)
-            print '\t',modellist,'\n'
+    def items(self):
+        return [(modelID,_ModelData(self.__region, modelID)) for modelID in self.keys()]
 
-            # Remove bad models now, if requested
-            if removeduds:
-                for m in modellist: self.data.pop(m)
+    def iteritems(self):
+        return iter(self.items())
 
-        __PrintWarning(emptymodels, 'empty data')
-        __PrintWarning(yieldlessmodels, 'empty yields')
-        __PrintWarning(CLlessmodels, 'empty CL data')
-        __PrintWarning(incompletemodels, 'incomplete CL data', False) # Hope for the best and do not remove here
+    def pop(self, modelID):
+        """Removes the model, returning its data as a plain dictionary."""
 
+        datum = dict(self[modelID].items())
+        remove = numpy.zeros(self.__region.NModels(), dtype=bool)
+        remove[self.__region.Row(modelID)] = True
+        self.__region.RemoveModels(remove)
+        return datum
@@ -103,17 +103,41 @@ class SRresult:
 
 if __name__=='__main__':
 
+    import argparse
+    from SkimYieldFile import PROFILES,SkimmedFile
+    parser = argparse.ArgumentParser(
+        description="""
+           Makes plots of the pMSSM parameters for excluded and non-excluded models.""",
+        )
+    parser.add_argument(
+        "--nproc",
+        dest = "nproc",
+        type = int,
+        default = 1,
+        help = "Number of processes to use for rendering the plots")
+    parser.add_argument(
+        "--profile",
+        dest = "profile",
+        default = "full",
+        choices = sorted(PROFILES.keys()),
+        help = "Branch profile of the skimmed ntuples to read (see SkimYieldFile.py), exclusion-plots or full")
+    cmdlinearguments = parser.parse_args()
+
     import ROOT
     ROOT.gROOT.SetBatch(True)
     ROOT.gROOT.LoadMacro("AtlasStyle.C")
     ROOT.SetAtlasStyle()
     ROOT.gROOT.LoadMacro("AtlasUtils.C") 
     ROOT.gROOT.LoadMacro("AtlasLabels.C")
+    from ParallelRender import RenderPages
+    from TreeIO import OpenTree
     
-    ntuplefile = ROOT.TFile.Open('Data_Yields/SummaryNtuple_STA_evgen.root')
+    # Only the plotted variables are read, so just these are cached
+    variables = sorted(set(':'.join(SRresult.plotlist).split(':')))
+    ntuplefile = OpenTree(SkimmedFile('evgen', cmdlinearguments.profile), cachebranches=variables)
     elistfile = ROOT.TFile.Open('Data_Yields/EventLists_evgen.root')
     
-    tree = ntuplefile.Get('susy')
+    tree = ntuplefile.tree
 
     # Extract TEventList objects from elistfile
     # Also, prepare some logical combinations of them
@@ -182,11 +206,14 @@ if __name__=='__main__':
     resultdict['SR0Z'] = SRresult(eldict['SR0Z'])
     resultdict['SR0Z'].getplots(tree, 'SR0Z', resultdict['FourLep'].histograms)
 
+    # The histograms are detached from the file, so it is no longer needed
+    ntuplefile.Close()
+
     canvas = ROOT.TCanvas('can','can',800,600)
     canvas.Divide(2,2)
-    canvas.Print('ExclusionAnalysis.pdf[')
 
-    for plotname in SRresult.plotlist:
+    def DrawPage(canvas, printpage, plotname):
+        """Draws the 2x2 comparison page for one of the SRresult.plotlist variables."""
 
         drawopt = 'BOX' if ':' in plotname else ''
 
@@ -230,6 +257,9 @@ if __name__=='__main__':
         ROOT.myText(0.2,0.9,ROOT.kBlack,'4L excluded')
         ROOT.myText(0.2,0.85,ROOT.kBlue,'SR0Z')
 
-        canvas.Print('ExclusionAnalysis.pdf')
+        printpage()
 
-    canvas.Print('ExclusionAnalysis.pdf]')
+    # One page per variable, in the order of SRresult.plotlist
+    jobs = [('ExclusionAnalysis.pdf', lambda canvas,printpage,plotname=plotname: DrawPage(canvas, printpage, plotname))
+            for plotname in SRresult.plotlist]
+    RenderPages(jobs, canvas, cmdlinearguments.nproc)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""Helpers for getting TGraph contents in and out as numpy arrays, so that per-point
+arithmetic can be done in one go rather than point-by-point through PyROOT."""
+
+import numpy
+import ROOT
+
+def BufferToArray(buf, npoints, copy=True):
+    """Returns a numpy array with the npoints entries of a ROOT Double_t* buffer.
+    With copy=False, the array is a view of the buffer itself.
+    Also used for the TTree::GetV1() etc. buffers filled by TTree::Draw.
+    """
+
+    if not npoints:
+        return numpy.zeros(0)
+
+    try:
+        # Old-style PyROOT buffers do not know their own length
+        buf.SetSize(npoints)
+    except AttributeError:
+        pass
+
+    view = numpy.frombuffer(buf, dtype=numpy.float64, count=npoints)
+    if copy:
+        return numpy.array(view)
+    return view
+
+def GraphViews(graph):
+    """Returns a tuple of numpy arrays (x,y,ex,ey) sharing memory with the graph points, ie without copying.
+    The views are only valid as long as the graph is alive and not resized (eg by SetPoint),
+    and should be treated as read-only.
+    The errors are (new) zero arrays if the graph is a plain TGraph.
+    """
+
+    npoints = graph.GetN()
+    x = BufferToArray(graph.GetX(), npoints, copy=False)
+    y = BufferToArray(graph.GetY(), npoints, copy=False)
+
+    if graph.InheritsFrom('TGraphErrors'):
+        ex = BufferToArray(graph.GetEX(), npoints, copy=False)
+        ey = BufferToArray(graph.GetEY(), npoints, copy=False)
+    else:
+        ex = numpy.zeros(npoints)
+        ey = numpy.zeros(npoints)
+
+    return x,y,ex,ey
+
+def GraphArrays(graph):
+    """Returns a tuple of numpy arrays (x,y,ex,ey) with copies of the graph points.
+    The errors are zero if the graph is a plain TGraph.
+    """
+
+    return tuple([numpy.array(a) for a in GraphViews(graph)])
+
+def MakeGraph(x, y, ex=None, ey=None):
+    """Creates a graph from arrays of the point coordinates in one call.
+    The result is a TGraphErrors if either of the error arrays is given (the other defaults to zero),
+    and a TGraph otherwise.
+    """
+
+    x = numpy.ascontiguousarray(x, dtype=numpy.float64)
+    y = numpy.ascontiguousarray(y, dtype=numpy.float64)
+    npoints = len(x)
+
+    if ex is None and ey is None:
+        if not npoints:
+            return ROOT.TGraph()
+        return ROOT.TGraph(npoints, x, y)
+
+    if ex is None:
+        ex = numpy.zeros(npoints)
+    if ey is None:
+        ey = numpy.zeros(npoints)
+    ex = numpy.ascontiguousarray(ex, dtype=numpy.float64)
+    ey = numpy.ascontiguousarray(ey, dtype=numpy.float64)
+
+    if not npoints:
+        return ROOT.TGraphErrors()
+    return ROOT.TGraphErrors(npoints, x, y, ex, ey)
+
+def InterpolateLinear(graphx, graphy, x):
+    """Vectorised equivalent of TGraph::Eval for a graph with points (graphx,graphy).
+    This is a linear interpolation between the neighbouring points,
+    with linear extrapolation from the two end points outside the graph range.
+    The graph points do not need to be sorted.
+    """
+
+    x = numpy.asarray(x, dtype=numpy.float64)
+
+    npoints = len(graphx)
+    if npoints == 0:
+        return numpy.zeros(x.shape)
+    if npoints == 1:
+        return numpy.zeros(x.shape) + graphy[0]
+
+    order = numpy.argsort(graphx, kind='mergesort')
+    graphx = numpy.asarray(graphx)[order]
+    graphy = numpy.asarray(graphy)[order]
+
+    # Pick the segment for each x value, using the end segments to extrapolate
+    upper = numpy.clip(numpy.searchsorted(graphx, x, side='right'), 1, npoints-1)
+    lower = upper - 1
+
+    x0 = graphx[lower]
+    x1 = graphx[upper]
+    y0 = graphy[lower]
+    y1 = graphy[upper]
+    dx = x1 - x0
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.where(dx != 0, y0 + (x - x0)*(y1 - y0)/dx, y0)
+
+def EvalGraph(graph, x):
+    """Vectorised graph.Eval(x) for an array of x values."""
+
+    graphx,graphy = GraphViews(graph)[:2]
+    return InterpolateLinear(graphx, graphy, x)
@@ -450,6 +450,13 @@ if __name__=='__main__':
     ROOT.gSystem.Load('libSusyFitter.so')
     ROOT.gROOT.ProcessLine('#include "/ptmp/mpp/flowerde/HistFitter/src/Utils.h"') # Needed to get the Utils from HistFitter working
 
+    # The calibration function code lives in the main directory
+    import sys
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    from CalibrationFunction import MakeCalibrationFunction
+    from GraphTools import MakeGraph
+    import numpy
+
     # Read in the analyses
     datafile = open('PaperSRData.dat')
 
@@ -536,25 +543,25 @@ if __name__=='__main__':
         pprint(YieldOrder)
 
         # Store the calibration curves in TGraph objects, which can then be converted to TF1 objects
-        graphObs = ROOT.TGraph()
+        results.sort() # Just in case
+        Nsig,CLsObs,CLsExp = numpy.array(results, dtype=numpy.float64).reshape(-1,3).T
+        if doLogCLs:
+            CLsObs = numpy.log10(CLsObs)
+            CLsExp = numpy.log10(CLsExp)
+
+        graphObs = MakeGraph(CLsObs, Nsig)
         graphObs.SetName(config.SR+'_graphObs')
-        graphExp = ROOT.TGraph()
+        graphExp = MakeGraph(CLsExp, Nsig)
         graphExp.SetName(config.SR+'_graphExp')
 
-        results.sort() # Just in case
-        for Nsig,CLsObs,CLsExp in results:
-            graphObs.SetPoint(graphObs.GetN(),math.log10(CLsObs) if doLogCLs else CLsObs,Nsig)
-            graphExp.SetPoint(graphExp.GetN(),math.log10(CLsExp) if doLogCLs else CLsExp,Nsig)
-
-        # Amazingly this works!
+        # Natively evaluated p[0]*graph(x), see CalibrationFunction.C
+        # The "normalisation" defaults to 1
         if doLogCLs:
-            functionObs = ROOT.TF1(config.SR+'_Obs', lambda x,p: p[0]*graphObs.Eval(x[0]), logMin, 0, 1)
-            functionExp = ROOT.TF1(config.SR+'_Exp', lambda x,p: p[0]*graphExp.Eval(x[0]), logMin, 0, 1)
+            functionObs = MakeCalibrationFunction(graphObs, config.SR+'_Obs', logMin, 0, divide=False)
+            functionExp = MakeCalibrationFunction(graphExp, config.SR+'_Exp', logMin, 0, divide=False)
         else:
-            functionObs = ROOT.TF1(config.SR+'_Obs', lambda x,p: p[0]*graphObs.Eval(x[0]), 0, 1, 1)
-            functionExp = ROOT.TF1(config.SR+'_Exp', lambda x,p: p[0]*graphExp.Eval(x[0]), 0, 1, 1)
-        functionObs.SetParameter(0,1) # Default "normalisation"
-        functionExp.SetParameter(0,1) # Default "normalisation"
+            functionObs = MakeCalibrationFunction(graphObs, config.SR+'_Obs', 0, 1, divide=False)
+            functionExp = MakeCalibrationFunction(graphExp, config.SR+'_Exp', 0, 1, divide=False)
 
         # Make sure we write both the graph and the function to the output file
         thingsToWrite.append(graphObs.Clone())
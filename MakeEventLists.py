@@ -7,9 +7,43 @@ A) Models excluded by a particular SR (for making plots of excluded models)
 B) A random separation of the 500 models into two groups. One is for making new calibration curves (=> output in the format of D3PDs.txt), and the other is for applying this modified calibration as a consistency check (=> output as a TEventList).
 """
 
+import numpy
 import ROOT
 ROOT.gRandom.SetSeed(1)
 
+from ColumnCache import OpenColumns,ReadColumns
+from TreeIO import OpenTree
+from SkimYieldFile import PROFILES,SkimmedFile
+
+import argparse
+parser = argparse.ArgumentParser(
+    description="""
+       Makes event lists of the excluded models, and splits the simulated models into two samples.""",
+    )
+parser.add_argument(
+    "--profile",
+    dest = "profile",
+    default = "full",
+    choices = sorted(PROFILES.keys()),
+    help = "Branch profile of the skimmed ntuples to read (see SkimYieldFile.py), any profile will do")
+cmdlinearguments = parser.parse_args()
+
+def ModelNames(filename):
+    """The modelName of every entry in the ntuple, in entry order.
+    They come from the exported columns if there are any (see ColumnCache.py),
+    otherwise they are read from the tree in one go."""
+
+    columns = OpenColumns(filename)
+    if columns is not None and 'modelName' in columns:
+        return numpy.asarray(columns['modelName'], dtype=numpy.int64)
+
+    infile = OpenTree(filename, branches=['modelName'])
+    intree = infile.tree
+    modelNames = ReadColumns(intree, 'modelName', 0, intree.GetEntries())[0].astype(numpy.int64)
+    infile.Close()
+
+    return modelNames
+
 from glob import glob
 SRfilenames = glob('results/smallest_officialMC_bestExpected/perSRresults/*.txt')
 modeldict = {}
@@ -21,39 +55,27 @@ for fname in SRfilenames:
         modeldict[SRname].add(int(line))
     SRfile.close()
 
-infile = ROOT.TFile.Open('Data_Yields/SummaryNtuple_STA_evgen.root')
-intree = infile.Get('susy')
-intree.SetBranchStatus('*',0)
-intree.SetBranchStatus('modelName',1)
+modelNames = ModelNames(SkimmedFile('evgen', cmdlinearguments.profile))
+print 'Read',len(modelNames),'models'
 
 eventlists = {
     }
 
-for ientry,entry in enumerate(intree):
-
-    if ientry%10000 == 0:
-        print 'Model',ientry
-    modelName = entry.modelName
-    for SRname,modellist in modeldict.items():
-        if modelName in modellist:
-            try:
-                eventlists[SRname].Enter(ientry)
-            except KeyError:
-                eventlists[SRname] = ROOT.TEventList('elist_'+SRname)
-                eventlists[SRname].Enter(ientry)
-            continue
+for SRname,modellist in modeldict.items():
+    # The entries of the models in the list, in entry order
+    entries = numpy.flatnonzero(numpy.in1d(modelNames, list(modellist)))
+    if not len(entries):
+        continue
+    eventlists[SRname] = ROOT.TEventList('elist_'+SRname)
+    for ientry in entries:
+        eventlists[SRname].Enter(int(ientry))
 
 outfile = ROOT.TFile.Open('Data_Yields/EventLists_evgen.root', 'RECREATE')
 for elist in eventlists.values():
     elist.Write()
 outfile.Close()
 
-infile.Close()
-
-infile = ROOT.TFile.Open('Data_Yields/SummaryNtuple_STA_sim.root')
-intree = infile.Get('susy')
-intree.SetBranchStatus('*',0)
-intree.SetBranchStatus('modelName',1)
+modelNames = ModelNames(SkimmedFile('sim', cmdlinearguments.profile))
 
 eventlists = {
     'TestCalib': ROOT.TEventList('elist_TestCalib'), # Just for checking
@@ -62,11 +84,11 @@ eventlists = {
 TestCalibModels = [] # Used later to create a text file of dataset names
 TestSampleModels = []
 
-for ientry,entry in enumerate(intree):
+for ientry,modelName in enumerate(modelNames):
 
     if ientry%10000 == 0:
         print 'Model',ientry
-    modelName = entry.modelName
+    modelName = int(modelName)
     if ROOT.gRandom.Rndm() > 0.5:
         eventlists['TestCalib'].Enter(ientry)
         TestCalibModels.append(modelName)
@@ -106,5 +128,3 @@ outfile = ROOT.TFile.Open('Data_Yields/EventLists_sim.root', 'RECREATE')
 for elist in eventlists.values():
     elist.Write()
 outfile.Close()
-
-infile.Close()
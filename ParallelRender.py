@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+"""Renders (multi-page) pdf files, optionally spreading the pages over several processes.
+
+The plotting code describes its output as a list of jobs (target, drawfunc) or
+(target, drawfunc, fingerprint), where drawfunc(canvas, printpage) draws one or more
+pages on the canvas, calling printpage() after each one. The pages of all jobs with
+the same target end up in that file, in the order of the job list, whether they are
+rendered here or in worker processes.
+
+Batch-mode ROOT only uses one core, so with nproc > 1 the jobs are rendered by forked
+worker processes, each into its own pdf file, and these are then merged with pdfunite
+or ghostscript. The workers inherit the job list and canvas from the parent process,
+so drawfunc can use any objects already in memory. It must not read from an open TFile
+though, as the file position would be shared between the processes, so read everything
+that is needed before calling RenderPages.
+If no merging tool is available, the jobs are rendered serially as before.
+
+If a job has a fingerprint (see Fingerprint), its pages are kept in a .plotcache
+directory next to the target, and a manifest of the fingerprints is written alongside
+the target (as target+'.manifest.json'). A target whose fingerprints are unchanged is
+not touched at all, and only the jobs with new fingerprints are rendered again.
+The fingerprint should therefore cover everything that goes into the pages;
+STYLE_VERSION is included automatically, to catch changes to the plotting code itself.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import ROOT
+
+# Bump this whenever the appearance of the cached plots changes,
+# ie the plotting code rather than the data being plotted
+STYLE_VERSION = 1
+
+# Where the pages of jobs with a fingerprint are kept, relative to their target
+CACHEDIR = '.plotcache'
+
+# State for the worker processes, set just before they are forked (see RenderPages)
+_jobs = None
+_canvas = None
+_jobfiles = None
+
+def LoadAtlasStyle():
+    """Loads the ATLAS style macros (only the first time), and sets the style.
+    The macros are the ones in the working directory, as in the main scripts."""
+
+    ROOT.gROOT.SetBatch(True)
+    if not hasattr(ROOT, 'SetAtlasStyle'):
+        ROOT.gROOT.LoadMacro("AtlasStyle.C")
+        ROOT.gROOT.LoadMacro("AtlasUtils.C")
+        ROOT.gROOT.LoadMacro("AtlasLabels.C")
+        if os.path.exists("ExtraAtlasUtils.C"):
+            ROOT.gROOT.LoadMacro("ExtraAtlasUtils.C")
+    ROOT.SetAtlasStyle()
+
+def Fingerprint(*items):
+    """Returns a hash of the items, for use as a job fingerprint.
+    Items can be anything with a stable repr, numpy arrays, or ROOT histograms and graphs
+    (in which case their contents, errors and titles are used).
+    """
+
+    import numpy
+
+    sha = hashlib.sha1()
+    sha.update(repr(STYLE_VERSION))
+
+    for item in items:
+        if isinstance(item, numpy.ndarray):
+            sha.update(repr((item.dtype.str,item.shape)))
+            sha.update(numpy.ascontiguousarray(item).tobytes())
+        elif isinstance(item, ROOT.TH1):
+            sha.update(repr((item.ClassName(), item.GetName(), item.GetTitle(),
+                             item.GetXaxis().GetTitle(), item.GetYaxis().GetTitle(),
+                             item.GetXaxis().GetXmin(), item.GetXaxis().GetXmax(),
+                             [item.GetBinContent(i) for i in range(item.GetSize())],
+                             [item.GetBinError(i) for i in range(item.GetSize())])))
+        elif isinstance(item, ROOT.TGraph):
+            from GraphTools import GraphViews
+            sha.update(repr((item.ClassName(), item.GetName(), item.GetTitle())))
+            for array in GraphViews(item):
+                sha.update(numpy.ascontiguousarray(array).tobytes())
+        else:
+            sha.update(repr(item))
+
+    return sha.hexdigest()
+
+def RenderPages(jobs, canvas, nproc=1):
+    """Renders the list of jobs, see the module documentation.
+    The canvas is used directly when rendering in this process, and copied into the worker processes otherwise.
+    """
+
+    # Targets in order of appearance, with their jobs
+    targets = []
+    targetjobs = {}
+    for job in jobs:
+        if job[0] not in targetjobs:
+            targets.append(job[0])
+            targetjobs[job[0]] = []
+        targetjobs[job[0]].append(job)
+
+    # Leave alone any targets that are already up to date
+    unchanged = [target for target in targets if _IsUpToDate(target, targetjobs[target])]
+    if unchanged:
+        print 'INFO: %i/%i plot files are unchanged'%(len(unchanged),len(targets))
+    targets = [target for target in targets if target not in unchanged]
+    jobs = [job for job in jobs if job[0] in targets]
+
+    if not jobs:
+        return
+
+    usecache = len([job for job in jobs if _JobFingerprint(job)]) > 0
+    mergecommand = _MergeCommand()
+    if (nproc > 1 or usecache) and mergecommand is None:
+        print 'WARNING in ParallelRender: neither pdfunite nor gs found, rendering the plots serially'
+
+    if mergecommand is None or (nproc <= 1 and not usecache):
+        _RenderSerial(jobs, canvas)
+        for target in targets:
+            _WriteManifest(target, targetjobs[target])
+        return
+
+    global _jobs,_canvas,_jobfiles
+    tmpdir = tempfile.mkdtemp(prefix='ParallelRender_')
+
+    # Each job goes to its own file, in the cache if it has a fingerprint
+    jobfiles = []
+    torender = []
+    for ijob,job in enumerate(jobs):
+        fingerprint = _JobFingerprint(job)
+        if fingerprint:
+            jobfile = _CacheFileName(job[0], fingerprint)
+            if not os.path.exists(jobfile):
+                torender.append(ijob)
+        else:
+            jobfile = os.path.join(tmpdir, 'job%05i.pdf'%(ijob))
+            torender.append(ijob)
+        jobfiles.append(jobfile)
+
+    _jobs = jobs
+    _canvas = canvas
+    _jobfiles = jobfiles
+
+    try:
+        if len(torender) < len(jobs):
+            print 'INFO: Reusing %i/%i cached plot jobs'%(len(jobs)-len(torender),len(jobs))
+
+        if nproc > 1 and len(torender) > 1:
+            import multiprocessing
+            nworkers = min(nproc, len(torender))
+            print 'INFO: Rendering %i plot jobs using %i processes'%(len(torender),nworkers)
+            pool = multiprocessing.Pool(nworkers, initializer=LoadAtlasStyle)
+            try:
+                pool.map(_RenderJob, torender, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for ijob in torender:
+                _RenderJob(ijob)
+
+        # Merge the files for each target, in the original order
+        failed = []
+        for target in targets:
+            filenames = [jobfiles[ijob] for ijob,job in enumerate(jobs) if job[0] == target]
+            # Jobs without any pages do not make a valid pdf
+            filenames = [filename for filename in filenames if os.path.getsize(filename)]
+            if not filenames:
+                continue
+            if _MergeFiles(mergecommand, filenames, target):
+                _WriteManifest(target, targetjobs[target])
+            else:
+                failed.append(target)
+
+        for target in targets:
+            _PruneCache(target, targetjobs[target])
+
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        _jobs = None
+        _canvas = None
+        _jobfiles = None
+
+    if failed:
+        print 'WARNING in ParallelRender: rendering %s serially instead'%(', '.join(failed))
+        _RenderSerial([job for job in jobs if job[0] in failed], canvas)
+
+def _RenderSerial(jobs, canvas):
+    """Renders the jobs on the canvas in this process, straight into the targets."""
+
+    # Open all files first, as the jobs for different targets may be interleaved
+    targets = []
+    for job in jobs:
+        if job[0] not in targets:
+            targets.append(job[0])
+            canvas.Print(job[0]+'[')
+
+    for job in jobs:
+        job[1](canvas, lambda: canvas.Print(job[0]))
+
+    for target in targets:
+        canvas.Print(target+']')
+
+def _RenderJob(ijob):
+    """Renders one job into its own file (see RenderPages).
+    Also the entry point of the worker processes.
+    Jobs without any pages leave an empty file.
+    """
+
+    drawfunc = _jobs[ijob][1]
+    filename = _jobfiles[ijob]
+
+    # Write to a temporary name first, so an interrupted job does not leave a broken cache file
+    tmpname = filename+'.tmp.pdf'
+
+    npages = [0]
+    def printpage():
+        if not npages[0]:
+            _canvas.Print(tmpname+'[')
+        _canvas.Print(tmpname)
+        npages[0] += 1
+
+    drawfunc(_canvas, printpage)
+
+    if npages[0]:
+        _canvas.Print(tmpname+']')
+        os.rename(tmpname, filename)
+    else:
+        open(filename, 'w').close()
+
+def _JobFingerprint(job):
+    if len(job) > 2:
+        return job[2]
+    return None
+
+def _CacheFileName(target, fingerprint):
+    dirname,basename = os.path.split(target)
+    cachedir = os.path.join(dirname, CACHEDIR)
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    return os.path.join(cachedir, '%s.%s.pdf'%(basename,fingerprint))
+
+def _ManifestName(target):
+    return target+'.manifest.json'
+
+def _Manifest(jobs):
+    """The manifest contents for a target with these jobs, or None if they are not all fingerprinted."""
+
+    fingerprints = [_JobFingerprint(job) for job in jobs]
+    if None in fingerprints:
+        return None
+    return {'style': STYLE_VERSION, 'pages': fingerprints}
+
+def _IsUpToDate(target, jobs):
+
+    manifest = _Manifest(jobs)
+    if manifest is None or not os.path.exists(target):
+        return False
+
+    try:
+        with open(_ManifestName(target)) as manifestfile:
+            return json.load(manifestfile) == manifest
+    except (IOError, ValueError):
+        return False
+
+def _WriteManifest(target, jobs):
+    """Records the fingerprints used for target, or removes an old manifest if there are none."""
+
+    manifest = _Manifest(jobs)
+    if manifest is None:
+        if os.path.exists(_ManifestName(target)):
+            os.remove(_ManifestName(target))
+        return
+
+    with open(_ManifestName(target), 'w') as manifestfile:
+        json.dump(manifest, manifestfile)
+
+def _PruneCache(target, jobs):
+    """Removes cached pages of target that are no longer used."""
+
+    dirname,basename = os.path.split(target)
+    cachedir = os.path.join(dirname, CACHEDIR)
+    if not os.path.isdir(cachedir):
+        return
+
+    keep = set(['%s.%s.pdf'%(basename,_JobFingerprint(job)) for job in jobs if _JobFingerprint(job)])
+    for filename in os.listdir(cachedir):
+        # The fingerprint is a hex string, so this cannot match other targets with the same prefix
+        if not filename.startswith(basename+'.') or filename in keep:
+            continue
+        if len(filename) == len(basename) + 45: # basename.<40 hex digits>.pdf
+            os.remove(os.path.join(cachedir, filename))
+
+def _MergeCommand():
+    """Returns the command (as a list) to merge pdf files, or None if there is no suitable tool.
+    Where the output and input files go depends on the tool, which is handled by _MergeFiles."""
+
+    from distutils.spawn import find_executable
+
+    if find_executable('pdfunite'):
+        return ['pdfunite']
+    if find_executable('gs'):
+        return ['gs', '-q', '-dBATCH', '-dNOPAUSE', '-sDEVICE=pdfwrite', '-sOutputFile=%s']
+    return None
+
+def _MergeFiles(command, filenames, target):
+    """Merges the pdf files into target, returning True on success.
+    The input files are left in place, as they may be cached.
+    """
+
+    if len(filenames) == 1:
+        shutil.copyfile(filenames[0], target)
+        return True
+
+    if command[0] == 'pdfunite':
+        fullcommand = command + filenames + [target]
+    else:
+        fullcommand = command[:-1] + [command[-1]%(target)] + filenames
+
+    try:
+        subprocess.check_call(fullcommand)
+    except (OSError, subprocess.CalledProcessError) as error:
+        print 'ERROR in ParallelRender: could not merge pages into %s: %s'%(target,error)
+        return False
+
+    return True
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import ROOT,math
+import numpy
 
 class CLsData:
     """Simple class to keep all of the CLs values together"""
@@ -108,19 +109,20 @@ class ProductCheck:
             SRindices = [idx for idx,SR in enumerate(self.__SRorder) if SR in allowedSRs]
 
             data = []
-            
-            for modelID,info in CombData.data.items():
-
-                result = CLsData(math.pow(10, info['LogCLs']))
-
-                for index in SRindices:
-                    try:
-                        SRdata = self.__perSRdata[index]
-                        CLs = math.pow(10, SRdata.data[modelID]['LogCLs'])
-                        result.SRCLs[SRdata.name] = CLs
-                    except KeyError:
-                        # May have no results in that model for that SR
-                        pass
+
+            # Work on whole columns: the combined CLs of each model, and the per-SR CLs of the same models
+            # The latter are NaN where a model has no results for that SR
+            combinedCLs = numpy.power(10, CombData.Column('LogCLs'))
+            SRCLs = [(self.__perSRdata[index].name, numpy.power(10, self.__perSRdata[index].Lookup(CombData.model_ids, 'LogCLs')))
+                     for index in SRindices]
+
+            for imodel in range(CombData.NModels()):
+
+                result = CLsData(float(combinedCLs[imodel]))
+
+                for SRname,CLs in SRCLs:
+                    if not numpy.isnan(CLs[imodel]):
+                        result.SRCLs[SRname] = float(CLs[imodel])
 
                 result.ComputeProduct()
                 data.append(result)
@@ -4,9 +4,75 @@ from glob import glob
 import math
 from DataObject import SignalRegion
 from ValueWithError import valueWithError
+from CalibrationFunction import MakeCalibrationFunction,EvalCalibrationFunction
+from GraphTools import GraphViews,MakeGraph
+from ColumnCache import OpenColumns
+from TreeIO import OpenTree
+import numpy
 import ROOT
 ROOT.gROOT.SetBatch(True)
 
+class HistFitterCurves:
+    """Registry of the HistFitter calibration curves, ie the <SR>_graphObs and <SR>_graphExp
+    graphs made by HistFitter/HistFitterLoop.py.
+    All graphs are read in one pass when the object is created, after which the file is closed.
+    The graphs stay in memory, and the same graph objects are handed to every caller.
+    """
+
+    def __init__(self, filename):
+
+        self.__filename = filename
+        self.__graphs = {} # shortSRname: {'Obs': TGraph, 'Exp': TGraph}
+        self.__missing = [] # SRs requested via GetGraphs, but not found in the file
+        self.__isopen = self.__ReadGraphs()
+
+    def __ReadGraphs(self):
+        """Reads all graphs from the file, returning False if it cannot be opened."""
+
+        funcfile = ROOT.TFile.Open(self.__filename)
+        if not funcfile or funcfile.IsZombie():
+            print 'ERROR in Reader_DMSTA: could not open HistFitter file %s'%(self.__filename)
+            return False
+
+        for key in funcfile.GetListOfKeys():
+
+            keyname = key.GetName()
+            for CLtype in ['Obs','Exp']:
+                suffix = '_graph'+CLtype
+                if not keyname.endswith(suffix):
+                    continue
+                # TGraphs are not owned by the file, so they survive it being closed
+                graph = funcfile.Get(keyname)
+                self.__graphs.setdefault(keyname[:-len(suffix)], {})[CLtype] = graph
+
+        funcfile.Close()
+
+        print 'INFO: Reader_DMSTA read HistFitter curves for %i SRs from %s'%(len(self.__graphs),self.__filename)
+        return True
+
+    def IsOpen(self):
+        """True if the HistFitter file could be read."""
+        return self.__isopen
+
+    def GetGraphs(self, shortSRname):
+        """Returns a tuple of the (observed,expected) graphs for the SR,
+        or None if either is missing."""
+
+        graphs = self.__graphs.get(shortSRname, {})
+        try:
+            return graphs['Obs'],graphs['Exp']
+        except KeyError:
+            if shortSRname not in self.__missing:
+                self.__missing.append(shortSRname)
+            return None
+
+    def ReportMissing(self):
+        """Print a one-line summary of SRs with no calibration curve, and reset the list."""
+
+        if self.__missing:
+            print 'WARNING in Reader_DMSTA: no HistFitter curves for %i SRs: %s'%(len(self.__missing),', '.join(sorted(self.__missing)))
+        self.__missing = []
+
 class DMSTAReader:
     """Similar to the dummy reader, but reads truth yields from an ntuple and CL values from text files."""
 
@@ -29,10 +95,17 @@ class DMSTAReader:
         # 'EwkThreeLepton_3L_SR0a_16': [254649], # Possible outlier with log(CLs) ~ -1.3
         }
     
+    # The systematic variations of the fits understood by ReadFiles (see __SetupFitFunc)
+    systematics = ['Lin', 'Quad', '2L', 'LinAll', 'QuadAll']
+
+    # Bump this if the cached format (see self.__WriteCache) changes
+    cacheversion = 3
+
     # Gah, way too many arguments - could fix with slots if I have time
     def __init__(self, yieldfile='Data_Yields/SummaryNtuple_STA_sim.root',
                  dirprefix='Data_', fileprefix='pMSSM_STA_table_EWK_', filesuffix='.dat',
-                 DSlist='Data_Yields/D3PDs.txt', HFfile='HistFitter/CLsFunctions_logCLs.root'):
+                 DSlist='Data_Yields/D3PDs.txt', HFfile='HistFitter/CLsFunctions_logCLs.root',
+                 cachedir='Data_Yields/ReaderCache'):
         """
         Set up to read input files from several directories.
         The yield ntuple path is stated explicitly, as is the DS list (for mapping the model ID to the DS ID).
@@ -52,6 +125,10 @@ class DMSTAReader:
 
         The HFfile describes where the HistFitter calibration functions are to be found.
         If set to None, '', etc, then no fit function will be associated with the objects.
+
+        The result of ReadFiles is cached (as a pickle file) in cachedir, keyed by a hash
+        of the input file names, sizes and modification times, as well as the reader options.
+        Set cachedir to None, '', etc to always read the input files from scratch.
         """
         
         self.__yieldfile = yieldfile
@@ -60,17 +137,34 @@ class DMSTAReader:
         self.__filesuffix = filesuffix
         self.__dslist = DSlist
         self.__hffile = HFfile
+        self.__cachedir = cachedir
+        self.__hfcurves = None # HistFitterCurves object, created when first needed
+        self.__filehashes = {} # Content hashes of the CL files, see self.__FileHash
         self.DSIDdict = {} # Formed from the DSlist in a bit
         
     def ReadFiles(self, officialMC=True, systematic=None):
         """Returns a list of SignalRegion objects, as required by the CorrelationPlotter.
         The flag sets whether the truth yields are taken from the official MC (default)
         or the original private evgen.
-        The third argument can be used to try systematic variations of the fits.
+        The third argument can be used to try systematic variations of the fits (one of self.systematics).
+        Each SignalRegion also gets a MakeFitFunctions(systematic) method,
+        so the fit functions for other variations can be made without reading everything again.
         """
 
         self.systematic = systematic
 
+        # Reading everything takes a while, so first see if we did this already
+        cachekey = self.__CacheKey(officialMC)
+        result = self.__ReadCache(cachekey)
+        if result is not None:
+            # The fit functions are not cached, so attach them now
+            for SRobj in result:
+                self.__SetupFitFunc(SRobj)
+                SRobj.inputhash = self.__InputHash(SRobj)
+            self.__ReportMissingCurves()
+            print
+            return result
+
         # This is what we want to return
         result = []
 
@@ -88,11 +182,126 @@ class DMSTAReader:
         # Then add the yields
         result = self.ReadYields(result, officialMC)
 
+        # Summarise the inputs of each SR, so that the calibration can be redone only where they change
+        for SRobj in result:
+            SRobj.inputhash = self.__InputHash(SRobj)
+
+        # Save the result for next time
+        self.__WriteCache(cachekey, result)
+
+        self.__ReportMissingCurves()
+
         # Keep warning/info messages from different sources separate
         print
 
         return result
 
+    def __ReportMissingCurves(self):
+        if self.__hfcurves is not None:
+            self.__hfcurves.ReportMissing()
+
+    def __CacheKey(self, officialMC):
+        """Returns a string that uniquely identifies the inputs to ReadFiles,
+        or None if caching is disabled.
+        Files are identified by their path, size and modification time,
+        so any edit to an input file results in a new key.
+        """
+
+        if not self.__cachedir:
+            return None
+
+        import os,hashlib
+
+        def FileID(fname):
+            if not fname or not os.path.exists(fname):
+                return (fname,None,None)
+            filestat = os.stat(fname)
+            return (fname,filestat.st_size,filestat.st_mtime)
+
+        infiles = [self.__yieldfile, self.__dslist]
+        for analysis in sorted(self.analysisdict.keys()):
+            infiles.extend(sorted(self.__FindCLFiles(analysis)[1]))
+
+        keyitems = [
+            self.cacheversion,
+            [FileID(fname) for fname in infiles],
+            officialMC,
+            self.systematic,
+            sorted(self.analysisdict.items()),
+            sorted(self.vetodata.items()),
+            ]
+
+        return hashlib.sha1(repr(keyitems)).hexdigest()
+
+    def __CacheFileName(self, cachekey):
+        return '/'.join([self.__cachedir,'ReadFiles_%s.pickle'%(cachekey)])
+
+    def __ReadCache(self, cachekey):
+        """Returns the list of SignalRegion objects stored under cachekey,
+        or None if there is no (usable) cached result.
+        """
+
+        if cachekey is None:
+            return None
+
+        import os,cPickle
+        cachename = self.__CacheFileName(cachekey)
+        if not os.path.exists(cachename):
+            return None
+
+        try:
+            cachefile = open(cachename, 'rb')
+            cached = cPickle.load(cachefile)
+            cachefile.close()
+        except Exception as e:
+            print 'WARNING in Reader_DMSTA: could not read cache file %s (%s), reading inputs instead'%(cachename,e)
+            return None
+
+        self.DSIDdict = cached['DSIDdict']
+
+        result = []
+        for name,branchname,infolist,(modelIDs,columns),inputfiles in cached['regions']:
+            obj = SignalRegion(name, infolist)
+            obj.SetColumnData(modelIDs, columns)
+            obj.inputfiles = inputfiles
+            if branchname is not None:
+                obj.branchname = branchname
+            result.append(obj)
+
+        print 'INFO: Reader_DMSTA read %i SRs from cache file %s'%(len(result),cachename)
+        return result
+
+    def __WriteCache(self, cachekey, data):
+        """Stores the data (a list of SignalRegion objects) under cachekey.
+        Only the model data are stored, as the fit functions cannot be pickled.
+        """
+
+        if cachekey is None:
+            return
+
+        import os,cPickle
+        if not os.path.exists(self.__cachedir):
+            os.makedirs(self.__cachedir)
+
+        cached = {
+            'DSIDdict': self.DSIDdict,
+            'regions': [(obj.name, getattr(obj,'branchname',None), obj.InfoList(), obj.ColumnData(), obj.inputfiles) for obj in data],
+            }
+
+        cachename = self.__CacheFileName(cachekey)
+        try:
+            # Write to a temporary file first, so that an interrupted job
+            # cannot leave a truncated cache file behind
+            cachefile = open(cachename+'.tmp', 'wb')
+            cPickle.dump(cached, cachefile, cPickle.HIGHEST_PROTOCOL)
+            cachefile.close()
+            os.rename(cachename+'.tmp', cachename)
+        except (IOError,OSError) as e:
+            print 'WARNING in Reader_DMSTA: could not write cache file %s (%s)'%(cachename,e)
+            return
+
+        print 'INFO: Reader_DMSTA wrote cache file %s'%(cachename)
+
     def __ReadDSIDs(self):
         """Map the model number to the ATLAS dataset ID.
         The information from self.__dslist is stored in self.DSIDdict
@@ -139,25 +348,26 @@ class DMSTAReader:
             
         # Keep warning/info messages from different sources separate
         print
+
+        branchprefix = 'EWOff' if officialMC else 'EW'
+
+        # Use the exported columns if there are any (see ColumnCache.py)
+        columns = OpenColumns(self.__yieldfile)
+        if columns is not None and self.__ReadYieldColumns(data, columns, branchprefix):
+            return data
             
         # Open up the ROOT ntuple with the yields and iterate over the entries
         # looking for relevant models
-        yieldfile = ROOT.TFile.Open(self.__yieldfile)
+        # Quick & dirty optimisation of what to read, as the tree is big
+        yieldtree = OpenTree(self.__yieldfile,
+                             branches = ['modelName']+['*%s*'%(analysis) for analysis in self.analysisdict.values()])
 
-        if not yieldfile:
+        if not yieldtree:
             print 'ERROR: ROOT file %s not found'%(self.__yieldfile)
             # If I were doing this properly, I'd probably raise an exception
             return result
         
-        tree = yieldfile.Get('susy')
-
-        branchprefix = 'EWOff' if officialMC else 'EW'
-
-        # Quick & dirty optimisation of what to read, as the tree is big
-        tree.SetBranchStatus('*', 0)
-        tree.SetBranchStatus('modelName', 1)
-        for analysis in self.analysisdict.values():
-            tree.SetBranchStatus('*%s*'%(analysis), 1)
+        tree = yieldtree.tree
 
         print 'INFO: Reader_DMSTA looping over %s entries'%(tree.GetEntries())
         filledYields = 0
@@ -196,41 +406,95 @@ class DMSTAReader:
                 trutherror = getattr(entry, '_'.join([branchprefix,'ExpectedError',datum.branchname]))
 
                 try:
-                    datum.data[DSID]['yield'] = valueWithError(truthyield,trutherror)
+                    datum.SetValue(DSID, 'yield', valueWithError(truthyield,trutherror))
                     filledYields += 1
 
                 except KeyError:
                     # FIXME: Should check if the model is in DSIDdict and the yield is high and print a warning if it's not in data
                     pass
 
+        yieldtree.Close()
+
         print 'Filled %i entries with yields'%(filledYields)
         return data
     
-    def ReadCLValues(self, data, analysis):
-        """For the given analysis, add the CL values to the data.
+    def __ReadYieldColumns(self, data, columns, branchprefix):
+        """As ReadYields, but from the columns exported from the ntuple (a ColumnCache).
+        Returns False (without filling anything) if a column is missing, True otherwise.
+        """
+
+        branchnames = {}
+        for datum in data:
+            branchnames[datum.name] = ['_'.join([branchprefix,'ExpectedEvents',datum.branchname]),
+                                       '_'.join([branchprefix,'ExpectedError',datum.branchname])]
+            if 'modelName' not in columns or not all([name in columns for name in branchnames[datum.name]]):
+                return False
+
+        print 'INFO: Reader_DMSTA reading %s entries from %s'%(columns.nentries,columns.directory)
+
+        # Only the entries of the known models are interesting
+        modelIDs = numpy.asarray(columns['modelName'])
+        entries = numpy.flatnonzero(numpy.in1d(modelIDs, self.DSIDdict.keys()))
+        DSIDs = [self.DSIDdict[int(modelID)] for modelID in modelIDs[entries]]
+        filledYields = 0
+
+        for datum in data:
+
+            # Killing the yield info is enough: we don't need to remove the CL values
+            veto = self.vetodata.get(datum.name, [])
+
+            yieldname,errorname = branchnames[datum.name]
+            truthyields = numpy.asarray(columns[yieldname][entries], dtype=numpy.float64)
+            trutherrors = numpy.asarray(columns[errorname][entries], dtype=numpy.float64)
+
+            for DSID,truthyield,trutherror in zip(DSIDs,truthyields,trutherrors):
+
+                if DSID in veto:
+                    continue
+
+                try:
+                    datum.SetValue(DSID, 'yield', valueWithError(float(truthyield),float(trutherror)))
+                    filledYields += 1
+
+                except KeyError:
+                    pass
+
+        print 'Filled %i entries with yields'%(filledYields)
+        return True
+
+    def __FindCLFiles(self, analysis):
+        """Find the CL input files for the given analysis.
+        Returns a tuple of (searchstring,filelist,isPmssmFormat).
         """
 
-        # Find the input files
         # Try the traditional pMSSM paper format first
         firstbit = self.__dirprefix+analysis+'/'+self.__fileprefix+analysis+'_'
         searchstring = firstbit+'*'+self.__filesuffix
         infiles = glob(searchstring)
-
         if infiles:
+            return searchstring,infiles,True
+
+        # Oh dear, maybe these are YAML files
+        searchstring = '/'.join([self.__dirprefix+analysis,'*.yaml'])
+        return searchstring,glob(searchstring),False
+
+    def ReadCLValues(self, data, analysis):
+        """For the given analysis, add the CL values to the data.
+        """
+
+        # Find the input files
+        searchstring,infiles,isPmssmFormat = self.__FindCLFiles(analysis)
+        print 'INFO: Reader_DMSTA found %i matches to %s'%(len(infiles),searchstring)
+
+        if isPmssmFormat:
             
-            print 'INFO: Reader_DMSTA found %i matches to %s'%(len(infiles),searchstring)
+            firstbit = self.__dirprefix+analysis+'/'+self.__fileprefix+analysis+'_'
             for fname in infiles:
                 SRname = self.NtupleSRname(fname.replace(firstbit,'').replace(self.__filesuffix,''), analysis)
                 data = self.__ReadPmssmFiles(data, analysis, fname, SRname)
 
         else:
 
-            # Oh dear, maybe these are YAML files
-            firstbit = self.__dirprefix+analysis
-            searchstring = '/'.join([firstbit,'*.yaml'])
-            infiles = glob(searchstring)
-
-            print 'INFO: Reader_DMSTA found %i matches to %s'%(len(infiles),searchstring)
             for fname in infiles:
                 modelname = int(fname.split('/')[-1].split('.')[0])
                 try:
@@ -271,9 +535,14 @@ class DMSTAReader:
 
                 # Store the equivalent ntuple branch name for convenience later
                 obj.branchname = '_'.join([self.analysisdict[analysis],self.NtupleSRname(SRname,analysis)])
+                obj.inputfiles = {}
 
                 self.__SetupFitFunc(obj)
 
+            # Record where the data for this SR came from
+            if fname not in obj.inputfiles:
+                obj.inputfiles[fname] = self.__FileHash(fname)
+
             # The data is stored as a list, use ast to read it
             import ast
             numericdata = ast.literal_eval(''.join(splitline[1:]))
@@ -320,6 +589,8 @@ class DMSTAReader:
 
             # Store the equivalent ntuple branch name for convenience later
             obj.branchname = '_'.join([self.analysisdict[analysis],self.NtupleSRname(SRname,analysis)])
+            # Record where the data for this SR came from
+            obj.inputfiles = {fname: self.__FileHash(fname)}
         else:
             print 'WARNING in Reader_DMSTA: already read-in file for %s'%(analysisSR)
             return data
@@ -380,6 +651,54 @@ class DMSTAReader:
         
         return data
     
+    def __FileHash(self, fname):
+        """Returns the sha1 hash of the file contents, remembering it for next time."""
+
+        try:
+            return self.__filehashes[fname]
+        except KeyError:
+            pass
+
+        import hashlib
+        infile = open(fname, 'rb')
+        self.__filehashes[fname] = hashlib.sha1(infile.read()).hexdigest()
+        infile.close()
+        return self.__filehashes[fname]
+
+    @classmethod
+    def __CurveHash(cls, graphs):
+        """Returns a hash of the points of the HistFitter (observed,expected) graphs."""
+
+        import hashlib
+        sha = hashlib.sha1()
+        for graph in graphs:
+            for array in GraphViews(graph):
+                sha.update(numpy.ascontiguousarray(array).tobytes())
+        return sha.hexdigest()
+
+    def __InputHash(self, SRobj):
+        """Returns a hash of everything read in for this SR that goes into its calibration,
+        ie the CL values and yields (so the relevant parts of the CL tables and yield ntuple),
+        and the HistFitter curves.
+        The data themselves are used rather than the input files, as the yield ntuple is shared by all SRs.
+        The CL tables for each SR (and their hashes) are recorded separately, in SRobj.inputfiles.
+        """
+
+        import hashlib
+
+        # Independent of the order in which the models were read
+        modelIDs,columns = SRobj.ColumnData()
+        order = sorted(range(len(modelIDs)), key=modelIDs.__getitem__)
+
+        sha = hashlib.sha1()
+        sha.update(repr([modelIDs[row] for row in order]))
+        for field in sorted(columns.keys()):
+            sha.update(field)
+            sha.update(numpy.ascontiguousarray(columns[field][order]).tobytes())
+        sha.update(repr(getattr(SRobj, 'curvehash', None)))
+
+        return sha.hexdigest()
+
     def NtupleSRname(self, SRname, analysis):
         """Convert the SR name used in the CL files to that used in the yield ntuple.
         """
@@ -417,7 +736,7 @@ class DMSTAReader:
                 return False
 
             # Check the x-range. We want at least one excluded point
-            xmin = min([graph.GetX()[i] for i in range(graph.GetN())])
+            xmin = GraphViews(graph)[0].min()
             if xmin > math.log10(0.05):
                 return False
 
@@ -435,8 +754,6 @@ class DMSTAReader:
             if not fitfunc:
                 return None
 
-            result = ROOT.TGraphErrors()
-
             # I haven't found a generic way to do this,
             # so I'll use the knowledge that this is really a one-parameter function
             normfactor = fitfunc.GetParameter(0)
@@ -446,22 +763,12 @@ class DMSTAReader:
             # Store the fractional error for convenience later
             normerror = fitfunc.GetParError(0)/normfactor
 
-            # Loop over the function range in regular steps
-            xmin = fitfunc.GetXmin()
-            xmax = fitfunc.GetXmax()
-            npx  = fitfunc.GetNpx()
-            stepsize = (xmax-xmin)/(npx-1)
-
-            for ipoint in range(npx):
-
-                xval = xmin + ipoint*stepsize
-                yval = fitfunc.Eval(xval)
-                yerr = normerror*yval
+            # Sample the function range in regular steps
+            xvalues = numpy.linspace(fitfunc.GetXmin(), fitfunc.GetXmax(), fitfunc.GetNpx())
+            yvalues = EvalCalibrationFunction(fitfunc, xvalues)
 
-                result.SetPoint(ipoint, xval, yval)
-                result.SetPointError(ipoint, 0, yerr)
-
-            return result
+            # The band is just the fractional error on the normalisation
+            return MakeGraph(xvalues, yvalues, None, normerror*yvalues)
 
         def SystematicFactor_linear(graph, fitfunc):
             return SystematicFactor(graph, fitfunc, False)
@@ -483,28 +790,21 @@ class DMSTAReader:
             # The central idea: simultaneously compute a "chi^2" of the
             # fractional deviation between the graph and function, as well
             # as the average fractional error on the truth yield
-            sumdiff2 = 0.
-            sumerr = 0.
-            Npoints = 0
-
-            for ipoint in range(graph.GetN()):
+            xpoints,ypoints,expoints,eypoints = GraphViews(graph)
+            yfunc = EvalCalibrationFunction(fitfunc, xpoints)
 
-                ypoint = graph.GetY()[ipoint]
-                xpoint = graph.GetX()[ipoint]
-                yfunc = fitfunc.Eval(xpoint)
-                if not ypoint or not yfunc:
-                    continue
-                if xpoint < fitfunc.xmin or xpoint > fitfunc.xmax:
-                    continue
-
-                # All tests passed OK, add this point into the calculation
-                Npoints += 1
-                sumdiff2 += (ypoint - yfunc)*(ypoint - yfunc)/(yfunc*yfunc)
-                sumerr += graph.GetEY()[ipoint]/ypoint
+            # Only use points with a nonzero yield and function value, inside the fit range
+            selection = (ypoints != 0) & (yfunc != 0) & (xpoints >= fitfunc.xmin) & (xpoints <= fitfunc.xmax)
+            Npoints = numpy.count_nonzero(selection)
 
             if not Npoints:
                 return 1.
 
+            ypoints = ypoints[selection]
+            yfunc = yfunc[selection]
+            sumdiff2 = numpy.sum((ypoints - yfunc)*(ypoints - yfunc)/(yfunc*yfunc))
+            sumerr = numpy.sum(eypoints[selection]/ypoints)
+
             if quadrature:
                 # Now treat sumerr/Npoints and sqrt(sumdiff2)/Npoints as uncorrelated errors
                 toterr2 = sumerr*sumerr + sumdiff2
@@ -539,68 +839,86 @@ class DMSTAReader:
         # Check first if we have anything to configure
         if not self.__hffile:
             return
-        # Extract HistFitter curves from the root file
-        funcfile = ROOT.TFile.Open(self.__hffile)
+        # Extract HistFitter curves from the root file, which is read only once
+        if self.__hfcurves is None:
+            self.__hfcurves = HistFitterCurves(self.__hffile)
 
-        if funcfile and not funcfile.IsZombie():
+        if self.__hfcurves.IsOpen():
 
             # Extracting the TF1 objects directly doesn't seem to work,
             # as the normalisation parameter becomes fixed.
             # So, extract the graph objects instead and recreate the TF1.
             # The real SR name is from "SR" to the end.
             shortSRname = SRobj.name[SRobj.name.index('SR'):]
-            graphObs = funcfile.Get(shortSRname+'_graphObs')
-            graphExp = funcfile.Get(shortSRname+'_graphExp')
-
-            # FIXME: hard-coded -6...
-            SRobj.fitfunctions['LogCLsObs'] = ROOT.TF1('fitfunc', lambda x,p: graphObs.Eval(x[0])/p[0], -6, 0, 1)
-            SRobj.fitfunctions['LogCLsExp'] = ROOT.TF1('fitfunc', lambda x,p: graphExp.Eval(x[0])/p[0], -6, 0, 1)
-
-            # Store the original graph, as this is the only meaningful way to copy the function
-            SRobj.fitfunctions['LogCLsObs'].graph = graphObs
-            SRobj.fitfunctions['LogCLsExp'].graph = graphExp
-
-            # Extract the TF1 object - does not work.
-            # SRobj.fitfunctions['LogCLsObs'] = funcfile.Get(shortSRname)
-            # SRobj.fitfunctions['LogCLsObs'].SetName('fitfunc') # for later convenience
-            SRobj.fitfunctions['LogCLsObs'].SetParameter(0,1.)
-            SRobj.fitfunctions['LogCLsExp'].SetParameter(0,1.)
-
-            # Restrict the fit range to small CLs values
-            # SRobj.fitfunctions['LogCLsObs'].SetRange(-6, -0.5)
-            SRobj.fitfunctions['LogCLsObs'].xmin = -6.
-            SRobj.fitfunctions['LogCLsExp'].xmin = -6.
-            SRobj.fitfunctions['LogCLsObs'].xmax = -0.5
-            SRobj.fitfunctions['LogCLsExp'].xmax = -0.5
-
-            if self.systematic:
-                # This gets a bit complicated.
-                # Options are:
-                # "Lin", "Quad": Apply SystematicFactor to all SRs, the only difference is how the components are summed.
-                # "2L": Only the xmax of the TwoLep regions is changed
-                # "LinAll", "QuadAll": The union of the above changes
-                tryTwoLep = self.systematic in ['2L','LinAll','QuadAll']
-                trySystFactor = 'Lin' in self.systematic or 'Quad' in self.systematic
-                if tryTwoLep and 'TwoLep' in SRobj.name:
-                    SRobj.fitfunctions['LogCLsObs'].xmax = 0.0
-                    SRobj.fitfunctions['LogCLsExp'].xmax = 0.0
-                elif trySystFactor:
-                    if 'Lin' in self.systematic:
-                        SRobj.fitfunctions['LogCLsObs'].SystematicFactor = SystematicFactor_linear
-                        SRobj.fitfunctions['LogCLsExp'].SystematicFactor = SystematicFactor_linear
-                    elif 'Quad' in self.systematic:
-                        SRobj.fitfunctions['LogCLsObs'].SystematicFactor = SystematicFactor_quadratic
-                        SRobj.fitfunctions['LogCLsExp'].SystematicFactor = SystematicFactor_quadratic
+            graphs = self.__hfcurves.GetGraphs(shortSRname)
+
+            # Even without a calibration curve, CorrelationPlotter expects these
+            SRobj.GoodFit = GoodFit
+            SRobj.FitErrorGraph = FitErrorGraph
+
+            if graphs is None:
+                # Reported in ReadFiles, leave the fit functions as None
+                return
+            graphObs,graphExp = graphs
+
+            # Record which curves were used, so that a change can be detected
+            SRobj.curvehash = self.__CurveHash(graphs)
+
+            def MakeFitFunctions(systematic=None):
+                """Creates this SR's fit functions, with the fit range and normalisation
+                scale factor for the given systematic variation (see DMSTAReader.systematics).
+                Returns a dictionary like SRobj.fitfunctions.
+                """
+
+                fitfunctions = dict.fromkeys(SRobj.InfoList())
+
+                # FIXME: hard-coded -6...
+                # The functions are evaluated natively, ie graph.Eval(x)/p[0] without calling python.
+                # They also store the original graph (as func.graph), as this is
+                # the only meaningful way to copy the function.
+                fitfunctions['LogCLsObs'] = MakeCalibrationFunction(graphObs, 'fitfunc', -6, 0)
+                fitfunctions['LogCLsExp'] = MakeCalibrationFunction(graphExp, 'fitfunc', -6, 0)
+
+                # Extract the TF1 object - does not work.
+                # fitfunctions['LogCLsObs'] = funcfile.Get(shortSRname)
+                # fitfunctions['LogCLsObs'].SetName('fitfunc') # for later convenience
+                fitfunctions['LogCLsObs'].SetParameter(0,1.)
+                fitfunctions['LogCLsExp'].SetParameter(0,1.)
+
+                # Restrict the fit range to small CLs values
+                # fitfunctions['LogCLsObs'].SetRange(-6, -0.5)
+                fitfunctions['LogCLsObs'].xmin = -6.
+                fitfunctions['LogCLsExp'].xmin = -6.
+                fitfunctions['LogCLsObs'].xmax = -0.5
+                fitfunctions['LogCLsExp'].xmax = -0.5
+
+                if systematic:
+                    # This gets a bit complicated.
+                    # Options are:
+                    # "Lin", "Quad": Apply SystematicFactor to all SRs, the only difference is how the components are summed.
+                    # "2L": Only the xmax of the TwoLep regions is changed
+                    # "LinAll", "QuadAll": The union of the above changes
+                    tryTwoLep = systematic in ['2L','LinAll','QuadAll']
+                    trySystFactor = 'Lin' in systematic or 'Quad' in systematic
+                    if tryTwoLep and 'TwoLep' in SRobj.name:
+                        fitfunctions['LogCLsObs'].xmax = 0.0
+                        fitfunctions['LogCLsExp'].xmax = 0.0
+                    elif trySystFactor:
+                        if 'Lin' in systematic:
+                            fitfunctions['LogCLsObs'].SystematicFactor = SystematicFactor_linear
+                            fitfunctions['LogCLsExp'].SystematicFactor = SystematicFactor_linear
+                        elif 'Quad' in systematic:
+                            fitfunctions['LogCLsObs'].SystematicFactor = SystematicFactor_quadratic
+                            fitfunctions['LogCLsExp'].SystematicFactor = SystematicFactor_quadratic
+
+                return fitfunctions
+
+            # Keep the recipe, so that CorrelationPlotter can make all the systematic variations in one go
+            SRobj.MakeFitFunctions = MakeFitFunctions
+            SRobj.fitfunctions = MakeFitFunctions(self.systematic)
 
             # Special case(s)
             # Now left just as an example
             # if 'SR0a_16' in SRobj.name:
             #     SRobj.fitfunctions['LogCLsObs'].xmax = -0.9
             #     SRobj.fitfunctions['LogCLsExp'].xmax = -0.7
-
-            SRobj.GoodFit = GoodFit
-            SRobj.FitErrorGraph = FitErrorGraph
-
-        else:
-
-            print 'ERROR in Reader_DMSTA: could not open HistFitter file'
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""A catalogue of the analysis/SR combinations, giving each one a stable integer ID.
+Code looping over many models can then use arrays indexed by the ID,
+rather than dictionaries keyed by the (long) SR names.
+"""
+
+import numpy
+
+def HepDataSRname(SR):
+    """Reinterpret the in-code SR name with a theorist-friendly one for HepData.
+    """
+
+    splitname = SR.split('_')
+
+    if splitname[0] == 'EwkTwoLepton':
+        if 'mT' in splitname[-1]:
+            threshold = 90 if 'a' in splitname[-1] else (120 if 'b' in splitname[-1] else 150)
+            return '2L_SR_mT2_%i'%(threshold)
+        else: # Zjets or WWx
+            return '2L_SR_%s'%(splitname[-1])
+
+    elif splitname[0] == 'EwkThreeLepton':
+        if 'SR0a' in splitname[-2]:
+            return '3L_SR_0tau_a_bin_%s'%(splitname[-1])
+        elif splitname[-1] == 'SR0b':
+            return '3L_SR_0tau_b'
+        elif splitname[-1] == 'SR1SS':
+            return '3L_SR_1tau'
+
+    elif splitname[0] == 'EwkFourLepton':
+        return '4L_%s'%(splitname[-1])
+
+    elif splitname[0] == 'EwkTwoTau':
+        if splitname[2].startswith('C1'):
+            return '2tau_SR_%s'%(splitname[2])
+        else:
+            return '2tau_SR_DS_lowMass' if 'low' in splitname[-1] else '2tau_SR_DS_highMass'
+
+    # If we get here, something went wrong
+    return SR #'ERROR'
+
+def LatexSRname(SR):
+    """The name of the SR in the LaTeX tables (see Combiner.LatexSummary).
+    """
+
+    if 'SR_WW' in SR:
+        # It's either SR_WWa, b, or c
+        whichone = SR.split('_')[2][-1]
+        return '2$\\ell$ SR-\\Wboson{}\\Wboson{}'+whichone
+
+    elif 'Zjets' in SR:
+        return '2$\\ell$ SR-\\Zboson{}jets'
+
+    elif 'SR_mT2' in SR:
+        # It's either SR_mT2a, b, or c
+        whichone = SR.split('_')[2][-1]
+        # But we don't call them a,b,c in the note...
+        whichone = {'a':90, 'b':120, 'c':150}[whichone]
+        return '2$\\ell$ SR-$\\mttwo^{%i}$'%(whichone)
+
+    elif 'SR0a' in SR:
+        return '3$\\ell$ SR0$\\tau$a bin %i'%(int(SR.split('_')[-1]))
+
+    elif 'SR0b' in SR:
+        return '3$\\ell$ SR0$\\tau$b'
+
+    elif 'SR1SS' in SR:
+        return '3$\\ell$ SR1$\\tau$'
+
+    elif 'FourLepton' in SR:
+        return '4$\\ell$ '+SR.split('_')[1]
+
+    elif 'TwoTau' in SR:
+        # Let's just hard-code this
+        if 'C1C1' in SR:
+            return '2$\\tau$ SR-C1C1'
+        elif 'C1N2' in SR:
+            return '2$\\tau$ SR-C1N2'
+        elif 'highMT2' in SR:
+            return '2$\\tau$ SR-DS-highMass'
+        elif 'lowMT2' in SR:
+            return '2$\\tau$ SR-DS-lowMass'
+
+    # Not a known SR, just make it safe for LaTeX
+    return SR.replace('_','\\_')
+
+class SRCatalogue:
+    """Stable integer IDs for a set of analysis/SR names, ie their position in sorted order,
+    with the other names of each SR precomputed as lists indexed by ID:
+    branchnames (the truth yield branch in the ntuple) and hepdatanames.
+    bins are the histogram bins of the SRs, for histograms with one bin per SR in ID order.
+    """
+
+    def __init__(self, names):
+
+        self.names = sorted(set(names))
+
+        self.branchnames = ['_'.join(['EW_ExpectedEvents',name]) for name in self.names]
+        self.hepdatanames = [HepDataSRname(name) for name in self.names]
+        self.bins = numpy.arange(1, len(self.names)+1)
+
+    def __len__(self):
+        return len(self.names)
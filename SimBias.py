@@ -90,11 +90,13 @@ ROOT.SetAtlasStyle()
 ROOT.gROOT.LoadMacro("AtlasUtils.C") 
 
 # Open the two ROOT files I want to compare
-simfile = ROOT.TFile.Open('Data_Yields/SummaryNtuple_STA_sim.root')
-simtree = simfile.Get('susy')
+# Each branch is drawn separately, so the branches in the cache are set for each one (see below)
+from TreeIO import OpenTree
+simfile = OpenTree('Data_Yields/SummaryNtuple_STA_sim.root', cachebranches=[])
+simtree = simfile.tree
 
-evgenfile = ROOT.TFile.Open('Data_Yields/SummaryNtuple_STA_evgen.root')
-evgentree = evgenfile.Get('susy')
+evgenfile = OpenTree('Data_Yields/SummaryNtuple_STA_evgen.root', cachebranches=[])
+evgentree = evgenfile.tree
 
 # Observed xsec limits from the disappearing track paper, converted to events
 #                SR1,  SR2,  SR3, SR4 (there is no SR0)
@@ -138,6 +140,10 @@ for branchname in branchlist:
     else:
         binstr = ''
 
+    # Only this branch and the disappearing track yields are read
+    evgenfile.CacheBranches([branchname, 'EW_ExpectedEvents_DisappearingTrack_SR*'])
+    simfile.CacheBranches([branchname])
+
     # Draw the three histograms, making sure they have the same binning
     evgentree.Draw(branchname+'>>hevgen'+branchname+binstr)
     simtree.Draw(branchname+'>>hsim'+branchname+binstr)
@@ -162,6 +168,7 @@ for h in histolist:
 outfile.Close()
 
 # Print out a bit more info about the disappearing track analysis
+evgenfile.CacheBranches(['EW_ExpectedEvents_DisappearingTrack_SR*', 'EW_Cat_*'])
 evgenentries = evgentree.GetEntries()
 for SR in range(1,5):
     passlimit = 'EW_ExpectedEvents_DisappearingTrack_SR%i > %.1f'%(SR,obslimits[SR])
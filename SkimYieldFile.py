@@ -1,149 +1,805 @@
 #!/usr/bin/env python
 
-"""A simple script to skim out the useful info from the 26GB(!) input yield file"""
-
+"""A simple script to skim out the useful info from the 26GB(!) input yield file.
+
+The input entries are split into ranges ("shards"), each skimmed into its own sim/evgen/noevgen
+shard files (by N worker processes with --nproc N). The shards are then merged in entry order,
+so the outputs do not depend on the number of shards. Finished shards are recorded in a checkpoint
+file, so an interrupted skim resumes where it stopped when it is run again.
+
+The skim itself does not loop over entries in python: the model IDs and truth event counts
+are read in chunks with TTree::Draw, the entries for each output are selected with numpy,
+and the selected entries are copied in bulk with TTree::CopyTree (using SkimTools.C).
+
+The branches written are chosen with --profile (see PROFILES): "full" keeps the same wide
+set of branches as always, while the other profiles write slimmer files with only the
+branches read by particular scripts. All profiles have the same entries in the same order.
+
+A full skim also writes a manifest (SKIMMANIFEST) with the input file version, the simulated
+models and the model ID of every input entry. If only the list of simulated models changes,
+the next run uses it to rewrite just the sim outputs (see IncrementalSkim).
+"""
+
+import datetime
+import glob
+import itertools
+import json
+import os
+import time
+import numpy
 import ROOT
 ROOT.gROOT.SetBatch(True)
 
+from ColumnCache import ReadColumns,ExportColumns,OpenColumns,SourceID
+
+INPUTFILE = 'Data_Yields/SummaryNtuple_STA_all_version4.root'
+MODELLISTFILE = 'Data_Yields/D3PDs.txt'
+
+# The three output trees, see SkimRange
+# The second and third trees contain all models, with none in common
+OUTPUTNAMES = ['sim', 'evgen', 'noevgen']
+OUTPUTFILES = dict([(name,'Data_Yields/SummaryNtuple_STA_%s.root'%(name)) for name in OUTPUTNAMES])
+
 # ########################################################
-# Load up the input tree
+# Branch profiles: which branches are kept in the outputs
 # ########################################################
 
-infile = ROOT.TFile.Open('Data_Yields/SummaryNtuple_STA_all_version4.root')
-intree = infile.Get('susy')
-
-# Turn every branch off, except the model ID
-intree.SetBranchStatus('*', 0)
-intree.SetBranchStatus('modelName', 1)
-
-# Turn analysis branches on
-intree.SetBranchStatus('*EwkFourLepton*', 1)
-intree.SetBranchStatus('*EwkThreeLepton*', 1)
-intree.SetBranchStatus('*EwkTwoLepton*', 1)
-intree.SetBranchStatus('*EwkTwoTau*', 1)
-intree.SetBranchStatus('*DisappearingTrack*', 1)
-intree.SetBranchStatus('EW_Events_truth',1)
-
-# Add some associated info about the models
-intree.SetBranchStatus('BF_chi_*', 1)
-intree.SetBranchStatus('Cross_section_nn*', 1)
-intree.SetBranchStatus('cos_tau', 1)
-intree.SetBranchStatus('m_chi_*', 1)
-intree.SetBranchStatus('LLV_*', 1)
-intree.SetBranchStatus('M_*', 1)
-intree.SetBranchStatus('N_*', 1)
-intree.SetBranchStatus('mu', 1)
-intree.SetBranchStatus('tanb', 1)
-
-# Turn some specific categories of branches off again
-intree.SetBranchStatus('EWTruthAcc_*', 0)
-intree.SetBranchStatus('EWOffTruthAcc_*', 0)
+# Each profile is a list of (pattern, status) pairs for TTree::SetBranchStatus,
+# applied in order after switching all branches off.
+# "full" is the original skim, the others are only what particular scripts read.
+FULLPROFILE = [
+    # The model ID
+    ('modelName', 1),
+
+    # Analysis branches
+    ('*EwkFourLepton*', 1),
+    ('*EwkThreeLepton*', 1),
+    ('*EwkTwoLepton*', 1),
+    ('*EwkTwoTau*', 1),
+    ('*DisappearingTrack*', 1),
+    ('EW_Events_truth', 1),
+
+    # Some associated info about the models
+    ('BF_chi_*', 1),
+    ('Cross_section_nn*', 1),
+    ('cos_tau', 1),
+    ('m_chi_*', 1),
+    ('LLV_*', 1),
+    ('M_*', 1),
+    ('N_*', 1),
+    ('mu', 1),
+    ('tanb', 1),
+
+    # Turn some specific categories of branches off again
+    ('EWTruthAcc_*', 0),
+    ('EWOffTruthAcc_*', 0),
+    ]
+
+# Where CalibrationProfile looks for the calibrated SRs by default
+CALIBFILE = 'plots_officialMC/calibration.root'
+
+def CalibratedSRs(calibfilename):
+    """The analysis/SR names with a calibration function in calibfilename
+    (named as in Combiner.ReadCalibrations), or an empty list if there is no such file."""
+
+    if not os.path.exists(calibfilename):
+        return []
+
+    calibfile = ROOT.TFile.Open(calibfilename)
+    SRs = set()
+    for key in calibfile.GetListOfKeys():
+        if ROOT.TClass.GetClass(key.GetClassName()).InheritsFrom('TF1'):
+            SRs.add('_'.join(key.GetName().split('_')[:-1]))
+    calibfile.Close()
+
+    return sorted(SRs)
+
+def CalibrationProfile(calibfilename=CALIBFILE):
+    """The branches read to make the calibration (Reader_DMSTA) and to apply it (CombineCLs):
+    the model ID, the truth yields and errors (EW and EWOff) of the analyses in DMSTAReader.analysisdict,
+    and the truth yields of the SRs calibrated in calibfilename (if it exists).
+    """
+
+    from Reader_DMSTA import DMSTAReader
+
+    profile = [('modelName', 1)]
+    for analysis in sorted(DMSTAReader.analysisdict.values()):
+        for prefix in ['EW','EWOff']:
+            for quantity in ['ExpectedEvents','ExpectedError']:
+                profile.append( ('_'.join([prefix,quantity,analysis])+'*', 1) )
+
+    for analysisSR in CalibratedSRs(calibfilename):
+        profile.append( ('_'.join(['EW','ExpectedEvents',analysisSR]), 1) )
+
+    return profile
+
+def ExclusionPlotsProfile():
+    """The branches plotted by ExclusionAnalysis.py, ie the variables in SRresult.plotlist, and the model ID."""
+
+    from ExclusionAnalysis import SRresult
+
+    profile = [('modelName', 1)]
+    for plot in SRresult.plotlist:
+        for branchname in plot.split(':'):
+            if (branchname, 1) not in profile:
+                profile.append( (branchname, 1) )
+
+    return profile
+
+# The known profiles, and functions returning their branches
+PROFILES = {
+    'full': lambda: FULLPROFILE,
+    'calibration': CalibrationProfile,
+    'exclusion-plots': ExclusionPlotsProfile,
+    }
+
+def ProfileOutputFiles(profile):
+    """The output files of a profile, a dictionary with the keys of OUTPUTNAMES.
+    The "full" profile writes the usual files, the others add the profile name."""
+
+    if profile == 'full':
+        return dict(OUTPUTFILES)
+    return dict([(name,'Data_Yields/SummaryNtuple_STA_%s_%s.root'%(name,profile)) for name in OUTPUTNAMES])
+
+def SkimmedFile(name, profile='full'):
+    """The skimmed file name (one of OUTPUTNAMES) of a profile, for the scripts reading the skim.
+    Warns if the file is missing, or if the last skim (see SKIMMANIFEST) did not write this profile,
+    in which case the file may be older than the skim of the other profiles."""
+
+    filename = ProfileOutputFiles(profile)[name]
+    if not os.path.exists(filename):
+        print 'WARNING: %s does not exist, make it with ./SkimYieldFile.py --profile %s'%(filename,profile)
+        return filename
+
+    manifest = ReadSkimManifest()
+    if manifest is not None and profile not in manifest['outputs']:
+        print 'WARNING: The last skim did not write the %s profile, so %s may be out of date. It wrote: %s'%(
+            profile, filename, ', '.join(sorted(manifest['outputs'].keys())))
+
+    return filename
+
+def SetBranches(tree, profile):
+    """Switches on only the branches of the profile (a list of (pattern, status) pairs)."""
+
+    tree.SetBranchStatus('*', 0)
+    for pattern,status in profile:
+        tree.SetBranchStatus(pattern, status)
 
 # ########################################################
-# Create the three output trees
-# The second and third trees contain all models, with none in common
+# Load up the input tree
 # ########################################################
 
-# First, a tree with just the 500 simulated models
-outfile_sim = ROOT.TFile.Open('Data_Yields/SummaryNtuple_STA_sim.root', 'RECREATE')
-outtree_sim = intree.CloneTree(0)
+def OpenInputTree(inputname):
+    """Returns the input file and tree, with only the branches needed to select the entries switched on."""
+
+    infile = ROOT.TFile.Open(inputname)
+    intree = infile.Get('susy')
 
-# Second, a tree for all models with evgen
-outfile_evgen = ROOT.TFile.Open('Data_Yields/SummaryNtuple_STA_evgen.root', 'RECREATE')
-outtree_evgen = intree.CloneTree(0)
+    SetBranches(intree, [('modelName', 1), ('EW_Events_truth', 1)])
 
-# Third, a tree for all models *without* evgen
-outfile_noevgen = ROOT.TFile.Open('Data_Yields/SummaryNtuple_STA_noevgen.root', 'RECREATE')
-outtree_noevgen = intree.CloneTree(0)
+    return infile,intree
 
 # ########################################################
 # Make a list of simulated samples
 # ########################################################
 
-# Open the file with the list of simulated samples
-f = open('Data_Yields/D3PDs.txt')
+def ReadModelList(filename):
+    """Returns the set of simulated model IDs, from the list of D3PD dataset names."""
 
-# Create a python list that will hold just the model IDs
-modellist = []
+    # Open the file with the list of simulated samples
+    f = open(filename)
 
-# Loop over the simulated models
-for line in f:
+    # Create a python set that will hold just the model IDs
+    modellist = set()
 
-    line = line.rstrip() # Remove carriage returns etc
-    if not line: # Empty line
-        continue
-            
-    # The line is not empty, so should have a dataset name!
-    # Split up the dataset into components
-    splitline = line.split('.')
+    # Loop over the simulated models
+    for line in f:
 
-    # In case the line is malformed, try to catch errors
-    try:
-        # Extract the dataset ID and the model ID
-        # The DSID is mainly to help check that this is a valid dataset name
-        DSID = int(splitline[1])
-        modelID = int(splitline[2].split('_')[5])
-    except IndexError:
-        # Badly formed line - print out a warning
-        print 'WARNING: failed to read line in D3PDs.txt'
-        print repr(line)
-        print splitline
-        raise # Because I want to see what this is and fix it
-
-    # Everything OK, add this model to the list
-    modellist.append(modelID)
+        line = line.rstrip() # Remove carriage returns etc
+        if not line: # Empty line
+            continue
+
+        # The line is not empty, so should have a dataset name!
+        # Split up the dataset into components
+        splitline = line.split('.')
+
+        # In case the line is malformed, try to catch errors
+        try:
+            # Extract the dataset ID and the model ID
+            # The DSID is mainly to help check that this is a valid dataset name
+            DSID = int(splitline[1])
+            modelID = int(splitline[2].split('_')[5])
+        except IndexError:
+            # Badly formed line - print out a warning
+            print 'WARNING: failed to read line in D3PDs.txt'
+            print repr(line)
+            print splitline
+            raise # Because I want to see what this is and fix it
+
+        # Everything OK, add this model to the list
+        modellist.add(modelID)
+
+    f.close()
+
+    return modellist
 
 # ########################################################
-# Loop over the input tree and fill the output trees
+# Select the entries for each output tree, column-wise
 # ########################################################
 
-print 'Looping over',intree.GetEntries(),'entries'
-nsimulated = 0 # Double-check the number of simulated samples
+# Entries read per TTree::Draw call when selecting entries
+CHUNKSIZE = 1000000
 
-for entry in intree:
+def LoadSkimTools():
+    """Compiles (if needed) and loads SkimTools.C.
+    Safe to call many times, the work is only done once."""
 
-    # Very slight optimisation for speed
-    modelName = entry.modelName
-    if modelName % 1000 == 0:
-        # The models actually don't print out in order any more,
-        # but it's still useful to get some sense of progress
-        print 'On model %6i, written %3i so far'%(modelName,nsimulated)
+    if hasattr(ROOT, 'MakeEntryList'):
+        return
 
-    # Check if the truth analysis actually ran
-    HaveTruthAcc = entry.EW_Events_truth != -1
+    macro = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SkimTools.C')
+    if ROOT.gROOT.LoadMacro(macro+'+'):
+        raise RuntimeError('Could not compile %s'%(macro))
 
-    if HaveTruthAcc:
-        # We have evgen, write to the "evgen" tree!
-        outtree_evgen.Fill()
+def SelectEntries(intree, modellist, first, last, chunksize=CHUNKSIZE):
+    """Returns a dictionary of numpy arrays with the entry numbers in [first,last)
+    that go into each output tree (see SkimRange), in entry order.
+    Only the model ID and EW_Events_truth are read, in chunks of entries.
+    Also returns the entry map of the range: numpy arrays with the model ID
+    of each entry, and whether it has evgen (see WriteSkimManifest).
+    """
 
-        # Check to see if this model was simulated
-        if modelName in modellist:
-            outtree_sim.Fill()
-            nsimulated += 1
-    else:
-        # Model was not generated, write to the "noevgen" tree
-        outtree_noevgen.Fill()
+    simmodels = numpy.array(sorted(modellist), dtype=numpy.float64)
+    selected = dict([(name,[]) for name in OUTPUTNAMES])
+    modelNames = []
+    evgen = []
+    nsimulated = 0 # Double-check the number of simulated samples
+
+    for start in xrange(first, last, chunksize):
+
+        nentries = min(chunksize, last-start)
+        modelName,truthevents = ReadColumns(intree, 'modelName:EW_Events_truth', start, nentries)
+        entries = numpy.arange(start, start+nentries, dtype=numpy.float64)
+
+        # Check if the truth analysis actually ran
+        HaveTruthAcc = truthevents != -1
+        # Check to see which models with evgen were simulated
+        simulated = HaveTruthAcc & numpy.in1d(modelName, simmodels)
+
+        selected['evgen'].append(entries[HaveTruthAcc])
+        selected['sim'].append(entries[simulated])
+        selected['noevgen'].append(entries[~HaveTruthAcc])
+        modelNames.append(modelName.astype(numpy.int32))
+        evgen.append(HaveTruthAcc)
+
+        nsimulated += simulated.sum()
+        print 'Read %i/%i entries, %i simulated so far'%(start+nentries-first,last-first,nsimulated)
+
+    selected = dict([(name,numpy.concatenate(selected[name]) if selected[name] else numpy.zeros(0)) for name in OUTPUTNAMES])
+    entrymap = (numpy.concatenate(modelNames) if modelNames else numpy.zeros(0, dtype=numpy.int32),
+                numpy.concatenate(evgen) if evgen else numpy.zeros(0, dtype=bool))
+    return selected,entrymap
+
+# ########################################################
+# Copy the selected entries into the output trees
+# ########################################################
+
+def SetEntries(intree, entries):
+    """Restricts the input tree to the entry numbers in the numpy array entries,
+    until intree.SetEntryList(0). Returns the TEntryList (made by SkimTools.C),
+    which must be kept for as long as the tree uses it."""
+
+    LoadSkimTools()
+
+    nentries = len(entries)
+    entries = numpy.ascontiguousarray(entries, dtype=numpy.float64)
+    if not nentries:
+        entries = numpy.zeros(1) # Just something to point to
+    entrylist = ROOT.MakeEntryList(intree, nentries, entries)
+    ROOT.SetOwnership(entrylist, True)
+    intree.SetEntryList(entrylist)
+    return entrylist
+
+def WriteEntries(intree, branches, outputname):
+    """Writes the entries of the input tree (as restricted with SetEntries)
+    to outputname, keeping only the branches of the profile."""
+
+    # The active branches of the selected entries are copied in one go
+    SetBranches(intree, branches)
+
+    outfile = ROOT.TFile.Open(outputname, 'RECREATE')
+    outtree = intree.CopyTree('')
+    print 'Writing %i entries to %s'%(outtree.GetEntries(),outputname)
+    outtree.Write()
+    outfile.Close()
+
+def SkimRange(inputname, outputs, modellist, first=0, last=None):
+    """Skims the input entries [first,last) into the output files.
+    outputs is a dictionary of {profile name: (branches, output files)},
+    with the branches as in PROFILES and the output files a dictionary with the keys of OUTPUTNAMES:
+    1. sim: just the simulated models
+    2. evgen: all models with evgen
+    3. noevgen: all models *without* evgen
+    The entries are selected once with SelectEntries, and copied for each profile with TTree::CopyTree,
+    so no python code runs per entry.
+    Returns the number of entries looked at, the number of simulated models,
+    and the entry map of the range (see SelectEntries).
+    """
+
+    infile,intree = OpenInputTree(inputname)
+    if last is None or last > intree.GetEntries():
+        last = intree.GetEntries()
+
+    print 'Looping over',last-first,'entries'
+    selected,entrymap = SelectEntries(intree, modellist, first, last)
+
+    for name in OUTPUTNAMES:
+
+        entrylist = SetEntries(intree, selected[name])
+        for profile in sorted(outputs.keys()):
+            branches,outputfiles = outputs[profile]
+            WriteEntries(intree, branches, outputfiles[name])
+        intree.SetEntryList(0)
+
+    infile.Close()
+
+    return last-first,len(selected['sim']),entrymap
+
+# ########################################################
+# Skim in entry ranges, in parallel and with checkpoints
+# ########################################################
 
-    # if nsimulated == 5: break # Just for testing
+# Where SkimShards records the finished shards
+CHECKPOINTFILE = 'Data_Yields/SkimCheckpoint.json'
+# The most entries skimmed between checkpoints (ie per shard) by default
+CHECKPOINTENTRIES = 200000
+
+def ShardRanges(nentries, nshards):
+    """Splits the entries into nshards contiguous ranges [first,last), in order."""
+
+    nshards = max(1, min(nshards, nentries))
+    edges = [nentries*ishard/nshards for ishard in range(nshards+1)]
+    return zip(edges[:-1], edges[1:])
+
+def _ShardOutputs(outputs, shardname, ishard):
+    """The outputs argument of SkimRange for one shard, with the same profiles as outputs."""
+
+    shardoutputs = {}
+    for profile,(branches,outputfiles) in outputs.items():
+        shardoutputs[profile] = (branches, dict([(name,'%s_%04i_%s_%s.root'%(shardname,ishard,profile,name)) for name in OUTPUTNAMES]))
+    return shardoutputs
+
+def _ShardEntryMapName(shardname, ishard):
+    """The numpy file with the entry map of a finished shard."""
+    return '%s_%04i_entries.npz'%(shardname,ishard)
+
+def _SkimShardInWorker(args):
+    """Entry point of the worker processes, see SkimShards.
+    Returns the shard number, the result of SkimRange and the number of bytes read from the input."""
+
+    ishard,inputname,outputs,modellist,first,last = args
+    bytesread = ROOT.TFile.GetFileBytesRead()
+    result = SkimRange(inputname, outputs, modellist, first, last)
+    return ishard,result,ROOT.TFile.GetFileBytesRead()-bytesread
+
+def MergeShards(shardfiles, outputname):
+    """Merges the shard files into outputname, keeping the entries in the order of shardfiles.
+    Returns True on success."""
+
+    merger = ROOT.TFileMerger(False)
+    merger.SetFastMethod(True)
+    merger.SetPrintLevel(0)
+    if not merger.OutputFile(outputname, 'RECREATE'):
+        return False
+    for shardfile in shardfiles:
+        if not merger.AddFile(shardfile):
+            return False
+    return merger.Merge()
+
+def _SkimSettings(inputname, outputs, modellist, shardname):
+    """What the shards of a checkpoint were made with, which must not change to resume from it."""
+
+    return {
+        'input': {'file': inputname, 'source': SourceID(inputname)},
+        'simmodels': sorted(modellist),
+        'outputs': _ManifestOutputs(outputs),
+        'shardname': shardname,
+        }
+
+def _ReadCheckpoint(checkpointname, settings, nshards):
+    """Returns the checkpoint of an interrupted skim with the same settings
+    (and number of shards, if not None), or None if there is none."""
 
-print 'Looped over',intree.GetEntries(),'entries'
-print 'Simulated',nsimulated,'entries'
+    try:
+        with open(checkpointname) as checkpointfile:
+            checkpoint = json.load(checkpointfile)
+    except (IOError, ValueError):
+        return None
+
+    if checkpoint.get('version') != SKIMMANIFESTVERSION or checkpoint.get('settings') != settings:
+        print 'INFO: Ignoring the checkpoint in %s, it is for a different skim'%(checkpointname)
+        return None
+    if nshards is not None and len(checkpoint['ranges']) != nshards:
+        print 'INFO: Ignoring the checkpoint in %s, it has %i shards'%(checkpointname,len(checkpoint['ranges']))
+        return None
+
+    return checkpoint
+
+def _WriteCheckpoint(checkpoint, checkpointname):
+    """Replaces the checkpoint file in one go, so it is never left half-written."""
+
+    with open(checkpointname+'.new', 'w') as checkpointfile:
+        json.dump(checkpoint, checkpointfile, indent=1, sort_keys=True)
+    os.rename(checkpointname+'.new', checkpointname)
+
+def _LastEntry(ranges, done):
+    """The entry up to which every shard is done."""
+
+    lastentry = 0
+    for ishard,(first,last) in enumerate(ranges):
+        if str(ishard) not in done:
+            break
+        lastentry = last
+    return lastentry
+
+class SkimProgress:
+    """Reports the progress of the skim as shards finish:
+    the entries and megabytes read per second, and an estimate of the time left."""
+
+    def __init__(self, ntotal, ndone):
+
+        self.ntotal = ntotal
+        self.ndone = ndone
+        # Only what is skimmed from now on counts for the rates
+        self.nentries = 0
+        self.nbytes = 0
+        self.start = time.time()
+
+    def Add(self, nentries, nbytes):
+
+        self.ndone += nentries
+        self.nentries += nentries
+        self.nbytes += nbytes
+
+        elapsed = max(time.time()-self.start, 1e-3)
+        rate = self.nentries/elapsed
+        eta = (self.ntotal-self.ndone)/rate if rate > 0 else 0
+        print 'Skimmed %i/%i entries (%.1f%%): %.0f entries/s, %.1f MB/s read, ETA %s'%(
+            self.ndone, self.ntotal, 100.*self.ndone/max(1,self.ntotal),
+            rate, self.nbytes/elapsed/1e6, datetime.timedelta(seconds=int(eta)))
+
+def SkimShards(inputname, outputs, modellist, nproc=1, nshards=None, shardname=None,
+               checkpointname=CHECKPOINTFILE, resume=True):
+    """As SkimRange for the whole input, with the entries split into shards
+    which are skimmed by nproc processes (or by this one, for nproc=1) and then merged.
+    By default there are a few shards per process, so that they finish at about the same time,
+    and at most about CHECKPOINTENTRIES entries per shard.
+    Every finished shard is recorded in the checkpoint file, and an interrupted skim with the
+    same input, models, profiles and shards carries on from there (unless resume is False).
+    The shard files and the checkpoint are removed after a successful merge.
+    """
+
+    import multiprocessing
+
+    # Compile the helpers once, before the workers are forked
+    LoadSkimTools()
+
+    infile = ROOT.TFile.Open(inputname)
+    nentries = infile.Get('susy').GetEntries()
+    infile.Close()
+
+    if shardname is None:
+        shardname = os.path.join(os.path.dirname(OUTPUTFILES['evgen']), 'SkimShard')
+    settings = _SkimSettings(inputname, outputs, modellist, shardname)
+
+    checkpoint = _ReadCheckpoint(checkpointname, settings, nshards) if resume else None
+    if checkpoint is None:
+        if nshards is None:
+            nshards = max(4*nproc, (nentries+CHECKPOINTENTRIES-1)/CHECKPOINTENTRIES)
+        # Start afresh, without any shards left over from an earlier skim
+        for filename in glob.glob(shardname+'_[0-9][0-9][0-9][0-9]_*'):
+            os.remove(filename)
+        checkpoint = {
+            'version': SKIMMANIFESTVERSION,
+            'settings': settings,
+            'ranges': [list(shardrange) for shardrange in ShardRanges(nentries, nshards)],
+            'done': {},
+            'lastentry': 0,
+            }
+        _WriteCheckpoint(checkpoint, checkpointname)
+
+    ranges = [tuple(shardrange) for shardrange in checkpoint['ranges']]
+    shardoutputs = [_ShardOutputs(outputs, shardname, ishard) for ishard in range(len(ranges))]
+
+    # Only trust the finished shards whose files are all still there
+    for key in checkpoint['done'].keys():
+        ishard = int(key)
+        shardfiles = [_ShardEntryMapName(shardname, ishard)]
+        for branches,files in shardoutputs[ishard].values():
+            shardfiles += files.values()
+        if not all([os.path.exists(filename) for filename in shardfiles]):
+            del checkpoint['done'][key]
+    if checkpoint['done']:
+        checkpoint['lastentry'] = _LastEntry(ranges, checkpoint['done'])
+        print 'INFO: Resuming the skim from %s, with %i/%i shards done (all entries up to %i)'%(
+            checkpointname, len(checkpoint['done']), len(ranges), checkpoint['lastentry'])
+
+    tasks = [(itask, inputname, shardoutputs[itask], modellist, first, last)
+             for itask,(first,last) in enumerate(ranges) if str(itask) not in checkpoint['done']]
+    progress = SkimProgress(nentries, sum([done['entries'] for done in checkpoint['done'].values()]))
+
+    print 'Skimming %i entries in %i shards using %i processes'%(nentries-progress.ndone,len(tasks),nproc)
+    # Each task opens its own files, so the processes share nothing but the model list
+    pool = multiprocessing.Pool(min(nproc, len(tasks))) if nproc > 1 and len(tasks) > 1 else None
+    try:
+        if pool:
+            results = pool.imap_unordered(_SkimShardInWorker, tasks)
+        else:
+            results = itertools.imap(_SkimShardInWorker, tasks)
+
+        # Record each shard as it finishes
+        for ishard,(nshardentries,nsimulated,entrymap),nbytes in results:
+            modelNames,evgen = entrymap
+            numpy.savez(_ShardEntryMapName(shardname, ishard), modelName=modelNames, evgen=evgen)
+            checkpoint['done'][str(ishard)] = {'entries': nshardentries, 'simulated': int(nsimulated)}
+            checkpoint['lastentry'] = _LastEntry(ranges, checkpoint['done'])
+            _WriteCheckpoint(checkpoint, checkpointname)
+            progress.Add(nshardentries, nbytes)
+    except:
+        # The finished shards are recorded, so don't wait for the others
+        if pool:
+            pool.terminate()
+            pool.join()
+        raise
+    if pool:
+        pool.close()
+        pool.join()
+
+    # Merge the shards, in entry order
+    for profile,(branches,outputfiles) in sorted(outputs.items()):
+        for name in OUTPUTNAMES:
+            shardfiles = [shard[profile][1][name] for shard in shardoutputs]
+            print 'Merging %i shards into %s'%(len(shardfiles),outputfiles[name])
+            if not MergeShards(shardfiles, outputfiles[name]):
+                raise RuntimeError('Failed to merge the shards into %s, the shard files are kept'%(outputfiles[name]))
+
+    # The entry maps of the shards, in entry order
+    entrymaps = [numpy.load(_ShardEntryMapName(shardname, ishard)) for ishard in range(len(ranges))]
+    entrymap = (numpy.concatenate([shardmap['modelName'] for shardmap in entrymaps]),
+                numpy.concatenate([shardmap['evgen'] for shardmap in entrymaps]))
+
+    for ishard,shard in enumerate(shardoutputs):
+        for branches,files in shard.values():
+            for filename in files.values():
+                os.remove(filename)
+        os.remove(_ShardEntryMapName(shardname, ishard))
+    os.remove(checkpointname)
+
+    done = checkpoint['done'].values()
+    return sum([shard['entries'] for shard in done]),sum([shard['simulated'] for shard in done]),entrymap
 
 # ########################################################
-# Save the results
+# Incremental re-skim, for a new list of simulated models
 # ########################################################
 
-outfile_sim.cd()
-outtree_sim.Write()
-outfile_sim.Close()
+# Where the full skim records what it was made from
+SKIMMANIFEST = 'Data_Yields/SkimManifest.json'
+# Bump this if the format of the manifest changes
+SKIMMANIFESTVERSION = 1
+
+def _EntryMapName(manifestname):
+    """The numpy file with the entry map, next to the manifest."""
+    return os.path.splitext(manifestname)[0]+'_entries.npz'
+
+def _ManifestBranches(branches):
+    """The branches of a profile as stored in the manifest (json has no tuples)."""
+    return [[pattern,status] for pattern,status in branches]
+
+def _ManifestOutputs(outputs):
+    """The branches and files of each profile in outputs (as for SkimRange), as stored in the manifest."""
+    return dict([(profile,{'branches': _ManifestBranches(branches), 'files': outputfiles})
+                 for profile,(branches,outputfiles) in outputs.items()])
+
+def _DumpSkimManifest(manifest, manifestname):
 
-outfile_evgen.cd()
-outtree_evgen.Write()
-outfile_evgen.Close()
+    with open(manifestname, 'w') as manifestfile:
+        json.dump(manifest, manifestfile, indent=1, sort_keys=True)
 
-outfile_noevgen.cd()
-outtree_noevgen.Write()
-outfile_noevgen.Close()
+def WriteSkimManifest(inputname, outputs, modellist, entrymap, manifestname=SKIMMANIFEST):
+    """Records what a full skim was made from: the version of the input file, the simulated models,
+    the branches and files of each profile in outputs (as for SkimRange), and the entry map
+    (see SelectEntries) of the whole input, which is saved in a separate numpy file.
+    """
+
+    modelNames,evgen = entrymap
+    entrymapname = _EntryMapName(manifestname)
+    numpy.savez(entrymapname, modelName=modelNames, evgen=evgen)
+
+    manifest = {
+        'version': SKIMMANIFESTVERSION,
+        'input': {'file': inputname, 'source': SourceID(inputname)},
+        'entrymap': {'file': os.path.basename(entrymapname), 'source': SourceID(entrymapname)},
+        'simmodels': sorted(modellist),
+        'outputs': _ManifestOutputs(outputs),
+        }
+    _DumpSkimManifest(manifest, manifestname)
+
+def ReadSkimManifest(manifestname=SKIMMANIFEST):
+    """Returns the manifest written by WriteSkimManifest, or None if there is no (usable) manifest."""
+
+    try:
+        with open(manifestname) as manifestfile:
+            manifest = json.load(manifestfile)
+    except (IOError, ValueError):
+        return None
+
+    if manifest.get('version') != SKIMMANIFESTVERSION:
+        return None
+    return manifest
+
+def _ManifestProblem(manifest, manifestname, inputname, outputs):
+    """Why the outputs of the manifest cannot be updated incrementally, or None if they can."""
+
+    if manifest is None:
+        return 'there is no skim manifest'
+
+    try:
+        if manifest['input'] != {'file': inputname, 'source': SourceID(inputname)}:
+            return 'the input file has changed'
+        entrymapname = os.path.join(os.path.dirname(manifestname), manifest['entrymap']['file'])
+        if manifest['entrymap']['source'] != SourceID(entrymapname):
+            return 'the entry map has changed'
+    except OSError:
+        return 'the input file or entry map is missing'
+
+    for profile,(branches,outputfiles) in outputs.items():
+        if profile not in manifest['outputs']:
+            return 'the %s profile was not skimmed before'%(profile)
+        if manifest['outputs'][profile]['branches'] != _ManifestBranches(branches):
+            return 'the branches of the %s profile have changed'%(profile)
+        if manifest['outputs'][profile]['files'] != outputfiles:
+            return 'the output files of the %s profile have changed'%(profile)
+
+    # All recorded outputs are updated, so they must all be there
+    for recorded in manifest['outputs'].values():
+        for filename in recorded['files'].values():
+            if not os.path.exists(filename):
+                return '%s is missing'%(filename)
+
+    return None
+
+def IncrementalSkim(inputname, outputs, modellist, manifestname=SKIMMANIFEST):
+    """Updates the outputs of an earlier full skim for a new list of simulated models, if possible.
+    Only the sim outputs depend on the model list, so if the input file and the requested profiles
+    are as recorded in the manifest, the sim outputs of every profile in the manifest are rewritten
+    with the entries selected from the stored entry map, without reading the whole input.
+    The entries end up in the same order as for a full skim, and the evgen/noevgen outputs are untouched.
+    Returns None if a full skim is needed, and otherwise the number of entries,
+    the number of simulated models, and the list of files that were rewritten.
+    """
+
+    manifest = ReadSkimManifest(manifestname)
+    problem = _ManifestProblem(manifest, manifestname, inputname, outputs)
+    if problem:
+        print 'INFO: Making a full skim, as %s'%(problem)
+        return None
+
+    entrymap = numpy.load(os.path.join(os.path.dirname(manifestname), manifest['entrymap']['file']))
+    modelNames = entrymap['modelName']
+    evgen = entrymap['evgen']
+
+    simmodels = numpy.array(sorted(modellist), dtype=numpy.int64)
+    simulated = evgen & numpy.in1d(modelNames, simmodels)
+
+    oldmodels = set(manifest['simmodels'])
+    added = set(modellist) - oldmodels
+    removed = oldmodels - set(modellist)
+    print 'INFO: %i simulated models added and %i removed since the last skim'%(len(added),len(removed))
+    if not added and not removed:
+        print 'INFO: The skimmed files are up to date'
+        return len(modelNames),simulated.sum(),[]
+
+    infile,intree = OpenInputTree(inputname)
+    entrylist = SetEntries(intree, numpy.flatnonzero(simulated))
+
+    # Rewrite via a temporary file, so an interrupted update does not leave a broken output
+    rewritten = []
+    for profile,recorded in sorted(manifest['outputs'].items()):
+        branches = [(str(pattern),status) for pattern,status in recorded['branches']]
+        outputname = str(recorded['files']['sim'])
+        WriteEntries(intree, branches, outputname+'.new')
+        os.rename(outputname+'.new', outputname)
+        rewritten.append(outputname)
+
+    intree.SetEntryList(0)
+    infile.Close()
+
+    manifest['simmodels'] = sorted(modellist)
+    _DumpSkimManifest(manifest, manifestname)
+
+    return len(modelNames),simulated.sum(),rewritten
+
+if __name__ == '__main__':
+
+    # Add some command line options
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="""
+           Skims the summary ntuple into files with the simulated models, the models with evgen, and the models without evgen.""",
+        )
+    parser.add_argument(
+        "--nproc",
+        dest = "nproc",
+        type = int,
+        default = 1,
+        help = "Number of processes to skim with, each taking a range of entries")
+    parser.add_argument(
+        "--nshards",
+        dest = "nshards",
+        type = int,
+        default = None,
+        help = "Number of entry ranges to split the input into (default: 4 per process, and at most %i entries each)"%(CHECKPOINTENTRIES))
+    parser.add_argument(
+        "--restart",
+        action = "store_true",
+        dest = "restart",
+        help = "Start the skim from scratch, instead of resuming from the checkpoint of an interrupted skim")
+    parser.add_argument(
+        "--profile",
+        dest = "profiles",
+        action = "append",
+        choices = sorted(PROFILES.keys()),
+        help = "Branch profile to write, can be given several times (default: full)")
+    parser.add_argument(
+        "--calibfile",
+        dest = "calibfile",
+        default = CALIBFILE,
+        help = "calibration.root file with the SRs for the calibration profile")
+    parser.add_argument(
+        "--columns",
+        action = "store_true",
+        dest = "columns",
+        help = "Also export the model IDs and yields of the outputs as memory-mappable arrays (see ColumnCache.py)")
+    parser.add_argument(
+        "--full",
+        action = "store_true",
+        dest = "full",
+        help = "Always skim the whole input, even if only the simulated models have changed since the last skim")
+    cmdlinearguments = parser.parse_args()
+
+    modellist = ReadModelList(MODELLISTFILE)
+
+    # The branches and files of each profile
+    outputs = {}
+    for profile in (cmdlinearguments.profiles or ['full']):
+        if profile == 'calibration':
+            branches = CalibrationProfile(cmdlinearguments.calibfile)
+        else:
+            branches = PROFILES[profile]()
+        outputs[profile] = (branches, ProfileOutputFiles(profile))
+
+    result = None
+    if not cmdlinearguments.full:
+        result = IncrementalSkim(INPUTFILE, outputs, modellist)
+
+    if result is None:
+        # The old manifest is invalid from here on, in case the skim is interrupted
+        if os.path.exists(SKIMMANIFEST):
+            os.remove(SKIMMANIFEST)
+        nentries,nsimulated,entrymap = SkimShards(INPUTFILE, outputs, modellist,
+                                                  cmdlinearguments.nproc, cmdlinearguments.nshards,
+                                                  resume = not cmdlinearguments.restart)
+        WriteSkimManifest(INPUTFILE, outputs, modellist, entrymap)
+        rewritten = [files[name] for _,files in outputs.values() for name in OUTPUTNAMES]
+    else:
+        nentries,nsimulated,rewritten = result
 
-infile.Close()
+    if cmdlinearguments.columns:
+        for profile,(branches,outputfiles) in sorted(outputs.items()):
+            for name in OUTPUTNAMES:
+                # Columns of unchanged files are still valid
+                if outputfiles[name] in rewritten or OpenColumns(outputfiles[name]) is None:
+                    ExportColumns(outputfiles[name])
 
+    print 'Looped over',nentries,'entries'
+    print 'Simulated',nsimulated,'entries'
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""Opening the yield ntuples for reading with a TTreeCache.
+
+Without a cache, every basket of every branch read is a separate small read from the file,
+which is slow for the big evgen ntuple. OpenTree switches on only the branches that are needed,
+and sets up a TTreeCache (with asynchronous prefetching) holding the baskets of the branches
+that are read, so that they are fetched in a few large reads. The branches to cache are either
+given explicitly, or found by the cache itself in a learning phase over the first entries.
+
+CachedTree.Close prints how much was read, in how many calls, and how often the cache was hit,
+so that the I/O of each script can be checked and tuned.
+"""
+
+import fnmatch
+import time
+import ROOT
+
+# Limits on the size of the cache (in bytes)
+MINCACHESIZE = 10*1024*1024
+MAXCACHESIZE = 256*1024*1024
+# Cache size when the cached branches are not known in advance
+DEFAULTCACHESIZE = 30*1024*1024
+
+# Entries read in the learning phase, if the branches to cache are not given
+LEARNENTRIES = 100
+
+def MatchBranches(tree, patterns):
+    """The top-level branches of the tree matching any of the (SetBranchStatus-style) patterns."""
+
+    return [branch for branch in tree.GetListOfBranches()
+            if any([fnmatch.fnmatchcase(branch.GetName(), pattern) for pattern in patterns])]
+
+def CacheSize(tree, branches):
+    """A cache size big enough for a cluster of baskets of the branches (a list of TBranch)
+    and the next one, which is being prefetched, within MINCACHESIZE and MAXCACHESIZE."""
+
+    nentries = tree.GetEntries()
+    zipbytes = sum([branch.GetZipBytes() for branch in branches])
+    if not nentries or not zipbytes:
+        return MINCACHESIZE
+
+    # The fraction of the tree in one cluster: AutoFlush is in entries if positive, and in bytes if negative
+    autoflush = tree.GetAutoFlush()
+    if autoflush > 0:
+        fraction = float(autoflush)/nentries
+    elif autoflush < 0 and tree.GetTotBytes():
+        fraction = float(-autoflush)/tree.GetTotBytes()
+    else:
+        fraction = 1.
+
+    return int(min(MAXCACHESIZE, max(MINCACHESIZE, 2*min(1.,fraction)*zipbytes)))
+
+def OpenTree(filename, treename='susy', branches=None, cachebranches=None,
+             learnentries=LEARNENTRIES, prefetch=True):
+    """Returns a CachedTree for the tree in filename, or None if the file cannot be opened.
+    branches are patterns of the branches to switch on (all others are switched off),
+    or None to leave them all on. cachebranches are patterns of the branches to cache,
+    by default the same as branches. If neither is given, the cache learns which branches
+    are read from the first learnentries entries.
+    With prefetch, the cache reads the next baskets asynchronously while the current ones are used.
+    """
+
+    start = time.time()
+
+    infile = ROOT.TFile.Open(filename)
+    if not infile or infile.IsZombie():
+        return None
+    tree = infile.Get(treename)
+
+    if branches is not None:
+        tree.SetBranchStatus('*', 0)
+        for pattern in branches:
+            tree.SetBranchStatus(pattern, 1)
+    if cachebranches is None:
+        cachebranches = branches
+
+    if cachebranches is None:
+        cachesize = DEFAULTCACHESIZE
+    else:
+        cachesize = CacheSize(tree, MatchBranches(tree, cachebranches))
+
+    # The prefetching setting is picked up when the cache is made
+    oldprefetch = ROOT.gEnv.GetValue('TFile.AsyncPrefetching', 0)
+    ROOT.gEnv.SetValue('TFile.AsyncPrefetching', 1 if prefetch else 0)
+    tree.SetCacheSize(cachesize)
+    ROOT.gEnv.SetValue('TFile.AsyncPrefetching', oldprefetch)
+
+    cachedtree = CachedTree(infile, tree, start)
+    if cachebranches is None:
+        tree.SetCacheLearnEntries(learnentries)
+    else:
+        cachedtree.CacheBranches(cachebranches)
+
+    return cachedtree
+
+class CachedTree:
+    """A tree opened by OpenTree, with its file (file and tree attributes)."""
+
+    def __init__(self, infile, tree, start):
+
+        self.file = infile
+        self.tree = tree
+        self.__start = start
+
+    def Cache(self):
+        """The TTreeCache of the tree (a null pointer if there is none)."""
+        return self.tree.GetReadCache(self.file)
+
+    def CacheBranches(self, patterns):
+        """Replaces the branches in the cache with the branches matching the patterns,
+        eg before a TTree::Draw of different variables. This also ends the learning phase."""
+
+        self.tree.DropBranchFromCache('*', True)
+        for branch in MatchBranches(self.tree, patterns):
+            self.tree.AddBranchToCache(branch, True)
+        self.tree.StopCacheLearningPhase()
+
+    def Statistics(self):
+        """A dictionary of I/O statistics: bytes and calls read from the file,
+        and the size, number of cached branches and efficiency (fraction of baskets
+        found in the cache) of the cache."""
+
+        cache = self.Cache()
+        stats = {
+            'bytes': self.file.GetBytesRead(),
+            'calls': self.file.GetReadCalls(),
+            'time': time.time()-self.__start,
+            'cachesize': 0,
+            'cachedbranches': 0,
+            'efficiency': 0.,
+            }
+        if cache:
+            stats['cachesize'] = cache.GetBufferSize()
+            cachedbranches = cache.GetCachedBranches()
+            stats['cachedbranches'] = cachedbranches.GetEntriesFast() if cachedbranches else 0
+            stats['efficiency'] = cache.GetEfficiency()
+        return stats
+
+    def Close(self):
+        """Prints the I/O statistics and closes the file."""
+
+        stats = self.Statistics()
+        print 'INFO: Read %.1f MB from %s in %i calls (%.1f kB per call, %.1f MB/s)'%(
+            stats['bytes']/1e6, self.file.GetName(), stats['calls'],
+            stats['bytes']/1e3/max(1,stats['calls']), stats['bytes']/1e6/max(1e-3,stats['time']))
+        print 'INFO: TTreeCache of %.0f MB with %i branches, %.1f%% of the baskets read from the cache'%(
+            stats['cachesize']/1e6, stats['cachedbranches'], 100.*stats['efficiency'])
+
+        self.file.Close()
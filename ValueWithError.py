@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from math import sqrt
+import numpy
 
 class valueWithError:
     """Value with error which is uncorrelated with other variables.
@@ -18,6 +19,7 @@ class valueWithError:
             self.value = val
             self.error = err
     def __add__(self, other):
+        if isinstance(other,valueWithErrorArray): return NotImplemented
         result = valueWithError(self.value, self.error)
         if isinstance(other,type(self)):
             error2 = self.error*self.error + other.error*other.error
@@ -29,6 +31,7 @@ class valueWithError:
     def __radd__(self, other):
         return self.__add__(other)
     def __sub__(self, other):
+        if isinstance(other,valueWithErrorArray): return NotImplemented
         result = valueWithError(self.value, self.error)
         if isinstance(other,type(self)):
             error2 = self.error*self.error + other.error*other.error
@@ -42,6 +45,7 @@ class valueWithError:
         result.value = -result.value
         return result
     def __mul__(self, other):
+        if isinstance(other,valueWithErrorArray): return NotImplemented
         result = valueWithError(self.value, self.error)
         if isinstance(other,type(self)):
             term1 = self.error*other.value
@@ -56,6 +60,7 @@ class valueWithError:
     def __rmul__(self, other):
         return self.__mul__(other)
     def __div__(self, other):
+        if isinstance(other,valueWithErrorArray): return NotImplemented
         result = valueWithError(self.value, self.error)
         if isinstance(other,type(self)):
             term1 = self.error/other.value
@@ -79,7 +84,8 @@ class valueWithError:
         return 1 if self.value else 0
     def sqrt(self):
         from math import sqrt
-        return valueWithError(sqrt(self.value), self.error/(2*self.value))
+        value = sqrt(self.value)
+        return valueWithError(value, self.error/(2*value))
     def __float__(self):
         return float(self.value)
     def __int__(self):
@@ -106,4 +112,105 @@ class valueWithError:
         except ValueError:
             pass # Or set error to zero?
         return result
-            
+
+class valueWithErrorArray(object):
+    """Array counterpart of valueWithError, holding numpy arrays of values and (uncorrelated) errors.
+    Arithmetic (+,-,*,/), sqrt, abs and binomialDivision work element-wise, with numpy broadcasting,
+    and the other operand can be another valueWithErrorArray, a valueWithError, or plain numbers/arrays.
+    Errors are propagated as in valueWithError, and are always non-negative.
+    Indexing with an integer returns a valueWithError, other indices (slices, masks) a valueWithErrorArray.
+    """
+    # Make numpy arrays on the left of an operator defer to this class
+    __array_priority__ = 1000
+    def __init__(self, val=0, err=0):
+        if isinstance(val,(valueWithErrorArray,valueWithError)):
+            val,err = val.value,val.error
+        value,error = numpy.broadcast_arrays(numpy.array(val, dtype=numpy.float64), numpy.array(err, dtype=numpy.float64))
+        self.value = numpy.array(value)
+        self.error = numpy.array(error)
+    @classmethod
+    def fromList(cls, values):
+        """Makes an array from a list of valueWithError objects (or plain numbers, with no error)."""
+        return cls([float(v) for v in values], [getattr(v,'error',0.) for v in values])
+    def toList(self):
+        return [valueWithError(float(v),float(e)) for v,e in zip(self.value.flat,self.error.flat)]
+    @staticmethod
+    def __split(other):
+        # Value and error arrays of the other operand
+        if isinstance(other,(valueWithErrorArray,valueWithError)):
+            return numpy.asarray(other.value, dtype=numpy.float64),numpy.asarray(other.error, dtype=numpy.float64)
+        return numpy.asarray(other, dtype=numpy.float64),0.
+    @property
+    def shape(self):
+        return self.value.shape
+    def __len__(self):
+        return len(self.value)
+    def __getitem__(self, index):
+        if isinstance(index,(int,long,numpy.integer)):
+            return valueWithError(float(self.value[index]), float(self.error[index]))
+        return valueWithErrorArray(self.value[index], self.error[index])
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    def __add__(self, other):
+        value,error = self.__split(other)
+        return valueWithErrorArray(self.value + value, numpy.hypot(self.error, error))
+    def __radd__(self, other):
+        return self.__add__(other)
+    def __sub__(self, other):
+        value,error = self.__split(other)
+        return valueWithErrorArray(self.value - value, numpy.hypot(self.error, error))
+    def __rsub__(self, other):
+        result = self.__sub__(other)
+        result.value = -result.value
+        return result
+    def __neg__(self):
+        return valueWithErrorArray(-self.value, self.error)
+    def __mul__(self, other):
+        value,error = self.__split(other)
+        return valueWithErrorArray(self.value*value, numpy.hypot(self.error*value, error*self.value))
+    def __rmul__(self, other):
+        return self.__mul__(other)
+    def __div__(self, other):
+        value,error = self.__split(other)
+        return valueWithErrorArray(self.value/value, numpy.hypot(self.error/value, error*self.value/(value*value)))
+    def __rdiv__(self, other):
+        return valueWithErrorArray(other).__div__(self)
+    __truediv__ = __div__
+    __rtruediv__ = __rdiv__
+    def __abs__(self):
+        return valueWithErrorArray(numpy.abs(self.value), self.error)
+    def sqrt(self):
+        value = numpy.sqrt(self.value)
+        return valueWithErrorArray(value, self.error/(2*value))
+    def sum(self):
+        """Sum of all elements, as a valueWithError."""
+        return valueWithError(float(self.value.sum()), float(numpy.sqrt((self.error*self.error).sum())))
+    def __lt__(self, other):
+        return self.value < self.__split(other)[0]
+    def __le__(self, other):
+        return self.value <= self.__split(other)[0]
+    def __gt__(self, other):
+        return self.value > self.__split(other)[0]
+    def __ge__(self, other):
+        return self.value >= self.__split(other)[0]
+    def __str__(self):
+        return '[%s]'%(', '.join([valueWithError.printstring%(v,e) for v,e in zip(self.value.flat,self.error.flat)]))
+    def __repr__(self):
+        return self.__str__()
+    @classmethod
+    def binomialDivision(cls, first, second):
+        """Element-wise valueWithError.binomialDivision.
+        Where the binomial error is not defined, the usual error of the ratio is kept (as in the scalar version).
+        """
+
+        first = valueWithErrorArray(first)
+        second = valueWithErrorArray(second)
+        # As in the scalar version, the error of first only enters through the binomial error
+        result = valueWithErrorArray(first.value)/second
+
+        # Custom error calculation: delta^2 = [(1-2e)delta_p^2 + e^2 delta_tot^2]/N_tot^2
+        err2 = (1.-2.*result.value)*first.error*first.error + result.value*result.value*second.error*second.error
+        valid = err2 >= 0
+        result.error = numpy.where(valid, numpy.sqrt(numpy.where(valid, err2, 0.))/second.value, result.error)
+        return result
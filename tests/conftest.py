@@ -0,0 +1,5 @@
+# The modules of the package live in the top directory, not in an installed package
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
@@ -0,0 +1,78 @@
+"""Checks that the structured-array CLs helpers behave like the scalar CLs class."""
+
+import numpy
+
+from CLsValues import CLs,CLsArray,CLsList,SortCLs,MultiplyCLs,TruncateCLs
+
+def MakeCLsList():
+    # Includes ties (0.01 three times, 0.2 twice) and a mix of valid flags and ratios
+    values = [0.2, 0.01, 0.5, 0.01, 1e-7, 0.2, 0.01, 3e-6]
+    valid = [True, False, True, True, False, True, True, True]
+    ratios = [1., 0.5, 2., 0.1, 0.01, 1., 0.3, 1.5]
+    return [CLs(value, isvalid, ratio) for value,isvalid,ratio in zip(values,valid,ratios)]
+
+def AssertSameCLs(array, clslist):
+    for item,expected in zip(CLsList(array), clslist):
+        assert item.value == expected.value
+        assert item.valid == expected.valid
+        assert item.ratio == expected.ratio
+
+def test_roundtrip():
+    clslist = MakeCLsList()
+    AssertSameCLs(CLsArray(clslist), clslist)
+
+def test_log_values():
+    # Values that are not positive are log10(CLs), as in the constructor
+    logvalues = [-1., -3.5, 0.3, -0.]
+    array = CLsArray(logvalues, valid=False, ratio=0.5)
+    AssertSameCLs(array, [CLs(value, False, 0.5) for value in logvalues])
+
+def test_sort_ties():
+    # sorted() is stable, so equal values keep their original order
+    clslist = MakeCLsList()
+    expected = sorted(range(len(clslist)), key=lambda i: clslist[i])
+    assert list(SortCLs(CLsArray(clslist))) == expected
+
+def test_sort_axis():
+    clslist = MakeCLsList()
+    array = CLsArray(clslist).reshape(2, 4)
+    for irow in range(2):
+        row = clslist[4*irow:4*irow+4]
+        assert list(SortCLs(array)[irow]) == sorted(range(4), key=lambda i: row[i])
+
+def test_multiply():
+    clslist = MakeCLsList()
+    array = CLsArray(clslist)
+    # Every pair, as in the "twosmallest" strategy, and the whole list
+    for first in range(len(clslist)):
+        for second in range(len(clslist)):
+            expected = clslist[first]*clslist[second]
+            product = CLs.product([clslist[first], clslist[second]])
+            result = CLsList(MultiplyCLs(array[[first,second]])[numpy.newaxis])[0]
+            assert result.value == product.value
+            assert result.valid == product.valid == expected.valid
+            # CLs.product starts from CLs(1.), so the ratio is at most one
+            assert result.ratio == product.ratio == min(expected.ratio, 1.)
+    AssertSameCLs(MultiplyCLs(array)[numpy.newaxis], [CLs.product(clslist)])
+
+def test_multiply_axis():
+    clslist = MakeCLsList()
+    array = CLsArray(clslist).reshape(2, 4)
+    expected = [CLs.product(clslist[:4]), CLs.product(clslist[4:])]
+    result = MultiplyCLs(array, axis=1)
+    assert numpy.allclose(result['value'], [item.value for item in expected], rtol=1e-15, atol=0)
+    assert list(result['valid']) == [item.valid for item in expected]
+    assert list(result['ratio']) == [item.ratio for item in expected]
+
+def test_multiply_empty():
+    AssertSameCLs(MultiplyCLs(CLsArray([]))[numpy.newaxis], [CLs.product([])])
+
+def test_truncate():
+    # As the scalar truncation in Combiner: values below 1e-6 become 1e-6, nothing else changes
+    clslist = MakeCLsList()
+    array = TruncateCLs(CLsArray(clslist))
+    for item in clslist:
+        if item.value < 1e-6:
+            item.value = 1e-6
+    AssertSameCLs(array, clslist)
+    assert array['value'].min() == 1e-6
@@ -0,0 +1,94 @@
+"""Checks that valueWithErrorArray propagates errors like the scalar valueWithError."""
+
+import numpy
+
+from ValueWithError import valueWithError,valueWithErrorArray
+
+VALUES = [3., 0.5, 12., 7.]
+ERRORS = [0.3, 0.2, 1.5, 0.]
+OTHERVALUES = [2., 4., 0.25, 7.]
+OTHERERRORS = [0.1, 1., 0.05, 0.7]
+
+def Scalars(values, errors):
+    return [valueWithError(value, error) for value,error in zip(values,errors)]
+
+def AssertClose(array, scalars, signederrors=False):
+    """Compares the array with the scalar results, element by element.
+    The scalar class keeps the sign of the error when multiplying or dividing by a negative
+    constant, while the array errors are never negative, so by default errors are compared
+    without their sign."""
+
+    values = [item.value for item in scalars]
+    errors = [item.error if signederrors else abs(item.error) for item in scalars]
+    assert numpy.allclose(array.value, values, rtol=1e-12, atol=0)
+    assert numpy.allclose(array.error, errors, rtol=1e-12, atol=0)
+
+def test_roundtrip():
+    array = valueWithErrorArray(VALUES, ERRORS)
+    scalars = array.toList()
+    AssertClose(valueWithErrorArray.fromList(scalars), Scalars(VALUES, ERRORS), signederrors=True)
+    AssertClose(array, [array[i] for i in range(len(array))], signederrors=True)
+
+def test_arrays():
+    first = valueWithErrorArray(VALUES, ERRORS)
+    second = valueWithErrorArray(OTHERVALUES, OTHERERRORS)
+    firsts = Scalars(VALUES, ERRORS)
+    seconds = Scalars(OTHERVALUES, OTHERERRORS)
+
+    AssertClose(first+second, [a+b for a,b in zip(firsts,seconds)], signederrors=True)
+    AssertClose(first-second, [a-b for a,b in zip(firsts,seconds)], signederrors=True)
+    AssertClose(first*second, [a*b for a,b in zip(firsts,seconds)], signederrors=True)
+    AssertClose(first/second, [a/b for a,b in zip(firsts,seconds)], signederrors=True)
+
+def test_scalar_operand():
+    # A valueWithError on either side gives an array
+    array = valueWithErrorArray(VALUES, ERRORS)
+    scalars = Scalars(VALUES, ERRORS)
+    other = valueWithError(2.5, 0.4)
+
+    AssertClose(array+other, [a+other for a in scalars], signederrors=True)
+    AssertClose(other+array, [other+a for a in scalars], signederrors=True)
+    AssertClose(array*other, [a*other for a in scalars], signederrors=True)
+    AssertClose(other*array, [other*a for a in scalars], signederrors=True)
+    AssertClose(array/other, [a/other for a in scalars], signederrors=True)
+    assert isinstance(other-array, valueWithErrorArray)
+    AssertClose(other-array, [other-a for a in scalars], signederrors=True)
+
+def test_constants():
+    array = valueWithErrorArray(VALUES, ERRORS)
+    scalars = Scalars(VALUES, ERRORS)
+
+    for constant in [2., 0.5]:
+        AssertClose(array+constant, [a+constant for a in scalars], signederrors=True)
+        AssertClose(constant-array, [constant-a for a in scalars], signederrors=True)
+        AssertClose(array*constant, [a*constant for a in scalars], signederrors=True)
+        AssertClose(constant*array, [constant*a for a in scalars], signederrors=True)
+        AssertClose(array/constant, [a/constant for a in scalars], signederrors=True)
+
+def test_negative_constants():
+    # The only difference: the scalar errors change sign, the array errors do not
+    array = valueWithErrorArray(VALUES, ERRORS)
+    scalars = Scalars(VALUES, ERRORS)
+
+    for constant in [-2., -0.5]:
+        AssertClose(array*constant, [a*constant for a in scalars])
+        AssertClose(array/constant, [a/constant for a in scalars])
+        assert (array*constant).error.min() >= 0
+        assert min([(a*constant).error for a in scalars]) < 0
+
+def test_functions():
+    array = valueWithErrorArray(VALUES, ERRORS)
+    scalars = Scalars(VALUES, ERRORS)
+
+    AssertClose(array.sqrt(), [a.sqrt() for a in scalars], signederrors=True)
+    AssertClose(abs(-array), [abs(valueWithError(-a.value, a.error)) for a in scalars], signederrors=True)
+    total = sum(scalars[1:], scalars[0])
+    assert numpy.isclose(array.sum().value, total.value, rtol=1e-12, atol=0)
+    assert numpy.isclose(array.sum().error, total.error, rtol=1e-12, atol=0)
+
+def test_binomial_division():
+    # Passed/total pairs, including one where the binomial error is not defined (err2 < 0)
+    passed = Scalars([3., 8., 9.], [1.7, 2.8, 1.])
+    total = Scalars([10., 10., 10.], [3.2, 3.2, 0.1])
+    result = valueWithErrorArray.binomialDivision(valueWithErrorArray.fromList(passed), valueWithErrorArray.fromList(total))
+    AssertClose(result, [valueWithError.binomialDivision(a, b) for a,b in zip(passed,total)], signederrors=True)